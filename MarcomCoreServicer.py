@@ -1,28 +1,105 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from typing import Generator
+import grpc
+import pyarrow.compute as pc
 from agent import Agent, AgentAttribute
-from db import SimulationEvent
+from analytics import CycleAggregates, SimulationAnalytics, get_simulation_analytics, unregister_simulation_analytics
+from cassette import close_cassette, use_cassette
+from db import (
+    EventRecord,
+    SimulationEvent,
+    SimulationFork,
+    close_shard,
+    drop_simulation_db,
+    finish_simulation_db,
+    fork_simulation_db,
+    get_lineage,
+    in_lineage,
+    is_sharding_enabled,
+    iter_lineage,
+    iter_with_simulation_db,
+    query_all_simulations,
+    simulation_exists,
+    simulation_ids,
+    use_simulation_db,
+)
+from live_update import LiveUpdate
+from llm import use_cancel_event, use_deadline
+from export import (
+    DEFAULT_CHUNK_SIZE,
+    iter_broadcast_batches,
+    iter_event_batches,
+    iter_memory_batches,
+    to_ipc_bytes,
+)
 from product import Product
 from proto import marcom_core_pb2, marcom_core_pb2_grpc
+from research_cache import get_research_cache, is_research_cache_enabled
 from researcher import (
     do_web_search,
     get_product_comp_report,
     reconstruct_query_with_product,
 )
 from simulation import Simulation
+from utils import CancelledException, LLMTimeoutException
+from warmup import get_model_residency
+from workers import RemoteSimulation, WorkerPool
 
 
 class MarcomCoreServicer(marcom_core_pb2_grpc.MarcomServiceServicer):
     current_simulations: list[Simulation] = (
         []
     )  # when start simulation, create and put in this array, so when try to stream updates can get from here
+    # added to on the event loop and removed from by the executor threads once a simulation completes, only changed in place under this lock
+    simulations_lock = threading.Lock()
     # stores the generator for pause capabilities pair id -> the generator
-    simulation_generators: dict[int, Generator[SimulationEvent, None, None]] = {}
+    simulation_generators: dict[int, Generator[EventRecord, None, None]] = {}
+    # sim id -> updates taken from the simulation that no client has received yet (eg. the stream got cancelled), sent first by the next stream
+    unsent_updates: dict[int, list[marcom_core_pb2.SimulationUpdate]] = {}
 
-    def StartSimulation(self, request, context):
+    # handlers run on the event loop, anything blocking (LLM calls, db queries) goes to these bounded executors
+    # so waiting streams do not hold a thread and a burst of simulations queues up instead of spawning threads
+    def __init__(self) -> None:
+        self.llm_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("LLM_WORKERS") or 16), thread_name_prefix="llm"
+        )
+        self.db_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("DB_WORKERS") or 4), thread_name_prefix="db"
+        )
+        # research has its own threads, a burst of simulation steps would otherwise keep every llm thread busy and research waits behind them
+        self.research_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("RESEARCH_WORKERS") or 4), thread_name_prefix="research"
+        )
+        # simulations run in worker processes instead when there are any, see workers.py
+        num_workers = int(os.getenv("SIMULATION_WORKERS") or 0)
+        self.workers = WorkerPool(num_workers) if num_workers > 0 else None
+
+    # creates the simulation of the request, run by the servicer's llm workers or by a worker process in worker pool mode
+    def add_simulation(self, request) -> Simulation:
+        if self.workers is not None:
+            sim = self.workers.create_simulation(request)
+        else:
+            sim = build_simulation(request)
+            self.simulation_generators[sim.id] = sim.run_simulation()  # create the generator
+        with self.simulations_lock:
+            self.current_simulations.append(sim)
+        return sim
+
+    # copy of the running simulations, so they can be gone through while a step removes a completed one
+    def running_simulations(self) -> list[Simulation]:
+        with self.simulations_lock:
+            return list(self.current_simulations)
+
+    async def StartSimulation(self, request, context):
         print(request)
         # check if the simulation has already been created (frontend limits that completed simulation wont be able to hit the run button)
         in_curr_sim = [
-            sim for sim in self.current_simulations if int(sim.id) == int(request.id)
+            sim for sim in self.running_simulations() if int(sim.id) == int(request.id)
         ]
         if len(in_curr_sim) > 0:  # should only be 1 though
             # resume the simulation, since is reference, can direct make changes
@@ -31,53 +108,187 @@ class MarcomCoreServicer(marcom_core_pb2_grpc.MarcomServiceServicer):
                 message="Simulation exist in core, calling stream to listen to updates"
             )  # give the client such message, but backend is the one responsible for calling stream
         else:
-            # build agents from grpc request
-            agents = []
-            for agent in request.agents:
-                agent_attrs = []
-                for attr in agent.attrs:
-                    agent_attrs.append(AgentAttribute(key=attr.key, value=attr.value))
-                agents.append(
-                    Agent(
-                        id=agent.id,
-                        name=agent.name,
-                        desc=agent.desc,
-                        attrs=agent_attrs,
-                        simulation_id=request.id,
-                    )
-                )
-            # build products from grpc request
-            products = []
-            for product in request.products:
-                products.append(
-                    Product(
-                        id=product.id,
-                        name=product.name,
-                        desc=product.desc,
-                        price=product.price,
-                        cost=product.cost,
-                        simulation_id=request.id,
-                    )
-                )
-            sim = Simulation(
-                id=int(request.id),
-                env_desc=request.env_desc,
-                agents=agents,
-                products=products,
-                total_cycle=request.total_cycles,
-            )
-            self.current_simulations.append(sim)
-            self.simulation_generators[sim.id] = (
-                sim.run_simulation()
-            )  # create the generator
+            self.add_simulation(request)
             return marcom_core_pb2.SimulationResponse(
                 message="Simulation added, calling stream to initialise and run simulation"
             )
 
-    def PauseSimulation(self, request, context):
+    # branches an existing simulation at fork_cycle with the products and environment description of the request
+    # the fork reads the parent's history before fork_cycle instead of copying or rerunning it, only its own cycles cost LLM calls
+    async def ForkSimulation(self, request, context):
+        print(request)
+        sim_id = int(request.simulation.id)
+        if request.fork_cycle < 1:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "fork_cycle starts from 1")
+        if sim_id == int(request.parent_id) or any([int(sim.id) == sim_id for sim in self.running_simulations()]):
+            await context.abort(grpc.StatusCode.ALREADY_EXISTS, f"Simulation {sim_id} already exists")
+        error = await asyncio.get_running_loop().run_in_executor(
+            self.db_executor, create_fork, sim_id, int(request.parent_id), int(request.fork_cycle)
+        )
+        if error is not None:
+            await context.abort(*error)
+        self.add_simulation(request.simulation)
+        return marcom_core_pb2.SimulationResponse(
+            message=f"Simulation forked from simulation {request.parent_id} at cycle {request.fork_cycle}, calling stream to run the fork"
+        )
+
+    # deletes a simulation the core is not running (a paused one is still in the core, its next stream would write to it again)
+    # its forks read their shared history from it, so they are dropped with it when asked to and it is not dropped otherwise
+    async def DropSimulation(self, request, context):
+        print(request)
+        sim_id = int(request.simulation_id)
+        loop = asyncio.get_running_loop()
+        sim_ids = await loop.run_in_executor(self.db_executor, find_simulation_and_forks, sim_id)
+        if len(sim_ids) == 0:
+            await context.abort(grpc.StatusCode.NOT_FOUND, f"No such simulation {sim_id} to drop")
+        if len(sim_ids) > 1 and not request.with_forks:
+            await context.abort(
+                grpc.StatusCode.FAILED_PRECONDITION, f"Simulation {sim_id} has forks {sim_ids[1:]}, set with_forks to drop them too"
+            )
+        running = [int(sim.id) for sim in self.running_simulations() if int(sim.id) in sim_ids]
+        if len(running) > 0:
+            await context.abort(grpc.StatusCode.FAILED_PRECONDITION, f"Simulation {running[0]} is still in the core")
+        await loop.run_in_executor(self.db_executor, drop_simulations, sim_ids)
+        for id in sim_ids:
+            self.unsent_updates.pop(id, None)
+        return marcom_core_pb2.DropSimulationResponse(message=f"Dropped {len(sim_ids)} simulation(s)", dropped_ids=sim_ids)
+
+    # runs the variants of a base simulation side by side, the base's agents are initialised once and every variant is a fork of it from cycle 1
+    # so persona rewrites are shared, and variants step together on the llm workers so the model servers are kept busy with all of them
+    # streams the events of every variant, and the analytics of all variants each time they have all completed another cycle
+    async def RunSweep(self, request, context):
+        print(request)
+        base_id = int(request.base.id)
+        variant_ids = [int(v.id) for v in request.variants]
+        if len(variant_ids) == 0:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "A sweep needs at least one variant")
+        if len(set(variant_ids + [base_id])) != len(variant_ids) + 1:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "The base and every variant need their own id")
+        running = [int(sim.id) for sim in self.running_simulations() if int(sim.id) in variant_ids + [base_id]]
+        if len(running) > 0:
+            await context.abort(grpc.StatusCode.ALREADY_EXISTS, f"Simulation {running[0]} is already running")
+        loop = asyncio.get_running_loop()
+        existing = await loop.run_in_executor(self.db_executor, find_existing_simulations, variant_ids)
+        if len(existing) > 0:
+            await context.abort(grpc.StatusCode.ALREADY_EXISTS, f"Simulation {existing[0]} already exists")
+
+        # the base only runs its initialisation (0 cycles), an already initialised base is reused as is
+        base_request = marcom_core_pb2.SimulationRequest()
+        base_request.CopyFrom(request.base)
+        base_request.total_cycles = 0
+        base = self.add_simulation(base_request)
+        async for update in self.merge_updates([base], context):
+            yield marcom_core_pb2.SweepUpdate(update=update)
+        if base in self.running_simulations():
+            return  # paused or cancelled before the agents were initialised
+
+        for v in request.variants:
+            error = await loop.run_in_executor(self.db_executor, create_fork, int(v.id), base_id, 1)
+            if error is not None:
+                await context.abort(*error)
+        variants = [self.add_simulation(to_variant_request(request.base, v)) for v in request.variants]
+
+        completed = {int(sim.id): 0 for sim in variants}  # last cycle each variant completed
+        ended = set()
+        reported = 0
+        async for update in self.merge_updates(variants, context):
+            yield marcom_core_pb2.SweepUpdate(update=update)
+            if update.action == "BUDGET":
+                completed[update.simulation_id] = update.cycle  # BUDGET is the last event of a cycle
+            elif update.action == "COMPLETE":
+                ended.add(update.simulation_id)
+            else:
+                continue
+            while True:
+                cycle = reported + 1
+                # variants that ended before the cycle (fewer cycles or out of budget) are left out of it
+                in_cycle = [sim for sim in variants if sim.total_cycle < 0 or sim.total_cycle >= cycle]
+                if len(in_cycle) == 0 or any(
+                    [int(sim.id) not in ended and completed[int(sim.id)] < cycle for sim in in_cycle]
+                ):
+                    break
+                reported = cycle
+                yield marcom_core_pb2.SweepUpdate(
+                    cycle=cycle,
+                    cycle_results=[to_analytics_message(sim.analytics, cycle, sim.analytics.get(cycle)) for sim in in_cycle],
+                    total_results=[to_analytics_message(sim.analytics, 0, sim.analytics.get_until(cycle)) for sim in variants],
+                )
+
+    # pulls the updates of the simulations at the same time (each from its own llm worker) until every one of them is paused or completed
+    async def merge_updates(self, sims: list[Simulation], context):
+        by_id = {int(sim.id): sim for sim in sims}
+        updates = asyncio.Queue()
+        producers = []
+        for sim in sims:
+            self.watch_stream(sim, context)
+            producers.append(asyncio.create_task(self.produce_updates(sim, updates)))
+        try:
+            running = len(producers)
+            while running > 0:
+                update = await updates.get()
+                if update is None:
+                    running -= 1  # every producer ends with None
+                    continue
+                yield update
+                self.ack_updates(by_id[update.simulation_id], 1)
+            await asyncio.gather(*producers)  # raises the exception that stopped a simulation if any
+        finally:
+            for producer in producers:
+                producer.cancel()
+
+    # ready once the models are loaded (see warmup.py), for the backend or a load balancer to hold off sending work until then
+    async def GetReadiness(self, request, context):
+        residency = get_model_residency()
+        ready = residency.is_ready()
+        if ready:
+            message = "Models loaded"
+        elif not residency.warmed_up.is_set():
+            message = "Warming up models"
+        else:
+            message = "Some models could not be loaded, retrying"
+        return marcom_core_pb2.ReadinessResponse(
+            ready=ready,
+            message=message,
+            models=[
+                marcom_core_pb2.ModelReadiness(
+                    server=status.backend.url,
+                    model=status.model,
+                    loaded=status.loaded,
+                    load_seconds=status.load_time or 0,
+                    error=status.error,
+                )
+                for status in residency.statuses
+            ],
+        )
+
+    # a simulation runs while it is not paused, paused ones can wait for the models to load again
+    def has_active_simulations(self) -> bool:
+        return any([not sim.paused for sim in self.running_simulations()])
+
+    # changes the products or environment description of a running simulation from the start of its next cycle, instead of starting it over
+    async def UpdateSimulation(self, request, context):
+        print(request)
         in_curr_sim = [
             sim
-            for sim in self.current_simulations
+            for sim in self.running_simulations()
+            if int(sim.id) == int(request.simulation_id)
+        ]
+        if len(in_curr_sim) <= 0:
+            await context.abort(grpc.StatusCode.NOT_FOUND, "No such simulation running, is StartSimulation called?")
+        update = to_live_update(request, uuid.uuid4().hex[:12])
+        error = in_curr_sim[0].check_update(update)
+        if error != "":
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, error)
+        in_curr_sim[0].queue_update(update)
+        return marcom_core_pb2.UpdateSimulationResponse(
+            message="Update queued, applied at the start of the next cycle of the simulation",
+            update_id=update.id,
+        )
+
+    async def PauseSimulation(self, request, context):
+        in_curr_sim = [
+            sim
+            for sim in self.running_simulations()
             if int(sim.id) == int(request.simulation_id)
         ]
         if len(in_curr_sim) > 0:  # should only be 1 though
@@ -90,49 +301,144 @@ class MarcomCoreServicer(marcom_core_pb2_grpc.MarcomServiceServicer):
             message="No such simulation in the system, is StartSimulation called?"
         )
 
-    def StreamSimulationUpdates(self, request, context):
+    async def StreamSimulationUpdates(self, request, context):
         in_curr_sim = [
             sim
-            for sim in self.current_simulations
+            for sim in self.running_simulations()
             if int(sim.id) == int(request.simulation_id)
         ]
         if len(in_curr_sim) <= 0:
             # simulation does not exist or is completed (completed simulations will be removed), directly end ba
             return
-        # get the specific generator
-        gen = self.simulation_generators[int(request.simulation_id)]
+        self.watch_stream(in_curr_sim[0], context)
+        for update in list(self.unsent_updates.get(int(in_curr_sim[0].id), [])):
+            yield update
+            self.ack_updates(in_curr_sim[0], 1)
+        loop = asyncio.get_running_loop()
         while not in_curr_sim[0].paused:
-            try:
-                sim_event = next(gen)
-                yield marcom_core_pb2.SimulationUpdate(
-                    agent_id=(
-                        sim_event.agent.agent_id if sim_event.agent is not None else 0
-                    ),
-                    action=sim_event.type,
-                    content=sim_event.content,
-                    cycle=sim_event.cycle,
-                    simulation_id=sim_event.sim_id,
-                )
-            except StopIteration:
-                # the simulation ended, remove it from the list
-                self.current_simulations = [
-                    sim
-                    for sim in self.current_simulations
-                    if int(sim.id) != int(request.simulation_id)
-                ]
-                del self.simulation_generators[int(request.simulation_id)]
-                # tell backend it ended
-                yield marcom_core_pb2.SimulationUpdate(
-                    agent_id=0,
-                    action="COMPLETE",
-                    content="",
-                    cycle=sim_event.cycle,
-                    simulation_id=sim_event.sim_id,
-                )
+            update = await loop.run_in_executor(self.llm_executor, self.next_update, in_curr_sim[0])
+            if update is None:
+                break  # interrupted
+            yield update
+            self.ack_updates(in_curr_sim[0], 1)
+            if update.action == "COMPLETE":
                 break
 
-    def ResearchProductCompetitor(self, request, context):
+    # same as StreamSimulationUpdates but many updates per message, for bursts (eg. initialisation, surrogate cycles) where per message overhead dominates
+    # a batch is sent once it has max_updates updates, reaches max_bytes, or linger_ms passed since its first update
+    async def StreamSimulationUpdatesBatched(self, request, context):
+        in_curr_sim = [
+            sim
+            for sim in self.running_simulations()
+            if int(sim.id) == int(request.simulation_id)
+        ]
+        if len(in_curr_sim) <= 0:
+            return
+        self.watch_stream(in_curr_sim[0], context)
+        if request.compress:
+            context.set_compression(grpc.Compression.Gzip)
+        max_updates = request.max_updates or int(os.getenv("STREAM_BATCH_MAX_UPDATES") or 64)
+        max_bytes = request.max_bytes or int(os.getenv("STREAM_BATCH_MAX_BYTES") or 65536)
+        linger = (request.linger_ms or int(os.getenv("STREAM_BATCH_LINGER_MS") or 50)) / 1000
+        # the simulation is pulled by its own task so a batch can be flushed on linger while an LLM call is still going
+        updates = asyncio.Queue()
+        producer = asyncio.create_task(self.produce_updates(in_curr_sim[0], updates))
+        try:
+            batch: list[marcom_core_pb2.SimulationUpdate] = []
+            batch_bytes = 0
+            flush_at = None
+            while True:
+                timeout = None if flush_at is None else max(flush_at - time.monotonic(), 0)
+                try:
+                    update = await asyncio.wait_for(updates.get(), timeout)
+                except asyncio.TimeoutError:
+                    update = None  # lingered long enough
+                else:
+                    if update is None:
+                        break
+                    batch.append(update)
+                    batch_bytes += update.ByteSize()
+                    if flush_at is None:
+                        flush_at = time.monotonic() + linger
+                    if len(batch) < max_updates and batch_bytes < max_bytes:
+                        continue
+                yield marcom_core_pb2.SimulationUpdateBatch(updates=batch)
+                self.ack_updates(in_curr_sim[0], len(batch))
+                batch, batch_bytes, flush_at = [], 0, None
+            if len(batch) > 0:
+                yield marcom_core_pb2.SimulationUpdateBatch(updates=batch)
+                self.ack_updates(in_curr_sim[0], len(batch))
+            await producer  # raises the exception that stopped the simulation if any
+        finally:
+            producer.cancel()  # client went away, stop pulling events
+
+    # pulls updates until the simulation is paused or completed, ends with None
+    async def produce_updates(self, sim: Simulation, updates: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        try:
+            for update in list(self.unsent_updates.get(int(sim.id), [])):
+                updates.put_nowait(update)
+            while not sim.paused:
+                update = await loop.run_in_executor(self.llm_executor, self.next_update, sim)
+                if update is None:
+                    break  # interrupted
+                updates.put_nowait(update)
+                if update.action == "COMPLETE":
+                    break
+        finally:
+            updates.put_nowait(None)
+
+    # a stream is what drives the simulation, when the client goes away the LLM call in progress is cancelled instead of running for nothing
+    def watch_stream(self, sim: Simulation, context):
+        sim.cancel_event.clear()  # left set if the previous stream was cancelled
+        context.add_done_callback(lambda ctx: sim.cancel() if ctx.cancelled() else None)
+
+    # the first n unsent updates reached the client
+    def ack_updates(self, sim: Simulation, n: int):
+        unsent = self.unsent_updates.get(int(sim.id), [])
+        del unsent[:n]
+        if len(unsent) == 0:
+            self.unsent_updates.pop(int(sim.id), None)
+
+    # runs the simulation until its next event, the COMPLETE update is returned once it ends
+    # returns None when the simulation got interrupted (paused or cancelled), it continues from the interrupted turn with a new generator
+    def next_update(self, sim: Simulation) -> marcom_core_pb2.SimulationUpdate:
+        # a new stream can start while the step of a cancelled one is still winding down, the generator can only run one step at a time
+        with sim.step_lock:
+            update = self.step_simulation(sim)
+        if update is not None:
+            self.unsent_updates.setdefault(int(sim.id), []).append(update)
+        return update
+
+    def step_simulation(self, sim: Simulation) -> marcom_core_pb2.SimulationUpdate:
+        if sim not in self.running_simulations():
+            return None  # completed while this stream waited for the step lock (eg. another stream of the simulation got COMPLETE)
+        if isinstance(sim, RemoteSimulation):
+            update = sim.step()
+        else:
+            update = step_local_simulation(sim, self.simulation_generators)
+        if update is not None and update.action == "COMPLETE":
+            # the simulation ended, remove it from the list
+            with self.simulations_lock:
+                if sim in self.current_simulations:
+                    self.current_simulations.remove(sim)
+            if isinstance(sim, RemoteSimulation) and is_sharding_enabled():
+                close_shard(int(sim.id))  # the worker finished (and maybe archived) the shard, reopened from the catalog if read again
+        return update
+
+    async def ResearchProductCompetitor(self, request, context):
         print(request)
+        # the LLM calls stop once the caller's deadline passes instead of running on for a response no one waits for
+        remaining = context.time_remaining()  # None if the caller did not set a deadline
+        deadline = time.monotonic() + remaining if remaining is not None else None
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.research_executor, self.research_product_competitor, request, deadline
+            )
+        except LLMTimeoutException as e:
+            await context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, f"Research timed out: {e}")
+
+    def research_product_competitor(self, request, deadline: float = None) -> marcom_core_pb2.ProductCompetitorResponse:
         p = Product(
             id=int(request.id),
             name=request.name,
@@ -141,6 +447,33 @@ class MarcomCoreServicer(marcom_core_pb2_grpc.MarcomServiceServicer):
             cost=float(request.cost),
             simulation_id=0,
         )  # not associated to a specific simulation
+        if not is_research_cache_enabled():
+            return self.run_research(p, deadline)
+        cache = get_research_cache()
+        cached = cache.lookup(p)
+        if cached is not None:
+            print(f"Research of product {p.id} served from the report of product {cached.row.product_id} (similarity {cached.similarity:.2f})")
+            return marcom_core_pb2.ProductCompetitorResponse(
+                query=cached.row.query,
+                report=cached.row.report,
+                cached=True,
+                source_product_id=cached.row.product_id,
+                source_product_name=cached.row.name,
+                similarity=cached.similarity,
+                source_created_at_ms=int(cached.row.time_created.timestamp() * 1000),
+            )
+        res = self.run_research(p, deadline)
+        cache.store(p, res.query, res.report)
+        return res
+
+    def run_research(self, p: Product, deadline: float = None) -> marcom_core_pb2.ProductCompetitorResponse:
+        try:
+            with use_deadline(deadline), use_cassette(f"research_{p.id}"):
+                return self.research(p)
+        finally:
+            close_cassette(f"research_{p.id}")
+
+    def research(self, p: Product) -> marcom_core_pb2.ProductCompetitorResponse:
         reconstructed_query = reconstruct_query_with_product(p)
         search_results = do_web_search(reconstructed_query["query"])
         report = get_product_comp_report(
@@ -149,3 +482,293 @@ class MarcomCoreServicer(marcom_core_pb2_grpc.MarcomServiceServicer):
         return marcom_core_pb2.ProductCompetitorResponse(
             query=reconstructed_query["query"], report=report
         )
+
+    async def GetSimulationAnalytics(self, request, context):
+        analytics = await asyncio.get_running_loop().run_in_executor(
+            self.db_executor, load_simulation_analytics, int(request.simulation_id)
+        )
+        if analytics is None:
+            context.set_code(grpc.StatusCode.NOT_FOUND)
+            context.set_details("No such simulation in the system, is StartSimulation called?")
+            return marcom_core_pb2.SimulationAnalytics()
+        return to_analytics_message(analytics, int(request.cycle), analytics.get(int(request.cycle)))
+
+    async def ExportSimulationHistory(self, request, context):
+        chunk_size = (
+            int(request.chunk_size)
+            if request.chunk_size > 0
+            else int(os.getenv("EXPORT_CHUNK_SIZE") or DEFAULT_CHUNK_SIZE)
+        )
+        tables = [("events", iter_event_batches)]
+        if not request.events_only:
+            tables.append(("memories", iter_memory_batches))
+            tables.append(("broadcasts", iter_broadcast_batches))
+        loop = asyncio.get_running_loop()
+        for table, iter_batches in tables:
+            batches = iter_with_simulation_db(
+                int(request.simulation_id),
+                iter_batches(
+                    int(request.simulation_id),
+                    int(request.from_cycle),
+                    int(request.to_cycle),
+                    chunk_size,
+                ),
+            )
+            while True:
+                chunk = await loop.run_in_executor(self.db_executor, next_export_chunk, table, batches)
+                if chunk is None:
+                    break
+                yield chunk
+
+
+# builds the simulation of a StartSimulation (or the fork of a ForkSimulation) request, settings not in the request come from env
+def build_simulation(request) -> Simulation:
+    # build agents from grpc request
+    agents = []
+    for agent in request.agents:
+        agent_attrs = []
+        for attr in agent.attrs:
+            agent_attrs.append(AgentAttribute(key=attr.key, value=attr.value))
+        agents.append(
+            Agent(
+                id=agent.id,
+                name=agent.name,
+                desc=agent.desc,
+                attrs=agent_attrs,
+                simulation_id=request.id,
+            )
+        )
+    # build products from grpc request
+    products = []
+    for product in request.products:
+        products.append(
+            Product(
+                id=product.id,
+                name=product.name,
+                desc=product.desc,
+                price=product.price,
+                cost=product.cost,
+                simulation_id=request.id,
+            )
+        )
+    return Simulation(
+        id=int(request.id),
+        env_desc=request.env_desc,
+        agents=agents,
+        products=products,
+        total_cycle=request.total_cycles,
+        batch_feedback=os.getenv("BATCH_FEEDBACK") == "true",
+        feedback_batch_size=int(os.getenv("FEEDBACK_BATCH_SIZE") or 8),
+        population_mode=os.getenv("POPULATION_MODE") == "true",
+        num_archetypes=(
+            int(os.getenv("POPULATION_ARCHETYPES"))
+            if os.getenv("POPULATION_ARCHETYPES")
+            else None
+        ),
+        population_sample_fraction=float(
+            os.getenv("POPULATION_SAMPLE_FRACTION") or 0.1
+        ),
+        surrogate_mode=os.getenv("SURROGATE_MODE") == "true",
+        surrogate_confidence=float(os.getenv("SURROGATE_CONFIDENCE") or 0.8),
+        surrogate_calibration_rate=float(
+            os.getenv("SURROGATE_CALIBRATION_RATE") or 0.1
+        ),
+        surrogate_min_cycles=int(os.getenv("SURROGATE_MIN_CYCLES") or 2),
+        max_dialogue_turns=int(os.getenv("MAX_DIALOGUE_TURNS") or 3),
+        cycle_token_budget=int(os.getenv("CYCLE_TOKEN_BUDGET") or 0),
+        simulation_token_budget=int(os.getenv("SIMULATION_TOKEN_BUDGET") or 0),
+        cycle_deadline=float(os.getenv("CYCLE_DEADLINE_SECONDS") or 0),
+        catalog_shortlist_size=int(os.getenv("CATALOG_SHORTLIST_SIZE") or 20),
+        catalog_exploration_slots=int(os.getenv("CATALOG_EXPLORATION_SLOTS") or 2),
+        social_graph=os.getenv("SOCIAL_GRAPH") or None,
+        social_degree=int(os.getenv("SOCIAL_DEGREE") or 8),
+        social_rewire=float(os.getenv("SOCIAL_REWIRE") or 0.1),
+        neighbours={
+            agent.id: list(agent.neighbour_ids)
+            for agent in request.agents
+            if len(agent.neighbour_ids) > 0
+        }
+        or None,
+    )
+
+
+def to_live_update(request, id: str) -> LiveUpdate:
+    return LiveUpdate(
+        id,
+        [
+            Product(
+                id=product.id,
+                name=product.name,
+                desc=product.desc,
+                price=product.price,
+                cost=product.cost,
+                simulation_id=request.simulation_id,
+            )
+            for product in request.products
+        ],
+        [int(i) for i in request.removed_product_ids],
+        request.env_desc,
+    )
+
+
+# returns the status code and details to abort ForkSimulation with, None once the fork is created
+def create_fork(sim_id: int, parent_id: int, fork_cycle: int) -> tuple[grpc.StatusCode, str]:
+    with use_simulation_db(sim_id, create=False):
+        if simulation_exists(sim_id):
+            return grpc.StatusCode.ALREADY_EXISTS, f"Simulation {sim_id} already exists"
+    with use_simulation_db(parent_id, create=False):
+        if not simulation_exists(parent_id):
+            return grpc.StatusCode.NOT_FOUND, f"No such simulation {parent_id} to fork"
+        # the cycles before the fork cycle have to be done, BUDGET is the last event of a cycle
+        done = next(
+            iter_lineage(
+                get_lineage(parent_id),
+                lambda sim_id, until_cycle: SimulationEvent.select()
+                .where(
+                    in_lineage([(sim_id, until_cycle)], SimulationEvent.sim_id, SimulationEvent.cycle)
+                    & (
+                        ((SimulationEvent.cycle == fork_cycle - 1) & (SimulationEvent.type == "BUDGET"))
+                        | (SimulationEvent.cycle >= fork_cycle)
+                    )
+                )
+                .limit(1),
+            ),
+            None,
+        )
+        if fork_cycle > 1 and done is None:
+            return grpc.StatusCode.FAILED_PRECONDITION, f"Simulation {parent_id} has not completed cycle {fork_cycle - 1} yet"
+    fork_simulation_db(sim_id, parent_id, fork_cycle)
+    return None
+
+
+# the simulation and every simulation forked off it (forks of forks too), empty if there is no such simulation
+def find_simulation_and_forks(sim_id: int) -> list[int]:
+    if sim_id not in simulation_ids():
+        return []
+    forks = query_all_simulations(
+        lambda fork_id, _: SimulationFork.select(SimulationFork.sim_id, SimulationFork.parent_id)
+        .where(SimulationFork.sim_id == fork_id)
+        .tuples()
+    )
+    children: dict[int, list[int]] = {}
+    for fork_id, parent_id in forks:
+        children.setdefault(parent_id, []).append(fork_id)
+    found = [sim_id]
+    for id in found:
+        found.extend(children.get(id, []))  # gone through as it grows
+    return found
+
+
+# forks first, a simulation is never dropped while a fork still reads from it
+def drop_simulations(sim_ids: list[int]):
+    for sim_id in reversed(sim_ids):
+        drop_simulation_db(sim_id)
+        unregister_simulation_analytics(sim_id)
+        print(f"Dropped simulation {sim_id}")
+
+
+# the variant with the base's roster, and the base's products, environment description and cycles where the variant leaves them empty
+def to_variant_request(base, variant) -> marcom_core_pb2.SimulationRequest:
+    return marcom_core_pb2.SimulationRequest(
+        id=variant.id,
+        env_desc=variant.env_desc or base.env_desc,
+        agents=base.agents,
+        products=variant.products if len(variant.products) > 0 else base.products,
+        total_cycles=variant.total_cycles or base.total_cycles,
+    )
+
+
+def find_existing_simulations(sim_ids: list[int]) -> list[int]:
+    existing = []
+    for sim_id in sim_ids:
+        with use_simulation_db(sim_id, create=False):
+            if simulation_exists(sim_id):
+                existing.append(sim_id)
+    return existing
+
+
+# runs the simulation's generator to its next event, on the servicer's llm workers or in a simulation worker process (see workers.py)
+# returns None when the simulation got interrupted (paused or cancelled), it continues from the interrupted turn with a new generator
+def step_local_simulation(sim: Simulation, generators: dict[int, Generator[EventRecord, None, None]]) -> marcom_core_pb2.SimulationUpdate:
+    # get the specific generator
+    gen = generators[int(sim.id)]
+    try:
+        # the simulation's work happens in next, route its queries to the simulation's db
+        with use_simulation_db(int(sim.id)), use_cancel_event(sim.cancel_event), use_cassette(f"sim_{sim.id}"):
+            sim_event = next(gen)
+        return to_simulation_update(sim_event)
+    except CancelledException:
+        # the generator is done for once an exception goes through it, the simulation keeps its progress so a new one picks up from there
+        generators[int(sim.id)] = sim.run_simulation()
+        return None
+    except LLMTimeoutException as e:
+        # timeouts outside of a turn (eg. rewriting personas when initialising), reported and retried by the next step
+        generators[int(sim.id)] = sim.run_simulation()
+        with use_simulation_db(int(sim.id)):
+            timeout_event = sim.new_event("TIMEOUT", f"{e}, retrying")
+        return to_simulation_update(timeout_event)
+    except StopIteration:
+        del generators[int(sim.id)]
+        close_cassette(f"sim_{sim.id}")
+        finish_simulation_db(int(sim.id))
+        # tell backend it ended
+        return marcom_core_pb2.SimulationUpdate(
+            agent_id=0,
+            action="COMPLETE",
+            content="",
+            cycle=max(sim.cycle - 1, 0),  # cycle of the last event, the simulation moved past the last cycle when it ended
+            simulation_id=int(sim.id),
+            ready_at_ms=int(time.time() * 1000),
+        )
+
+
+def to_simulation_update(sim_event: EventRecord) -> marcom_core_pb2.SimulationUpdate:
+    return marcom_core_pb2.SimulationUpdate(
+        agent_id=sim_event.agent_id,
+        action=sim_event.type,
+        content=sim_event.content,
+        cycle=sim_event.cycle,
+        simulation_id=sim_event.sim_id,
+        ready_at_ms=int(time.time() * 1000),
+    )
+
+
+def load_simulation_analytics(sim_id: int):
+    with use_simulation_db(sim_id, create=False):
+        return get_simulation_analytics(sim_id)
+
+
+def to_analytics_message(analytics: SimulationAnalytics, cycle: int, aggregates: CycleAggregates) -> marcom_core_pb2.SimulationAnalytics:
+    return marcom_core_pb2.SimulationAnalytics(
+        simulation_id=analytics.sim_id,
+        cycle=cycle,
+        latest_cycle=analytics.latest_cycle,
+        decisions=aggregates.decisions(),
+        skips=aggregates.skips,
+        skip_rate=aggregates.skip_rate(),
+        messages=aggregates.messages,
+        revenue=aggregates.revenue(),
+        margin=aggregates.margin(),
+        products=[
+            marcom_core_pb2.ProductAnalytics(
+                product_id=product_id,
+                purchases=p.purchases,
+                revenue=p.revenue,
+                margin=p.margin(),
+            )
+            for product_id, p in aggregates.products.items()
+        ],
+    )
+
+
+# reads and encodes the next chunk of the table, None when the table is done
+def next_export_chunk(table: str, batches) -> marcom_core_pb2.ExportChunk:
+    batch = next(batches, None)
+    if batch is None:
+        return None
+    return marcom_core_pb2.ExportChunk(
+        table=table,
+        arrow_ipc=to_ipc_bytes(batch),
+        rows=batch.num_rows,
+        max_cycle=pc.max(batch.column("cycle")).as_py(),
+    )
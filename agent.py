@@ -1,19 +1,28 @@
 import copy
+import heapq
+import sys
+from datetime import datetime
 from typing import Self, Callable
 from pydantic import BaseModel, Field
-from langchain_community.llms import Ollama
 from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.prompts import PromptTemplate
 
-from db import AgentInfo, AgentMemory
+from db import AgentInfo, AgentMemory, in_lineage, iter_lineage
+from llm import RoutedChain
 from product import Product
-from utils import get_chain_response_json, get_format_instruction_of_pydantic_object
+from utils import get_format_instruction_of_pydantic_object
+
+
+MEMORY_WINDOW = 30  # number of newest memories put in the prompt
 
 
 class AgentAttribute:
+    __slots__ = ("key", "value")
+
     def __init__(self, key: str, value: str) -> None:
-        self.key = key
-        self.value = value
+        # same few keys and values are repeated across the whole roster, interned so every agent points to one copy
+        self.key = sys.intern(key)
+        self.value = sys.intern(value)
 
     def string(self) -> str:
         return f"{{{self.key}, {self.value}}}"  # for future me: need to use double curly to escape curly in f strings
@@ -27,7 +36,6 @@ class AgentAttributeRewrite(BaseModel):
 def get_agent_desc_rewrite(
     name: str, desc: str, attrs: list[AgentAttribute]
 ) -> dict[str, str]:
-    llm = Ollama(model="llama3.1", format="json", stop=["<|eot_id|>"])
     parser = JsonOutputParser(pydantic_object=AgentAttributeRewrite)
     kvInStr = f"[{",".join([attr.string() for attr in attrs])}]"
     prompt = PromptTemplate(
@@ -47,7 +55,12 @@ def get_agent_desc_rewrite(
 
     rewrite_desc = f"Rewrite {desc} to create an agent named {name} that is in a simulation in a second person point of view, start with 'You are in a simulation with other agents and you act as {name},'"
     rewrite_attr_second_person = f"Given the following {{key,value}} pairs in a list {kvInStr}, write a paragraph in a second person point of view, try to fit everything in a short paragraph, do not include special characters in the description. Rewrite it such that it tells the agent about it's personality, phrase the paragraph so that they know they are consumers"
-    chain = prompt | llm | parser
+    chain = RoutedChain(
+        "persona_rewrite",
+        lambda llm: prompt | llm | parser,
+        format="json",
+        stop=["<|eot_id|>"],
+    )
     invalid_characters = [
         "{",
         "}",
@@ -61,12 +74,11 @@ def get_agent_desc_rewrite(
         )
 
     # rewriting description for agent
-    res_desc = get_chain_response_json(
-        chain, {"action": rewrite_desc}, ["description"], additional_check=add_check
+    res_desc = chain.invoke_json(
+        {"action": rewrite_desc}, ["description"], additional_check=add_check
     )
     # rewriting attributes for agent
-    res = get_chain_response_json(
-        chain,
+    res = chain.invoke_json(
         {"action": rewrite_attr_second_person},
         ["description"],
         additional_check=add_check,
@@ -80,8 +92,7 @@ def get_agent_desc_rewrite(
         f"Rewrite '{rewrite_second_person}' in a third person point of view"
     )
     # rewriting description for agent in third person view
-    res_3rd = get_chain_response_json(
-        chain,
+    res_3rd = chain.invoke_json(
         {"action": rewrite_third_person_prompt},
         ["description"],
         additional_check=add_check,
@@ -93,6 +104,17 @@ def get_agent_desc_rewrite(
     }
 
 
+# description without the LLM for agents that are not worth the rewrite cost (eg. non representative agents in population mode)
+def get_agent_desc_template(
+    name: str, desc: str, attrs: list[AgentAttribute]
+) -> dict[str, str]:
+    traits = ", ".join([f"{attr.key} is {attr.value}" for attr in attrs])
+    return {
+        "description": f"You are in a simulation with other agents and you act as {name}, {desc} As a consumer, your {traits}.",
+        "description_3rd": f"{name} is in a simulation with other agents, {desc} As a consumer, their {traits}.",
+    }
+
+
 class AgentAction(BaseModel):
     action: str = Field("", description="the action to take")
     reason: str = Field("", description="the reason for the action taken")
@@ -112,6 +134,21 @@ class MessageResponse(BaseModel):
 
 
 class Agent:
+    # slots since large rosters have thousands of agents, anything else goes to the class (eg. the chain) or the db
+    __slots__ = (
+        "id",
+        "name",
+        "desc",
+        "attrs",
+        "simulation_id",
+        "cycle",
+        "memory",
+        "broadcasts",
+        "info_id",
+        "sim_desc",
+        "sim_desc_3rd",
+        "lineage",
+    )
     parser = JsonOutputParser(pydantic_object=AgentAction)
     # to keep consistency, let agent reply product_id:productname
     actions = {
@@ -141,9 +178,6 @@ class Agent:
         },
     )
 
-    # memory yinggai will be implemented with sliding window, meaning only newest nth cycle memory would be retained
-    memory: list[str] = []
-
     def __init__(
         self,
         id: int,
@@ -151,32 +185,60 @@ class Agent:
         desc: str,
         attrs: list[AgentAttribute],
         simulation_id: int,
-        model: str = "llama3.1",  # allow user change, but default to llama3.1
     ) -> None:
         # basic init the class
         self.id = id
         self.name = name
-        self.desc = desc
+        self.desc = sys.intern(desc)  # rosters are usually generated from a few descriptions
         self.attrs = attrs
         self.simulation_id = simulation_id
-        self.model = model
+        self.cycle = 0  # current cycle of the simulation, set by the simulation so memories know which cycle they belong to
+        # memory yinggai will be implemented with sliding window, meaning only newest nth cycle memory would be retained
+        # entries are (time_created, content) so they can be merged in order with the simulation's broadcast memory
+        self.memory: list[tuple[datetime, str]] = []  # per instance, a class level list would be shared by every agent
+        self.broadcasts: list[tuple[datetime, str]] = []  # shared with every agent of the simulation, set by the simulation
+        self.info_id: int = None  # id of the AgentInfo row, only the id is kept so the agent does not hold on to a model instance
+        self.sim_desc: str = None
+        self.sim_desc_3rd: str = None
+        # simulations whose memories are the agent's history (see db.get_lineage), shared with every agent and set by the simulation if it is a fork
+        self.lineage: list[tuple[int, int]] = [(simulation_id, None)]
 
     # actually initialising the agent, creating the llms etc
     # returns True if the agent is being initialized for the first time (no previous record of rewritten descriptions in the db), False otherwise, so Simulation can insert to the SimulationEvent regarding creation of agent
-    def init_agent(self) -> bool:
+    # rewrite False uses a template description instead of asking the LLM to rewrite it
+    def init_agent(self, rewrite: bool = True) -> bool:
         first_time = True
         # initialising agent for simulation
         # get combined description (can get from db if any for consistency, if ntg from db generate lo)
-        self.agent_model = AgentInfo.get_or_none(
-            AgentInfo.agent_id == self.id, AgentInfo.sim_id == self.simulation_id
-        )
-        if self.agent_model is None:
+        agent_model = AgentInfo.get_or_none((AgentInfo.agent_id == self.id) & (AgentInfo.sim_id == self.simulation_id))
+        if agent_model is None and len(self.lineage) > 1:
+            # a fork reuses the rewritten description of the simulation it was forked from, copied to an AgentInfo of its own
+            # so the fork's rows only reference rows in its own db (with sharding the ancestors' rows stay in their shards)
+            inherited = next(
+                iter_lineage(
+                    self.lineage[1:],
+                    lambda sim_id, _: AgentInfo.select().where((AgentInfo.agent_id == self.id) & (AgentInfo.sim_id == sim_id)).limit(1),
+                ),
+                None,
+            )
+            if inherited is not None:
+                agent_model = AgentInfo.create(
+                    agent_id=self.id,
+                    sim_id=self.simulation_id,
+                    rewritten_desc=inherited.rewritten_desc,
+                    rewritten_desc_third_person=inherited.rewritten_desc_third_person,
+                )
+        if agent_model is None:
             # obtain the rewritten description
-            desc = get_agent_desc_rewrite(self.name, self.desc, self.attrs)
+            desc = (
+                get_agent_desc_rewrite(self.name, self.desc, self.attrs)
+                if rewrite
+                else get_agent_desc_template(self.name, self.desc, self.attrs)
+            )
             self.sim_desc = desc["description"]
             self.sim_desc_3rd = desc["description_3rd"]
             # write rewritten description of the agent to the db
-            self.agent_model = AgentInfo.create(
+            agent_model = AgentInfo.create(
                 agent_id=self.id,
                 sim_id=self.simulation_id,
                 rewritten_desc=self.sim_desc,
@@ -184,25 +246,30 @@ class Agent:
             )
         else:
             # already has record in db
-            self.sim_desc = self.agent_model.rewritten_desc
-            self.sim_desc_3rd = self.agent_model.rewritten_desc_third_person
+            self.sim_desc = agent_model.rewritten_desc
+            self.sim_desc_3rd = agent_model.rewritten_desc_third_person
             first_time = False
-        # find if the agent has memory stored in db
-        memory_query = (
-            AgentMemory.select(AgentMemory)
+        self.info_id = agent_model.id
+        self.load_memory()
+        return first_time
+
+    # (re)loads the memory window from db, eg. when the agent is initialised or after an interrupted turn is undone
+    # the agent's memories in each simulation of the lineage are matched by its agent id, a fork's are written with the fork's own AgentInfo
+    def load_memory(self):
+        memories = iter_lineage(
+            self.lineage,
+            lambda sim_id, until_cycle: AgentMemory.select(AgentMemory)
             .join(AgentInfo)
-            .where(AgentMemory.agent == self.agent_model)
-            .order_by(AgentMemory.time_created)
-        )
-        for mem in memory_query:
-            self.add_to_memory(mem.content, save_to_db=False) # alrd in db d the memory
-        llm = Ollama(
-            model=self.model,
-            stop=["<|eot_id|>"],  # might need to change this when switch model
-            format="json",
+            .where(
+                (AgentInfo.agent_id == self.id)
+                & in_lineage([(sim_id, until_cycle)], AgentMemory.sim_id, AgentMemory.cycle)
+            )
+            .order_by(AgentMemory.time_created.desc())
+            .limit(MEMORY_WINDOW),
         )
-        self.chain = self.prompt | llm | self.parser
-        return first_time
+        self.memory = []
+        for mem in sorted(memories, key=lambda m: m.time_created)[-MEMORY_WINDOW:]:
+            self.add_to_memory(mem.content, save_to_db=False, time_created=mem.time_created) # alrd in db d the memory
 
     # calls the agent to take action for the cycle
     def get_action(
@@ -210,7 +277,7 @@ class Agent:
         env_desc: str,
         message: str,
         products: list[Product],
-        agents: list[Self],
+        agents: str,  # agents it can message, rendered with render_agents (the simulation reuses it across calls)
         actions: dict[str, str] = None,
         should_add_memory: bool = False,
     ):
@@ -228,20 +295,20 @@ class Agent:
                     return False
             # noneed care about case (LLM output is very hard to control), for MESSAGE, there is no need for a reason
             return res["action"].upper() in actions and (res["action"] == "MESSAGE" or res["reason"] != "")
-        action = get_chain_response_json(
-            self.chain,
+        action = self.chain.invoke_json(
             {
                 "system_prompt": f"{env_desc}\n{self.sim_desc}",
-                "memory": "\n".join(self.memory) 
+                "memory": self.render_memory()
                 + (
                     f"\n{message}" if not should_add_memory else ""
                 ),  # if no add to memory, just append as part of the prompt
-                "agents": f"[{','.join([agent.to_prompt_str() for agent in agents if int(agent.id) != int(self.id)])}]",
+                "agents": agents,
                 "products": f"[{';'.join([product.to_prompt_str() for product in products])}]",
                 "actions": f"[{';'.join([f'{k}:{v}' for k, v in (actions.items())])}]",
             },
             expected_fields=[k for k in (AgentAction.model_json_schema()["properties"])],
             additional_check=action_check,
+            affinity_key=self.affinity_key(),
         )
         return action
 
@@ -252,11 +319,6 @@ class Agent:
     ):
         self.add_to_memory(message)
         # create a specialised chain only for responding back to the message
-        llm = Ollama(
-            model=self.model,
-            stop=["<|eot_id|>"],  # might need to change this when switch model
-            format="json",
-        )
         parser = JsonOutputParser(pydantic_object=MessageResponse)
         prompt = PromptTemplate(
             template="""
@@ -274,24 +336,68 @@ class Agent:
                 ),
             },
         )
-        chain = prompt | llm | parser
-        return get_chain_response_json(
-            chain,
+        chain = RoutedChain(
+            "talk_response",
+            lambda llm: prompt | llm | parser,
+            stop=["<|eot_id|>"],  # might need to change this when switch model
+            format="json",
+        )
+        return chain.invoke_json(
             {
                 "system_prompt": f"{env_desc}\n{self.sim_desc}",
-                "memory": "\n".join(self.memory),
+                "memory": self.render_memory(),
             },
             expected_fields=["message"],
+            affinity_key=self.affinity_key(),
         )
 
+    # prompts of the agent start with its system prompt and memory, keeping them on one model server lets it reuse the cached prefix
+    # keyed by the first simulation of the lineage, so the agent in every fork (eg. the variants of a sweep) shares the server and the prefix up to the fork
+    def affinity_key(self) -> str:
+        return f"{self.lineage[-1][0]}:{self.id}"
+
     # add to agent's memory
-    def add_to_memory(self, mem: str, save_to_db: bool = True):
-        self.memory.append(mem)
-        self.memory = self.memory[-30:] # sliding window (context too less, so only take last 30 otherwise system prompt might get overwritten)
+    def add_to_memory(self, mem: str, save_to_db: bool = True, time_created: datetime = None):
+        time_created = time_created if time_created is not None else datetime.now()
+        self.memory.append((time_created, mem))
+        del self.memory[:-MEMORY_WINDOW] # sliding window (context too less, so only take last 30 otherwise system prompt might get overwritten)
         # write to db as well (if is not called when init agent)
         if save_to_db:
-            AgentMemory.create(agent=self.agent_model, content=mem)
+            AgentMemory.create(
+                agent=self.info_id, sim_id=self.simulation_id, content=mem, cycle=self.cycle, time_created=time_created
+            )
+
+    # personal and broadcast memory merged in the order they happened, only the newest ones within the window
+    def render_memory(self) -> str:
+        merged = list(
+            heapq.merge(
+                self.memory[-MEMORY_WINDOW:],
+                self.broadcasts[-MEMORY_WINDOW:],
+                key=lambda entry: entry[0],
+            )
+        )
+        return "\n".join([content for _, content in merged[-MEMORY_WINDOW:]])
 
     # if using model that are more powerful maybe can include short description of the agent for more context
     def to_prompt_str(self):
         return f"(agent_id:{self.id})"
+
+    # the agents this agent can message as put in its prompt
+    def render_agents(self, agents: list[Self]) -> str:
+        return f"[{','.join([agent.to_prompt_str() for agent in agents if int(agent.id) != int(self.id)])}]"
+
+
+# prompt and parser are the same for every agent so all agents share a single chain (model is decided by the routing config in llm.py)
+Agent.chain = RoutedChain(
+    "agent_action",
+    lambda llm: Agent.prompt | llm | Agent.parser,
+    stop=["<|eot_id|>"],  # might need to change this when switch model
+    format="json",
+)
+
+
+# start of the action prompt of every agent in a simulation (template and environment description), for model servers to cache before the first turn
+def get_shared_prompt_prefix(env_desc: str) -> str:
+    marker = "\x00"  # cut where the agent's own description starts
+    prompt = Agent.prompt.format(system_prompt=f"{env_desc}\n{marker}", memory="", agents="", products="", actions="")
+    return prompt.split(marker)[0]
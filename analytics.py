@@ -0,0 +1,225 @@
+# running aggregates of the simulations, updated as events are produced so results can be answered in O(products) instead of going through every event
+import threading
+
+from db import ProductInfo, SimulationChange, SimulationEvent, get_lineage, in_lineage, use_simulation_db
+from live_update import load_live_update
+from product import Product
+
+
+class ProductAggregates:
+    def __init__(self) -> None:
+        self.purchases = 0
+        self.revenue = 0.0
+        self.cost = 0.0
+
+    def margin(self) -> float:
+        return self.revenue - self.cost
+
+
+class CycleAggregates:
+    def __init__(self) -> None:
+        self.products: dict[int, ProductAggregates] = {}  # product id -> aggregates
+        self.skips = 0
+        self.messages = 0
+
+    def add_purchase(self, product_id: int, price: float, cost: float):
+        aggregates = self.products.setdefault(product_id, ProductAggregates())
+        aggregates.purchases += 1
+        aggregates.revenue += price
+        aggregates.cost += cost
+
+    def merge(self, other: "CycleAggregates"):
+        for product_id, p in other.products.items():
+            aggregates = self.products.setdefault(product_id, ProductAggregates())
+            aggregates.purchases += p.purchases
+            aggregates.revenue += p.revenue
+            aggregates.cost += p.cost
+        self.skips += other.skips
+        self.messages += other.messages
+
+    def copy(self) -> "CycleAggregates":
+        aggregates = CycleAggregates()
+        aggregates.merge(self)
+        return aggregates
+
+    def purchases(self) -> int:
+        return sum([p.purchases for p in self.products.values()])
+
+    def decisions(self) -> int:
+        return self.purchases() + self.skips
+
+    def skip_rate(self) -> float:
+        return self.skips / self.decisions() if self.decisions() > 0 else 0.0
+
+    def revenue(self) -> float:
+        return sum([p.revenue for p in self.products.values()])
+
+    def margin(self) -> float:
+        return sum([p.margin() for p in self.products.values()])
+
+
+class SimulationAnalytics:
+    def __init__(self, sim_id: int, products: list[Product]) -> None:
+        self.sim_id = sim_id
+        self.lock = threading.Lock()  # recorded from the simulation's stream, read from other rpc threads
+        self.set_products(products)
+        self.base_prices = dict(self.prices)  # before any live update, a rebuild replays the updates from these
+        self.reset()
+
+    def reset(self):
+        self.total = CycleAggregates()
+        self.cycles: dict[int, CycleAggregates] = {}
+        self.latest_cycle = 0
+
+    # purchases are valued at the price and cost of the product at the time they are recorded
+    def set_products(self, products: list[Product]):
+        self.prices = to_prices(products)
+
+    # a live update changed the prices, removed products keep theirs for the purchases alrd made
+    def update_prices(self, products: list[Product]):
+        with self.lock:
+            self.prices = {**self.prices, **to_prices(products)}
+
+    # prices are the ones of the simulation the event belongs to when rebuilding, the current ones otherwise
+    def record(self, event: SimulationEvent, prices: dict[int, tuple[float, float]] = None):
+        with self.lock:
+            prices = prices if prices is not None else self.prices
+            self.latest_cycle = max(self.latest_cycle, event.cycle)
+            match event.type:
+                case "BUY":
+                    product_id = int(event.content.split(":", 1)[0])
+                    price, cost = prices.get(product_id, (0.0, 0.0))
+                    for aggregates in [self.total, self.get_cycle(event.cycle)]:
+                        aggregates.add_purchase(product_id, price, cost)
+                case "SKIP":
+                    for aggregates in [self.total, self.get_cycle(event.cycle)]:
+                        aggregates.skips += 1
+                case "MESSAGE":
+                    for aggregates in [self.total, self.get_cycle(event.cycle)]:
+                        aggregates.messages += 1
+
+    def get_cycle(self, cycle: int) -> CycleAggregates:
+        return self.cycles.setdefault(cycle, CycleAggregates())
+
+    # rebuilds the aggregates from the event table (eg. after a restart), the only time the events are gone through
+    # a fork counts the cycles it shares with its parent from the parent's events, priced at the parent's prices (a fork with cheaper products
+    # is only cheaper from its fork cycle)
+    def rebuild(self):
+        with self.lock:
+            self.reset()
+        for sim_id, until_cycle in get_lineage(self.sim_id):
+            with use_simulation_db(sim_id, create=False):  # with sharding the parent's events and products are in its own shard
+                if sim_id == self.sim_id:
+                    self.prices = self.replay(sim_id, until_cycle, self.base_prices)
+                else:
+                    self.replay(sim_id, until_cycle, to_prices(load_simulation_products(sim_id)))
+
+    # counts the events of one simulation of the lineage (the cycles before until_cycle if set) starting from its request's prices
+    # its live updates are replayed at the cycle they took effect, so purchases are valued at the prices of their cycle
+    # returns the prices after its last update
+    def replay(self, sim_id: int, until_cycle: int, prices: dict[int, tuple[float, float]]) -> dict[int, tuple[float, float]]:
+        prices = dict(prices)
+        updates = list(
+            SimulationChange.select(SimulationChange.cycle, SimulationChange.content)
+            .where(in_lineage([(sim_id, until_cycle)], SimulationChange.sim_id, SimulationChange.cycle))
+            .order_by(SimulationChange.cycle, SimulationChange.id)
+        )
+        query = (
+            SimulationEvent.select(
+                SimulationEvent.type, SimulationEvent.content, SimulationEvent.cycle
+            )
+            .where(
+                in_lineage([(sim_id, until_cycle)], SimulationEvent.sim_id, SimulationEvent.cycle)
+                & (SimulationEvent.type.in_(["BUY", "SKIP", "MESSAGE"]))
+            )
+            .order_by(SimulationEvent.id)
+        )
+        for event in query.iterator():  # iterator so the rows are not cached in memory
+            while len(updates) > 0 and updates[0].cycle <= event.cycle:
+                prices.update(to_prices(load_live_update("", updates.pop(0).content, sim_id).products))
+            self.record(event, prices)
+        for update in updates:
+            prices.update(to_prices(load_live_update("", update.content, sim_id).products))
+        return prices
+
+    # cycle 0 means the totals of every cycle, a copy so it can be read while the simulation keeps recording
+    def get(self, cycle: int) -> CycleAggregates:
+        with self.lock:
+            if cycle == 0:
+                return self.total.copy()
+            return self.cycles.get(cycle, CycleAggregates()).copy()
+
+    # totals of the cycles up to and including cycle, eg. to compare simulations that are at different cycles
+    def get_until(self, cycle: int) -> CycleAggregates:
+        total = CycleAggregates()
+        with self.lock:
+            for c, aggregates in self.cycles.items():
+                if c <= cycle:
+                    total.merge(aggregates)
+        return total
+
+
+# sim id -> analytics, kept after the simulation completes so results stay available
+simulation_analytics: dict[int, SimulationAnalytics] = {}
+simulation_analytics_lock = threading.Lock()
+
+
+def register_simulation_analytics(analytics: SimulationAnalytics):
+    with simulation_analytics_lock:
+        simulation_analytics[analytics.sim_id] = analytics
+
+
+def unregister_simulation_analytics(sim_id: int):
+    with simulation_analytics_lock:
+        simulation_analytics.pop(sim_id, None)
+
+
+def to_prices(products: list[Product]) -> dict[int, tuple[float, float]]:
+    return {int(p.id): (float(p.price), float(p.cost)) for p in products}
+
+
+def save_simulation_products(sim_id: int, products: list[Product]):
+    ProductInfo.delete().where(ProductInfo.sim_id == sim_id).execute()
+    if len(products) == 0:
+        return
+    ProductInfo.insert_many(
+        [
+            {
+                "product_id": p.id,
+                "sim_id": sim_id,
+                "name": p.name,
+                "desc": p.desc,
+                "price": p.price,
+                "cost": p.cost,
+            }
+            for p in products
+        ]
+    ).execute()
+
+
+def load_simulation_products(sim_id: int) -> list[Product]:
+    return [
+        Product(
+            id=info.product_id,
+            name=info.name,
+            desc=info.desc,
+            price=info.price,
+            cost=info.cost,
+            simulation_id=sim_id,
+        )
+        for info in ProductInfo.select().where(ProductInfo.sim_id == sim_id)
+    ]
+
+
+# returns the analytics of the simulation, rebuilding it from the db if it is not in memory (eg. after a restart), None if the simulation is unknown
+def get_simulation_analytics(sim_id: int) -> SimulationAnalytics:
+    with simulation_analytics_lock:
+        if sim_id in simulation_analytics:
+            return simulation_analytics[sim_id]
+    products = load_simulation_products(sim_id)
+    if len(products) == 0:
+        return None
+    analytics = SimulationAnalytics(sim_id, products)
+    analytics.rebuild()
+    register_simulation_analytics(analytics)
+    return analytics
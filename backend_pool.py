@@ -0,0 +1,151 @@
+# pool of model servers (ollama endpoints) the LLM calls are spread over, so model serving can scale horizontally behind the core
+# every call goes to the least loaded healthy server (in flight calls and recent latency), failing servers are ejected until their health check passes again
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+DEFAULT_ENDPOINT = "http://localhost:11434"  # same as the default of langchain's ollama
+DEFAULT_HEALTH_INTERVAL = 10
+DEFAULT_HEALTH_TIMEOUT = 2
+LATENCY_SMOOTHING = 0.2  # weight of the latest call in the moving average of latency
+AFFINITY_SLACK = 2  # extra in flight calls an agent's server can have over the least loaded one before the agent is moved
+DEFAULT_MAX_AFFINITY_KEYS = 100000  # agents remembered, the least recently called ones are forgotten first (their next call goes to the least loaded server)
+
+
+class Backend:
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self.in_flight = 0
+        self.latency: float = None  # moving average of seconds per call, None until the first call returns
+        self.healthy = True
+        self.calls = 0
+        self.failures = 0
+
+    # expected wait of one more call on this server
+    def load(self, default_latency: float) -> float:
+        latency = self.latency if self.latency is not None else default_latency
+        return (self.in_flight + 1) * latency
+
+    def string(self) -> str:
+        latency = f"{self.latency:.2f}s" if self.latency is not None else "-"
+        return f"{self.url}({'up' if self.healthy else 'down'}): calls={self.calls},failures={self.failures},in_flight={self.in_flight},latency={latency}"
+
+
+class BackendPool:
+    def __init__(
+        self,
+        urls: list[str],
+        health_interval: float = DEFAULT_HEALTH_INTERVAL,
+        health_timeout: float = DEFAULT_HEALTH_TIMEOUT,
+        max_affinity_keys: int = DEFAULT_MAX_AFFINITY_KEYS,
+    ) -> None:
+        self.backends = [Backend(url) for url in urls]
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        # affinity key (eg. an agent) -> server its prompts were last sent to, least recently called first
+        # bounded since every agent of every simulation adds a key and nothing else removes them
+        self.affinity: OrderedDict[str, Backend] = OrderedDict()
+        self.max_affinity_keys = max_affinity_keys
+        self.lock = threading.Lock()  # calls of every simulation and rpc go through the one pool
+        self.health_thread: threading.Thread = None
+
+    # servers reuse the cached prompt prefix of the agent (system prompt and memory) if its calls keep going to the same server
+    # so the agent stays on its server unless that server is down or much busier than the least loaded one
+    def acquire(self, affinity_key: str = None, exclude: list[Backend] = None) -> Backend:
+        exclude = exclude or []
+        with self.lock:
+            candidates = [b for b in self.backends if b.healthy and b not in exclude]
+            if len(candidates) == 0:
+                # nothing is known to be up, still better to try than to fail the call
+                candidates = [b for b in self.backends if b not in exclude] or self.backends
+            known = [b.latency for b in self.backends if b.latency is not None]
+            default_latency = min(known) if len(known) > 0 else 1.0  # new servers get tried early
+            backend = min(candidates, key=lambda b: b.load(default_latency))
+            if affinity_key is not None:
+                sticky = self.affinity.get(affinity_key)
+                if sticky in candidates and sticky.in_flight <= backend.in_flight + AFFINITY_SLACK:
+                    backend = sticky
+                self.affinity[affinity_key] = backend
+                self.affinity.move_to_end(affinity_key)
+                if len(self.affinity) > self.max_affinity_keys:
+                    self.affinity.popitem(last=False)
+            backend.in_flight += 1
+            backend.calls += 1
+            return backend
+
+    def release(self, backend: Backend, elapsed: float, ok: bool = True):
+        with self.lock:
+            backend.in_flight -= 1
+            if not ok:
+                return
+            if backend.latency is None:
+                backend.latency = elapsed
+            else:
+                backend.latency += LATENCY_SMOOTHING * (elapsed - backend.latency)
+
+    # the server could not be reached, no more calls go to it until its health check passes
+    def eject(self, backend: Backend):
+        with self.lock:
+            backend.failures += 1
+            if backend.healthy:
+                print(f"LLM backend {backend.url} failed, ejecting it")
+            backend.healthy = False
+
+    def check_health(self, backend: Backend) -> bool:
+        try:
+            return requests.get(f"{backend.url}/api/tags", timeout=self.health_timeout).status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
+    def check_all(self):
+        for backend in self.backends:
+            healthy = self.check_health(backend)
+            with self.lock:
+                if healthy != backend.healthy:
+                    print(f"LLM backend {backend.url} is {'back up' if healthy else 'down'}")
+                if not healthy:
+                    backend.failures += 1
+                backend.healthy = healthy
+
+    def start_health_checks(self):
+        if self.health_interval <= 0 or self.health_thread is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(self.health_interval)
+                self.check_all()
+
+        self.health_thread = threading.Thread(target=run, name="llm-health", daemon=True)
+        self.health_thread.start()
+
+    def string(self) -> str:
+        with self.lock:
+            return "; ".join([b.string() for b in self.backends])
+
+
+backend_pool: BackendPool = None
+backend_pool_lock = threading.Lock()
+
+
+# built on first use since dotenv is only loaded in main after the modules are imported
+def get_backend_pool() -> BackendPool:
+    global backend_pool
+    with backend_pool_lock:
+        if backend_pool is None:
+            urls = [url.strip().rstrip("/") for url in (os.getenv("LLM_ENDPOINTS") or "").split(",") if url.strip() != ""]
+            backend_pool = BackendPool(
+                urls or [DEFAULT_ENDPOINT],
+                health_interval=float(os.getenv("LLM_HEALTH_INTERVAL") or DEFAULT_HEALTH_INTERVAL),
+                health_timeout=float(os.getenv("LLM_HEALTH_TIMEOUT") or DEFAULT_HEALTH_TIMEOUT),
+            )
+            if len(backend_pool.backends) > 1:
+                backend_pool.start_health_checks()  # nothing to route around with a single server
+        return backend_pool
+
+
+def format_backend_stats() -> str:
+    return get_backend_pool().string()
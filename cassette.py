@@ -0,0 +1,192 @@
+# record and replay of everything a run gets from outside (LLM responses, random draws, web searches), so a simulation or research run can be rerun without a model server
+# LLM_CASSETTE=record writes the calls of every simulation (and research) to its own cassette in CASSETTE_DIR, LLM_CASSETTE=replay answers the calls from it
+# a replay gives the same events as the recorded run, so the non LLM parts (simulation, agents, db, grpc stream) can be profiled and regression tested on real traces
+# the calls are replayed in the recorded order, replays have to start from an empty db otherwise the initialisation is skipped and the calls no longer line up
+import gzip
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable
+
+from utils import CancelledException, CassetteDivergenceException
+
+
+def get_cassette_mode() -> str:
+    return os.getenv("LLM_CASSETTE") or ""  # "record", "replay" or "" when off
+
+
+def get_cassette_dir() -> str:
+    return os.getenv("CASSETTE_DIR") or "cassettes"
+
+
+# inputs are only kept as a hash to keep cassettes small, enough to tell that a call got a different input than recorded
+def hash_key(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+class Cassette:
+    def __init__(self, name: str, mode: str) -> None:
+        self.name = name
+        self.mode = mode
+        self.path = os.path.join(get_cassette_dir(), f"{name}.jsonl.gz")
+        self.lock = threading.Lock()
+        self.entries: list[dict[str, Any]] = []  # only loaded when replaying
+        self.position = 0  # calls recorded or replayed so far
+        self.divergences = 0  # replayed calls whose input was different from the recorded one
+        self.file = None
+        self.unit: list[dict[str, Any]] = None  # entries of the unit in progress (see cassette_unit), written once it is done (None outside a unit)
+        self.unit_start = 0  # position when the unit started
+        self.unit_tokens = 0  # tokens the simulation used when the unit started
+        if mode == "replay":
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                self.entries = [json.loads(line) for line in f]
+
+    def record(self, entry: dict[str, Any]):
+        with self.lock:
+            self.position += 1
+            if self.unit is not None:
+                self.unit.append(entry)
+                return
+            self.write([entry])
+
+    def write(self, entries: list[dict[str, Any]]):
+        if self.file is None:
+            os.makedirs(get_cassette_dir(), exist_ok=True)
+            self.file = gzip.open(self.path, "wt", encoding="utf-8")  # a recording is of one run, an older one is overwritten
+        for entry in entries:
+            self.file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        self.file.flush()  # the calls so far are kept even if the server dies
+
+    # meter is the simulation's llm.TokenMeter, the tokens of a cancelled unit were spent so the replay counts them too
+    def begin_unit(self, meter=None):
+        with self.lock:
+            if self.mode == "replay":
+                while self.position < len(self.entries) and self.entries[self.position]["kind"] == "discarded":
+                    if meter is not None:
+                        meter.add(self.entries[self.position]["tokens"])
+                    self.position += 1
+            self.unit = []
+            self.unit_start = self.position
+            self.unit_tokens = meter.total if meter is not None else 0
+
+    def commit_unit(self):
+        with self.lock:
+            entries, self.unit = self.unit, None
+            if entries:
+                self.write(entries)
+
+    # the unit is undone and run again later, its calls are dropped from the recording (or read again when replaying)
+    # only the tokens they used are recorded, read by begin_unit when the replay runs the unit
+    def discard_unit(self, meter=None):
+        with self.lock:
+            self.unit = None
+            self.position = self.unit_start
+            tokens = meter.total - self.unit_tokens if meter is not None else 0
+            if self.mode == "record" and tokens > 0:
+                self.write([{"kind": "discarded", "site": "", "tokens": tokens}])
+                self.position += 1
+            elif meter is not None:
+                meter.add(-tokens)  # the recorded run was not cancelled here, its calls are replayed again
+
+    # next recorded entry, it has to be the same kind of call from the same site (nothing sensible to answer otherwise)
+    # a different input is reported and answered with the recorded output anyways
+    def replay(self, kind: str, site: str, key: str) -> dict[str, Any]:
+        with self.lock:
+            if self.position >= len(self.entries):
+                raise CassetteDivergenceException(
+                    f"cassette {self.name} call {self.position} ({kind} {site}) is past the end of the recording"
+                )
+            entry = self.entries[self.position]
+            if entry["kind"] != kind or entry["site"] != site:
+                raise CassetteDivergenceException(
+                    f"cassette {self.name} call {self.position} is {kind} {site} but {entry['kind']} {entry['site']} was recorded"
+                )
+            if entry.get("key") != key:
+                self.divergences += 1
+                print(f"Cassette {self.name} call {self.position} ({kind} {site}) got a different input than recorded, replaying the recorded output")
+            self.position += 1
+            return entry
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if self.mode == "record":
+                print(f"Cassette {self.name} recorded {self.position} calls to {self.path}")
+            else:
+                print(
+                    f"Cassette {self.name} replayed {self.position}/{len(self.entries)} calls, {self.divergences} with a different input"
+                )
+
+
+# name -> opened cassette
+cassettes: dict[str, Cassette] = {}
+cassettes_lock = threading.Lock()
+
+
+# None when cassettes are off
+def get_cassette(name: str) -> Cassette:
+    mode = get_cassette_mode()
+    if mode not in ["record", "replay"]:
+        return None
+    with cassettes_lock:
+        if name not in cassettes:
+            cassettes[name] = Cassette(name, mode)
+        return cassettes[name]
+
+
+def close_cassette(name: str):
+    with cassettes_lock:
+        cassette = cassettes.pop(name, None)
+    if cassette is not None:
+        cassette.close()
+
+
+# the cassette the calls made in this context go through, the calls of a simulation are sequential so each simulation gets its own
+current_cassette: ContextVar[Cassette] = ContextVar("current_cassette", default=None)
+
+
+@contextmanager
+def use_cassette(name: str):
+    token = current_cassette.set(get_cassette(name))
+    try:
+        yield
+    finally:
+        current_cassette.reset(token)
+
+
+# calls of a unit of work that is undone and run again from its start when cancelled (an agent turn, an agent's initialisation, a feedback batch)
+# are only recorded once the unit is done, a cancelled unit's calls are dropped otherwise the recording has calls no replay makes and the replay diverges
+# a unit that timed out is kept, the replay has to time out at the same call
+@contextmanager
+def cassette_unit(meter=None):
+    cassette = current_cassette.get()
+    if cassette is None:
+        yield
+        return
+    cassette.begin_unit(meter)
+    try:
+        yield
+    except CancelledException:
+        cassette.discard_unit(meter)
+        raise
+    except BaseException:
+        cassette.commit_unit()
+        raise
+    cassette.commit_unit()
+
+
+# runs call and records its result, or returns the recorded result when replaying (results have to be json serializable)
+def recorded(kind: str, site: str, key: str, call: Callable[[], Any]) -> Any:
+    cassette = current_cassette.get()
+    if cassette is None:
+        return call()
+    if cassette.mode == "replay":
+        return cassette.replay(kind, site, key)["output"]
+    output = call()
+    cassette.record({"kind": kind, "site": site, "key": key, "output": output})
+    return output
@@ -0,0 +1,88 @@
+# shortlists the products an agent sees in its prompt when the catalog is large, instead of listing every product in every prompt
+# products are indexed once per simulation as tf-idf weighted hashed bag of words (name, description and price band), each agent gets the products
+# closest to its description and recent memory, plus a few exploration slots rotating through the rest so every product still gets seen
+import re
+import zlib
+
+import numpy as np
+
+from agent import Agent
+from product import Product
+
+BUCKETS = 1024  # hashed bag of words size
+NAME_WEIGHT = 2  # name words count as this many description words
+MEMORY_ITEMS = 10  # latest memories used for the agent's query, older ones are less telling of what it wants now
+# words of the price band of a product relative to the rest of the catalog, so descriptions like "on a tight budget" match the cheap products
+PRICE_BAND_WORDS = [
+    "cheap budget affordable low price value",
+    "mid range moderate price",
+    "premium expensive luxury high end quality",
+]
+
+
+def tokenize(text: str) -> list[str]:
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+# crc32 so buckets are stable across restarts unlike hash()
+def bucket_counts(text: str, weight: float = 1.0) -> dict[int, float]:
+    counts: dict[int, float] = {}
+    for word in tokenize(text):
+        b = zlib.crc32(word.encode()) % BUCKETS
+        counts[b] = counts.get(b, 0.0) + weight
+    return counts
+
+
+class CatalogIndex:
+    def __init__(self, products: list[Product], shortlist_size: int = 20, exploration_slots: int = 2) -> None:
+        self.shortlist_size = shortlist_size
+        self.exploration_slots = exploration_slots
+        self.set_products(products)
+
+    def set_products(self, products: list[Product]):
+        self.products = products
+        if not self.is_enabled():
+            return
+        prices = np.array([float(p.price) for p in products])
+        band_edges = np.quantile(prices, [1 / 3, 2 / 3])
+        counts = np.zeros((len(products), BUCKETS))
+        for i, p in enumerate(products):
+            band = int(np.searchsorted(band_edges, float(p.price), side="right"))
+            for text, weight in [(p.name, NAME_WEIGHT), (p.desc, 1.0), (PRICE_BAND_WORDS[band], 1.0)]:
+                for b, c in bucket_counts(text, weight).items():
+                    counts[i, b] += c
+        df = (counts > 0).sum(0)
+        self.idf = np.log((1 + len(products)) / (1 + df)) + 1.0  # smoothed, words in every product still count a little
+        self.vectors = normalize_rows(counts * self.idf)
+
+    # small catalogs are listed whole like before
+    def is_enabled(self) -> bool:
+        return self.shortlist_size > 0 and len(self.products) > self.shortlist_size + self.exploration_slots
+
+    # products to put in the agent's prompt this cycle, the full catalog when shortlisting is off
+    # deterministic for an agent, cycle and memory so an interrupted turn is replayed with the same prompt
+    def shortlist(self, agent: Agent, cycle: int) -> list[Product]:
+        if not self.is_enabled():
+            return self.products
+        query = np.zeros(BUCKETS)
+        texts = [agent.sim_desc or agent.desc] + [content for _, content in agent.memory[-MEMORY_ITEMS:]]
+        for text in texts:
+            for b, c in bucket_counts(text).items():
+                query[b] += c
+        scores = self.vectors @ (query * self.idf)
+        # stable sort so ties keep the catalog order
+        ranked = np.argsort(-scores, kind="stable")
+        picked = ranked[: self.shortlist_size]
+        rest = ranked[self.shortlist_size :]
+        # exploration slots walk through the rest of the catalog a few products per cycle, agents start at different offsets
+        if self.exploration_slots > 0 and len(rest) > 0:
+            rest = np.sort(rest)
+            start = (cycle * self.exploration_slots + int(agent.id) * 7919) % len(rest)  # 7919 spreads neighbouring agent ids apart
+            explore = [rest[(start + i) % len(rest)] for i in range(min(self.exploration_slots, len(rest)))]
+            picked = np.concatenate([picked, explore])
+        return [self.products[i] for i in sorted(picked)]  # catalog order, the prompt does not hint at the ranking
+
+
+def normalize_rows(x: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / np.where(norms == 0, 1.0, norms)
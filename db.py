@@ -1,11 +1,37 @@
 # responsible to handle all memory and simulation related stuff that requires persistence across restarts
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime
 import os
+import shutil
+import threading
+from typing import Any, Callable, Generator, Iterable, NamedTuple
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
 
-db = SqliteDatabase(
+from utils import MissingShardException
+
+catalog_db = SqliteDatabase(
     os.getenv("DB_FILE") if os.getenv("DB_FILE") is not None else "marcom_simcore.db"
-)  # default to marcom_simcore.db
+)  # default to marcom_simcore.db, when sharding is enabled only holds the catalog of shards
+
+# database of the simulation currently being worked on in this context, None means the catalog db (also when sharding is off)
+current_shard: ContextVar[SqliteDatabase] = ContextVar("current_shard", default=None)
+
+
+# routes every query of the simulation tables to the shard of the current simulation, so simulations do not share a single writer lock
+class ShardRouter(DatabaseProxy):
+    @property
+    def obj(self):
+        shard = current_shard.get()
+        return shard if shard is not None else catalog_db
+
+    @obj.setter
+    def obj(self, value):
+        pass  # always routed, nothing to initialize
+
+
+db = ShardRouter()
 
 # stores simulation related agent info specific to the simulation (that web server does not store) like rewritten description
 class AgentInfo(Model):
@@ -22,18 +48,352 @@ class AgentInfo(Model):
 # stores agent memory for that specific agent in that specific simulation
 class AgentMemory(Model):
     agent = ForeignKeyField(AgentInfo, backref="memory")
+    sim_id = IntegerField(null=True, index=True) # simulation that wrote the memory, forks made before they had their own AgentInfo share their parent's so it is not always the AgentInfo's simulation
     content = TextField() # storing in plain text for now for simplicity (means when simulating have to make responses into texts and store'em in)
+    cycle = IntegerField(default=0) # which cycle the memory is created in, 0 for init (and memories created before this column existed)
     time_created = DateTimeField(default=datetime.now) # better than just storing a counter and incrementing them to preserve order
     class Meta:
         database = db
 
+# simulation wide memory (eg. cycle start) stored once and merged into every agent's timeline instead of copied to every agent
+class BroadcastMemory(Model):
+    sim_id = IntegerField(index=True)
+    content = TextField()
+    cycle = IntegerField(default=0)
+    time_created = DateTimeField(default=datetime.now) # ordered together with AgentMemory of the agents
+    class Meta:
+        database = db
+
 # store a copy of the events of the simulation here (also will be forwarded back to web server)
 class SimulationEvent(Model):
     agent = ForeignKeyField(AgentInfo, backref="events", null=True) # agents only exist if event type is of ACTION event (eg., BUY/SKIP/MESSAGE, ACTION_RESP)
-    sim_id = IntegerField()
-    type = TextField() # (BUY/SKIP/MESSAGE): agent takes action, SIMULATION: high level simulation related events, like initializing agent, ACTION_RESP: response to BUY actions of an agent
+    sim_id = IntegerField(index=True) # most queries are per simulation
+    type = TextField() # (BUY/SKIP/MESSAGE): agent takes action, SIMULATION: high level simulation related events, like initializing agent, ACTION_RESP: response to BUY actions of an agent, BUDGET: JSON of the tokens used at the end of every cycle, TIMEOUT: an agent or the cycle's feedbacks ran out of time (agent set if it's an agent)
     content = TextField() # additional information about the event (where the actual message resides) for BUY format is PRODUCT_ID:REASON, for MESSAGE format is AGENT_ID:CONTENT
     cycle = IntegerField() # which cycle does this happen, if is initialisation, then is 0
     time_created = DateTimeField(default=datetime.now) # better than just storing a counter and incrementing them to preserve order
+    decided_by = TextField(null=True) # who made a BUY/SKIP decision: llm, surrogate, follower (population mode) or fallback (timed out), null for other events and for decisions from before this column existed
+    class Meta:
+        database = db
+
+
+# a simulation branched off another one at a cycle, the history of the parent before that cycle is read from the parent's rows instead of being copied
+class SimulationFork(Model):
+    sim_id = IntegerField(unique=True)
+    parent_id = IntegerField()
+    fork_cycle = IntegerField() # first cycle the fork runs on its own, the parent's cycles before it are shared
+    time_created = DateTimeField(default=datetime.now)
     class Meta:
         database = db
+
+
+# simulations whose rows make up the history of a simulation: (sim id, cycle the rows stop at or None for all of them)
+# the simulation itself, then its parent before the fork cycle, then the parent's parent and so on
+# each fork is looked up in the db of its simulation, with sharding the chain goes across shards
+def get_lineage(sim_id: int) -> list[tuple[int, int]]:
+    lineage = [(sim_id, None)]
+    until_cycle = None
+    with use_simulation_db(sim_id, create=False):
+        fork = SimulationFork.get_or_none(SimulationFork.sim_id == sim_id)
+    while fork is not None:
+        until_cycle = fork.fork_cycle if until_cycle is None else min(until_cycle, fork.fork_cycle)
+        lineage.append((fork.parent_id, until_cycle))
+        with use_simulation_db(fork.parent_id, create=False):
+            fork = SimulationFork.get_or_none(SimulationFork.sim_id == fork.parent_id)
+    return lineage
+
+
+# condition matching the rows of the lineage, for tables with a sim id and a cycle
+def in_lineage(lineage: list[tuple[int, int]], sim_field: Field, cycle_field: Field):
+    condition = None
+    for sim_id, until_cycle in lineage:
+        c = sim_field == sim_id
+        if until_cycle is not None:
+            c &= cycle_field < until_cycle
+        condition = c if condition is None else condition | c
+    return condition
+
+
+# rows of the query build_query(sim_id, until_cycle) gives for every simulation of the lineage, oldest first, each run in that simulation's db
+# a fork's shard only has the rows the fork wrote, the rows it shares with its ancestors are read from theirs (one db when sharding is off)
+def iter_lineage(lineage: list[tuple[int, int]], build_query: Callable[[int, int], Iterable[Any]]) -> Generator[Any, None, None]:
+    for sim_id, until_cycle in reversed(lineage):
+        yield from iter_with_simulation_db(sim_id, build_query(sim_id, until_cycle), create=False)
+
+
+# immutable copy of a SimulationEvent row yielded out of the simulation, a tuple instead of a model instance (and the AgentInfo it references)
+# so events held by the stream or the caller stay small
+class EventRecord(NamedTuple):
+    id: int
+    sim_id: int
+    agent_id: int  # id of the agent from the web server backend, 0 for simulation level events
+    type: str
+    content: str
+    cycle: int
+
+
+# inserts the event without building a model instance, info_id is the AgentInfo id of the agent (None for simulation level events)
+def create_event(
+    sim_id: int, type: str, content: str, cycle: int, info_id: int = None, agent_id: int = 0, decided_by: str = None
+) -> EventRecord:
+    id = SimulationEvent.insert(
+        agent=info_id, sim_id=sim_id, type=type, content=content, cycle=cycle, decided_by=decided_by
+    ).execute()
+    return EventRecord(id, sim_id, agent_id, type, content, cycle)
+
+
+# stores a copy of the products of the simulation (obtained from the web server backend) so results can be computed without the backend resending them
+class ProductInfo(Model):
+    product_id = IntegerField()
+    sim_id = IntegerField()
+    name = TextField()
+    desc = TextField()
+    price = FloatField()
+    cost = FloatField()
+    class Meta:
+        database = db
+
+
+# a live update (UpdateSimulation) applied to the simulation, replayed onto the products and environment description of the request when the simulation is initialised again
+class SimulationChange(Model):
+    sim_id = IntegerField(index=True)
+    change_id = TextField() # given when the update was requested, an update sent again (eg. to a restarted worker) is only applied once
+    cycle = IntegerField() # first cycle with the update
+    content = TextField() # JSON of the update (see live_update.py)
+    time_created = DateTimeField(default=datetime.now)
+    class Meta:
+        database = db
+
+
+# maps simulations to their shard file when sharding is enabled
+class SimulationShard(Model):
+    sim_id = IntegerField(unique=True)
+    path = TextField()
+    archived = BooleanField(default=False)
+    time_created = DateTimeField(default=datetime.now)
+    class Meta:
+        database = catalog_db
+
+
+# research reports of past ResearchProductCompetitor calls, near duplicate products are answered from here (see research_cache.py)
+# not tied to a simulation so always in the catalog db
+class ResearchReport(Model):
+    product_id = IntegerField()
+    name = TextField()
+    desc = TextField()
+    price = FloatField()
+    price_band = IntegerField(index=True) # log scale price band, lookups only look at the neighbouring bands
+    signature = BlobField() # minhash signature of the name and description words
+    query = TextField()
+    report = TextField()
+    time_created = DateTimeField(default=datetime.now, index=True)
+    class Meta:
+        database = catalog_db
+
+
+# tables that live in the shard of each simulation when sharding is enabled
+SHARDED_TABLES = [AgentInfo, AgentMemory, BroadcastMemory, SimulationEvent, ProductInfo, SimulationFork, SimulationChange]
+
+shards: dict[int, SqliteDatabase] = {}  # sim id -> opened shard
+shards_lock = threading.Lock()
+
+
+def is_sharding_enabled() -> bool:
+    return os.getenv("DB_SHARDING") == "true"
+
+
+def get_shard_dir() -> str:
+    return os.getenv("DB_SHARD_DIR") or "shards"
+
+
+def open_shard(path: str) -> SqliteDatabase:
+    # wal so readers (eg. analytics, export) do not block the simulation writing
+    return SqliteDatabase(path, pragmas={"journal_mode": "wal", "synchronous": "normal"})
+
+
+# returns the shard of the simulation, creating it (and its catalog entry) if create is True, None if it does not exist
+# a shard whose file is gone is only created again once the simulation is dropped (see drop_simulation_db), except for archived ones
+def get_shard(sim_id: int, create: bool = True) -> SqliteDatabase:
+    with shards_lock:
+        if sim_id in shards:
+            return shards[sim_id]
+        entry = SimulationShard.get_or_none(SimulationShard.sim_id == sim_id)
+        if entry is not None and not os.path.exists(entry.path):
+            if not entry.archived:
+                raise MissingShardException(f"Shard of simulation {sim_id} is missing at {entry.path}, drop the simulation to start it again")
+            entry.delete_instance()  # its archived file was deleted, the simulation is dropped
+            entry = None
+        if entry is None:
+            if not create:
+                return None
+            os.makedirs(get_shard_dir(), exist_ok=True)
+            path = os.path.join(get_shard_dir(), f"sim_{sim_id}.db")
+            for suffix in ["", "-wal", "-shm"]:
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)  # left by a simulation that is not in the catalog anymore
+            entry = SimulationShard.create(sim_id=sim_id, path=path)
+        # forks made before they got their own shard live in the shard of their parent, one connection per file
+        for opened in shards.values():
+            if opened.database == entry.path:
+                shards[sim_id] = opened
+                return opened
+        shard = open_shard(entry.path)
+        token = current_shard.set(shard)
+        try:
+            migrate_db(SHARDED_TABLES)
+        finally:
+            current_shard.reset(token)
+        shards[sim_id] = shard
+        return shard
+
+
+# whether the simulation has anything in db, checked in the simulation's db context
+def simulation_exists(sim_id: int) -> bool:
+    if is_sharding_enabled() and get_shard(sim_id, create=False) is None:
+        return False
+    return AgentInfo.get_or_none(AgentInfo.sim_id == sim_id) is not None or SimulationFork.get_or_none(SimulationFork.sim_id == sim_id) is not None
+
+
+# branches the simulation off its parent at fork_cycle, the fork reads the parent's rows before fork_cycle instead of rerunning them
+# when sharding the fork gets its own (empty) shard so forks (eg. the variants of a sweep) write in parallel instead of on their parent's writer lock,
+# the parent's rows stay in the parent's shard and are read from there (see iter_lineage)
+def fork_simulation_db(sim_id: int, parent_id: int, fork_cycle: int):
+    with use_simulation_db(sim_id):
+        SimulationFork.create(sim_id=sim_id, parent_id=parent_id, fork_cycle=fork_cycle)
+
+
+# every query of the simulation tables within this context goes to the simulation's shard (no-op when sharding is off)
+@contextmanager
+def use_simulation_db(sim_id: int, create: bool = True):
+    shard = get_shard(sim_id, create) if is_sharding_enabled() else None
+    token = current_shard.set(shard)
+    try:
+        yield
+    finally:
+        current_shard.reset(token)
+
+
+# pulls every item of the iterable within the simulation's db context but yields it outside, so the context never leaks across yields
+def iter_with_simulation_db(sim_id: int, iterable: Iterable[Any], create: bool = True) -> Generator[Any, None, None]:
+    with use_simulation_db(sim_id, create):
+        it = iter(iterable)  # a query runs when iterated
+    while True:
+        with use_simulation_db(sim_id, create):
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+        yield item
+
+
+# ids of the simulations in the db, with sharding the catalog's plus the ones started in the catalog db before sharding was enabled
+def simulation_ids() -> list[int]:
+    token = current_shard.set(None)  # the catalog db
+    try:
+        ids = set([a.sim_id for a in AgentInfo.select(AgentInfo.sim_id).distinct()])
+        ids.update([f.sim_id for f in SimulationFork.select(SimulationFork.sim_id)])
+        if is_sharding_enabled():
+            ids.update([e.sim_id for e in SimulationShard.select(SimulationShard.sim_id)])
+    finally:
+        current_shard.reset(token)
+    return sorted(ids)
+
+
+# runs fn(sim_id, from_cycle) for every simulation in its db and concatenates the results, for queries that span simulations
+# fn reads the simulation's own rows only (sim_id, and for a fork the cycles from its fork cycle), the cycles a fork shares with its parent
+# are the parent's rows so they are counted once, shards whose file is gone are skipped
+def query_all_simulations(fn: Callable[[int, int], Iterable[Any]]) -> list[Any]:
+    results = []
+    for sim_id in simulation_ids():
+        try:
+            with use_simulation_db(sim_id, create=False):
+                fork = SimulationFork.get_or_none(SimulationFork.sim_id == sim_id)
+                results.extend(fn(sim_id, fork.fork_cycle if fork is not None else 0))
+        except MissingShardException as e:
+            print(f"{e}, skipped")
+    return results
+
+
+# closes the shard of the simulation and returns the catalog entries of every simulation in it (forks made before they got their own shard share their parent's)
+def close_shard(sim_id: int) -> list[SimulationShard]:
+    with shards_lock:
+        entry = SimulationShard.get_or_none(SimulationShard.sim_id == sim_id)
+        if entry is None:
+            return []
+        entries = list(SimulationShard.select().where(SimulationShard.path == entry.path))
+        for e in entries:
+            shard = shards.pop(e.sim_id, None)
+            if shard is not None:
+                shard.close()
+        return entries
+
+
+# moves the shard of a finished simulation out of the shard dir, no large DELETEs needed, it is opened from the archive dir if read again
+# deleting the archived file drops the simulation, forks sharing the shard are archived together
+def archive_simulation_db(sim_id: int, archive_dir: str = None):
+    entries = close_shard(sim_id)
+    if len(entries) == 0 or entries[0].archived:
+        return
+    src = entries[0].path
+    archive_dir = archive_dir or os.getenv("DB_ARCHIVE_DIR") or "archive"
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, os.path.basename(src))
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.exists(src + suffix):
+            shutil.move(src + suffix, path + suffix)
+    SimulationShard.update(path=path, archived=True).where(SimulationShard.path == src).execute()
+
+
+# deletes the simulation from the db, with sharding its shard file and catalog entry so no large DELETEs are needed (also when the file is
+# alrd gone), a shard still shared with forks made before they got their own shard only loses the simulation's rows
+# forks read their shared history from their parent so they have to be dropped first
+def drop_simulation_db(sim_id: int):
+    entry = SimulationShard.get_or_none(SimulationShard.sim_id == sim_id) if is_sharding_enabled() else None
+    shared = entry is not None and SimulationShard.select().where(SimulationShard.path == entry.path).count() > 1
+    if entry is None or shared:
+        with use_simulation_db(sim_id, create=False), db.atomic():
+            for model in SHARDED_TABLES:
+                model.delete().where(model.sim_id == sim_id).execute()
+    if entry is None:
+        return
+    close_shard(sim_id)
+    if not shared:
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(entry.path + suffix):
+                os.remove(entry.path + suffix)
+    entry.delete_instance()
+
+
+# a completed simulation's shard is closed so finished simulations do not keep connections open, and archived if DB_ARCHIVE_COMPLETED is true
+# a shard still shared with other simulations (forks made before they got their own shard) is only closed
+def finish_simulation_db(sim_id: int):
+    if not is_sharding_enabled():
+        return
+    entries = close_shard(sim_id)
+    if os.getenv("DB_ARCHIVE_COMPLETED") == "true" and len(entries) == 1:
+        archive_simulation_db(sim_id)
+
+
+# creates the tables, create_tables does not alter existing tables so the columns introduced after a table was first created are added first
+# then create_tables adds the missing tables and the indexes added to existing columns (eg. index=True on sim_id), both only if they do not exist
+def migrate_db(models: list[Model]):
+    migrator = SqliteMigrator(db.obj)
+    for model in models:
+        table = model._meta.table_name
+        if not db.table_exists(table):
+            continue
+        existing = set([c.name for c in db.get_columns(table)])
+        indexes = set([i.name for i in db.get_indexes(table)])
+        for field in model._meta.sorted_fields:
+            if field.column_name not in existing:
+                print(f"Adding column {field.column_name} to {table}")
+                if f"{table}_{field.column_name}" in indexes:
+                    # left by an older version that created the indexes before adding the columns, sqlite indexed the column name as a string
+                    db.execute_sql(f'DROP INDEX "{table}_{field.column_name}"')
+                migrate(migrator.add_column(table, field.column_name, field))
+                if field is AgentMemory.sim_id:
+                    # memories written before forking existed all belong to the simulation of their AgentInfo
+                    AgentMemory.update(
+                        sim_id=AgentInfo.select(AgentInfo.sim_id).where(AgentInfo.id == AgentMemory.agent)
+                    ).execute()
+    db.create_tables(models)
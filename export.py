@@ -0,0 +1,165 @@
+# exports the history of a simulation (events, agent memories and broadcast memories) in Arrow IPC chunks
+# a fork's history includes the rows it shares with its parent, sim_id tells which simulation wrote the row (ids are per simulation's db so
+# sim_id and id together identify a row when sharding), rows are read with keyset pagination on the id so memory stays constant no matter how long the simulation is
+from typing import Any, Callable, Generator
+
+import pyarrow as pa
+from peewee import JOIN
+
+from db import AgentInfo, AgentMemory, BroadcastMemory, SimulationEvent, get_lineage, in_lineage, iter_with_simulation_db
+
+DEFAULT_CHUNK_SIZE = 5000
+
+EVENT_SCHEMA = pa.schema(
+    [
+        ("id", pa.int64()),
+        ("sim_id", pa.int32()),
+        ("cycle", pa.int32()),
+        ("agent_id", pa.int32()),  # null for simulation level events
+        ("type", pa.dictionary(pa.int8(), pa.string())),  # only a handful of types, dictionary encoded to stay compact
+        ("content", pa.string()),
+        ("time_created", pa.timestamp("us")),
+    ]
+)
+
+MEMORY_SCHEMA = pa.schema(
+    [
+        ("id", pa.int64()),
+        ("sim_id", pa.int32()),
+        ("cycle", pa.int32()),
+        ("agent_id", pa.int32()),
+        ("content", pa.string()),
+        ("time_created", pa.timestamp("us")),
+    ]
+)
+
+BROADCAST_SCHEMA = pa.schema(
+    [
+        ("id", pa.int64()),
+        ("sim_id", pa.int32()),
+        ("cycle", pa.int32()),
+        ("content", pa.string()),
+        ("time_created", pa.timestamp("us")),
+    ]
+)
+
+
+# to_cycle 0 means up to the latest cycle
+def cycle_range_filter(field, from_cycle: int, to_cycle: int):
+    condition = field >= from_cycle
+    if to_cycle > 0:
+        condition &= field <= to_cycle
+    return condition
+
+
+# pages through the query by id, build_query gets the last id of the previous page
+def iter_keyset_batches(
+    build_query: Callable[[int], Any], schema: pa.Schema, chunk_size: int
+) -> Generator[pa.RecordBatch, None, None]:
+    last_id = 0
+    while True:
+        rows = list(build_query(last_id).limit(chunk_size).tuples())
+        if len(rows) == 0:
+            return
+        last_id = rows[-1][0]  # id is always the first column
+        yield pa.RecordBatch.from_arrays(
+            [pa.array(column, type=field.type) for column, field in zip(zip(*rows), schema)],
+            schema=schema,
+        )
+
+
+# the batches of every simulation of the lineage, oldest first, each paged through in that simulation's db
+# build_query gets the simulation, the cycle its rows stop at and the last id of the previous page
+def iter_lineage_batches(
+    sim_id: int, build_query: Callable[[int, int, int], Any], schema: pa.Schema, chunk_size: int
+) -> Generator[pa.RecordBatch, None, None]:
+    lineage = get_lineage(sim_id)  # read lazily, within the simulation's db context
+    for lineage_id, until_cycle in reversed(lineage):
+        yield from iter_with_simulation_db(
+            lineage_id,
+            iter_keyset_batches(lambda last_id: build_query(lineage_id, until_cycle, last_id), schema, chunk_size),
+            create=False,
+        )
+
+
+def iter_event_batches(
+    sim_id: int, from_cycle: int = 0, to_cycle: int = 0, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> Generator[pa.RecordBatch, None, None]:
+    yield from iter_lineage_batches(
+        sim_id,
+        lambda lineage_id, until_cycle, last_id: SimulationEvent.select(
+            SimulationEvent.id,
+            SimulationEvent.sim_id,
+            SimulationEvent.cycle,
+            AgentInfo.agent_id,
+            SimulationEvent.type,
+            SimulationEvent.content,
+            SimulationEvent.time_created,
+        )
+        .join(AgentInfo, JOIN.LEFT_OUTER)
+        .where(
+            in_lineage([(lineage_id, until_cycle)], SimulationEvent.sim_id, SimulationEvent.cycle)
+            & (SimulationEvent.id > last_id)
+            & cycle_range_filter(SimulationEvent.cycle, from_cycle, to_cycle)
+        )
+        .order_by(SimulationEvent.id),
+        EVENT_SCHEMA,
+        chunk_size,
+    )
+
+
+def iter_memory_batches(
+    sim_id: int, from_cycle: int = 0, to_cycle: int = 0, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> Generator[pa.RecordBatch, None, None]:
+    yield from iter_lineage_batches(
+        sim_id,
+        lambda lineage_id, until_cycle, last_id: AgentMemory.select(
+            AgentMemory.id,
+            AgentMemory.sim_id,
+            AgentMemory.cycle,
+            AgentInfo.agent_id,
+            AgentMemory.content,
+            AgentMemory.time_created,
+        )
+        .join(AgentInfo)
+        .where(
+            in_lineage([(lineage_id, until_cycle)], AgentMemory.sim_id, AgentMemory.cycle)
+            & (AgentMemory.id > last_id)
+            & cycle_range_filter(AgentMemory.cycle, from_cycle, to_cycle)
+        )
+        .order_by(AgentMemory.id),
+        MEMORY_SCHEMA,
+        chunk_size,
+    )
+
+
+# simulation wide memories, part of every agent's timeline (merged by time_created)
+def iter_broadcast_batches(
+    sim_id: int, from_cycle: int = 0, to_cycle: int = 0, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> Generator[pa.RecordBatch, None, None]:
+    yield from iter_lineage_batches(
+        sim_id,
+        lambda lineage_id, until_cycle, last_id: BroadcastMemory.select(
+            BroadcastMemory.id,
+            BroadcastMemory.sim_id,
+            BroadcastMemory.cycle,
+            BroadcastMemory.content,
+            BroadcastMemory.time_created,
+        )
+        .where(
+            in_lineage([(lineage_id, until_cycle)], BroadcastMemory.sim_id, BroadcastMemory.cycle)
+            & (BroadcastMemory.id > last_id)
+            & cycle_range_filter(BroadcastMemory.cycle, from_cycle, to_cycle)
+        )
+        .order_by(BroadcastMemory.id),
+        BROADCAST_SCHEMA,
+        chunk_size,
+    )
+
+
+# every chunk is a self contained Arrow IPC stream (schema + one record batch) so the client can decode chunks independently
+def to_ipc_bytes(batch: pa.RecordBatch) -> bytes:
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
@@ -0,0 +1,138 @@
+# stand-in for an ollama server for load tests (see loadtest.py), answers every call site of the core with a valid response after a set latency
+# so the core can be loaded with many simulations without GPUs, only the core's own overhead and the configured latency are measured
+# python fake_model_server.py --port 11434 --latency 0.5 --token-latency 0.01
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# response for the prompt, picked by what the prompt asks for (same checks as the prompts' format instructions)
+def answer(prompt: str, message_rate: float) -> str:
+    if "additional_data_id" in prompt:
+        roll = random.random()
+        agent_ids = re.findall(r"\(agent_id:(\d+)\)", prompt)
+        product_ids = re.findall(r"product_id:(\d+)", prompt)
+        if roll < message_rate and len(agent_ids) > 0:
+            res = {"action": "MESSAGE", "reason": "", "additional_data_id": int(random.choice(agent_ids)), "additional_data_content": "have you seen this?"}
+        elif roll < message_rate + (1 - message_rate) / 2 and len(product_ids) > 0:
+            res = {"action": "BUY", "reason": "looks good", "additional_data_id": int(random.choice(product_ids)), "additional_data_content": "product"}
+        else:
+            res = {"action": "SKIP", "reason": "too pricey", "additional_data_id": 0, "additional_data_content": "too pricey"}
+    elif '"feedbacks"' in prompt:
+        res = {"feedbacks": [{"agent_id": int(i), "feedback": "it was alright"} for i in re.findall(r"\(agent_id:(\d+),event:", prompt)]}
+    elif '"feedback"' in prompt:
+        res = {"feedback": "it was alright"}
+    elif '"message"' in prompt:
+        res = {"message": "thanks, I will have a look"}
+    elif "'query'" in prompt:
+        res = {"query": "similar products and prices"}
+    elif "'description'" in prompt:
+        res = {"description": "You are a consumer who cares about value for money"}
+    else:
+        return "No competitors found in the search results."
+    return json.dumps(res)
+
+
+class FakeModelHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    token_latency = 0.0
+    message_rate = 0.15
+    load_time = 0.0
+    loaded: dict[str, float] = {}  # model -> time it unloads
+    load_lock = threading.Lock()  # one model load at a time like ollama
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_json({"models": [{"name": model} for model in self.loaded]})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        is_chat = self.path == "/api/chat"
+        prompt = "\n".join([m.get("content", "") for m in body.get("messages", [])]) if is_chat else body.get("prompt", "")
+        self.load(body.get("model"), body.get("keep_alive"))
+        if prompt == "":
+            self.send_json({"model": body.get("model"), "response": "", "done": True, "done_reason": "load"})
+            return
+        time.sleep(self.get_latency(prompt))
+        text = self.get_answer(prompt)
+        counts = {"prompt_eval_count": len(prompt) // 4, "eval_count": len(text) // 4}
+        if not body.get("stream", True):
+            self.send_json({"model": body.get("model"), **self.chunk(text, is_chat), "done": True, **counts})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for i in range(0, len(text), 4):  # 4 characters per token
+                time.sleep(self.token_latency)
+                self.wfile.write((json.dumps({"model": body.get("model"), **self.chunk(text[i : i + 4], is_chat), "done": False}) + "\n").encode())
+                self.wfile.flush()
+            self.wfile.write((json.dumps({"model": body.get("model"), **self.chunk("", is_chat), "done": True, **counts}) + "\n").encode())
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the core cancelled the call
+
+    # seconds before the first token, the same for every prompt, tests override it to stall only some call sites
+    def get_latency(self, prompt: str) -> float:
+        return self.latency
+
+    # response for the prompt, tests override it to answer some call sites their own way
+    def get_answer(self, prompt: str) -> str:
+        return answer(prompt, self.message_rate)
+
+    def chunk(self, text: str, is_chat: bool) -> dict:
+        return {"message": {"role": "assistant", "content": text}} if is_chat else {"response": text}
+
+    def send_json(self, res: dict):
+        data = json.dumps(res).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # models unload once their keep alive (default 5 minutes) passed since the last call, the next call pays the load time again
+    def load(self, model: str, keep_alive):
+        with self.load_lock:
+            if self.loaded.get(model, 0) < time.time():
+                time.sleep(self.load_time)
+            self.loaded[model] = time.time() + parse_duration(keep_alive)
+
+
+def parse_duration(value) -> float:
+    if value is None:
+        return 300
+    match = re.match(r"^(-?\d+(?:\.\d+)?)([smh]?)$", str(value))
+    if match is None:
+        return 300
+    seconds = float(match.group(1)) * {"": 1, "s": 1, "m": 60, "h": 3600}[match.group(2)]
+    return seconds if seconds >= 0 else float("inf")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ollama stand-in for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before the first token of every call")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds per streamed token")
+    parser.add_argument("--message-rate", type=float, default=0.15, help="share of agent decisions that message another agent")
+    parser.add_argument("--load-time", type=float, default=0.0, help="seconds to load a model that is not loaded")
+    args = parser.parse_args()
+    FakeModelHandler.latency = args.latency
+    FakeModelHandler.token_latency = args.token_latency
+    FakeModelHandler.message_rate = args.message_rate
+    FakeModelHandler.load_time = args.load_time
+    print(f"Fake model server on {args.host}:{args.port}")
+    ThreadingHTTPServer((args.host, args.port), FakeModelHandler).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# a change to the catalog or environment of a running simulation (UpdateSimulation), applied at the start of the simulation's next cycle
+# so a cycle never sees two catalogs, agents keep their descriptions and memory
+# applied updates are stored (db.SimulationChange) and replayed onto the request's products and environment description when the simulation is initialised again
+import json
+
+from product import Product
+
+
+class LiveUpdate:
+    def __init__(
+        self,
+        id: str,
+        products: list[Product],  # added or changed, a product with the id of an existing one replaces it
+        removed_ids: list[int],
+        env_desc: str = "",  # empty keeps the environment description
+    ) -> None:
+        self.id = id
+        self.products = products
+        self.removed_ids = removed_ids
+        self.env_desc = env_desc
+
+    # the catalog after the update, existing products keep their order and added ones go at the end
+    def apply_to(self, products: list[Product]) -> list[Product]:
+        changed = {int(p.id): p for p in self.products}
+        kept = [p for p in products if int(p.id) not in self.removed_ids]
+        result = [changed.pop(int(p.id), p) for p in kept]
+        return result + list(changed.values())
+
+    # why the update cannot be applied to a catalog of these product ids, empty if it can
+    def check(self, product_ids: set[int]) -> str:
+        changed = set([int(p.id) for p in self.products])
+        if len(changed) == 0 and len(self.removed_ids) == 0 and self.env_desc == "":
+            return "The update changes nothing"
+        if len(changed) != len(self.products):
+            return "A product is given more than once"
+        if len(changed & set(self.removed_ids)) > 0:
+            return "A product is both changed and removed"
+        unknown = set(self.removed_ids) - product_ids
+        if len(unknown) > 0:
+            return f"No such products to remove: {', '.join([str(i) for i in sorted(unknown)])}"
+        if len((product_ids - set(self.removed_ids)) | changed) == 0:
+            return "The update removes every product"
+        return ""
+
+    # ids of the catalog after the update, to check updates queued after this one
+    def product_ids(self, product_ids: set[int]) -> set[int]:
+        return (product_ids - set(self.removed_ids)) | set([int(p.id) for p in self.products])
+
+    # what changed for the SIMULATION event, compared to the catalog before the update
+    def describe(self, products: list[Product]) -> str:
+        before = {int(p.id): p for p in products}
+        changes = []
+        for p in self.products:
+            old = before.get(int(p.id))
+            if old is None:
+                changes.append(f"added {p.name} (product_id:{p.id}) at RM{p.price}")
+            elif float(old.price) != float(p.price):
+                changes.append(f"{p.name} (product_id:{p.id}) price RM{old.price} -> RM{p.price}")
+            else:
+                changes.append(f"{p.name} (product_id:{p.id}) changed")
+        for i in self.removed_ids:
+            if i in before:
+                changes.append(f"removed {before[i].name} (product_id:{i})")
+        if self.env_desc != "":
+            changes.append(f"environment description changed to: {self.env_desc}")
+        return f"Simulation updated ({self.id}): {'; '.join(changes)}"
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "products": [
+                    {"id": int(p.id), "name": p.name, "desc": p.desc, "price": float(p.price), "cost": float(p.cost)}
+                    for p in self.products
+                ],
+                "removed_ids": self.removed_ids,
+                "env_desc": self.env_desc,
+            }
+        )
+
+
+def load_live_update(id: str, content: str, simulation_id: int) -> LiveUpdate:
+    data = json.loads(content)
+    return LiveUpdate(
+        id,
+        [Product(simulation_id=simulation_id, **p) for p in data["products"]],
+        data["removed_ids"],
+        data["env_desc"],
+    )
@@ -0,0 +1,451 @@
+# central place where all the LLMs of the core are created, every call site is routed to a model tier
+# so cheap and high volume calls (feedback, talk replies, query rewriting) can run on a smaller and faster model
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Generator, Iterable
+
+import requests
+from langchain_community.llms import Ollama
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.runnables import RunnableLambda
+
+from backend_pool import Backend, get_backend_pool
+from cassette import current_cassette, get_cassette_mode, hash_key
+from utils import (
+    CancelledException,
+    DeadlinePassedException,
+    LLMTimeoutException,
+    RetryLimitExceededException,
+    get_chain_response_json,
+)
+
+# ordered from smallest to largest, when a tier fails validation too many times the call falls back to the next larger tier
+TIER_ORDER = ["small", "large"]
+
+# default model for each tier, can be overwritten with MODEL_SMALL and MODEL_LARGE env
+DEFAULT_TIER_MODELS = {
+    "small": "llama3.2",
+    "large": "llama3.1",
+}
+
+# call site -> tier, can be overwritten with MODEL_ROUTES env (eg. MODEL_ROUTES=talk_response=large,action_feedback=small)
+DEFAULT_ROUTES = {
+    "agent_action": "large",
+    "talk_response": "small",
+    "action_feedback": "small",
+    "persona_rewrite": "large",
+    "research_query": "small",
+    "research_report": "large",
+}
+
+# number of rejected responses a tier gets before the call falls back to a larger tier
+DEFAULT_FALLBACK_RETRIES = 3
+
+# seconds a single LLM call can take, can be overwritten with LLM_TIMEOUT env (0 for no limit)
+DEFAULT_LLM_TIMEOUT = 120
+
+# servers unload a model 5 minutes after its last call by default, long enough gaps (eg. pauses, fallback only tiers) mean paying the load time again
+DEFAULT_KEEP_ALIVE = "30m"
+
+
+# env are read lazily since dotenv is only loaded in main after the modules are imported
+def get_tier_model(tier: str) -> str:
+    return os.getenv(f"MODEL_{tier.upper()}") or DEFAULT_TIER_MODELS[tier]
+
+
+def get_routes() -> dict[str, str]:
+    routes = dict(DEFAULT_ROUTES)
+    for route in (os.getenv("MODEL_ROUTES") or "").split(","):
+        if "=" not in route:
+            continue
+        call_site, tier = [s.strip() for s in route.split("=", 1)]
+        if tier not in TIER_ORDER:
+            print(f"Unknown model tier {tier} for call site {call_site}, ignoring")
+            continue
+        routes[call_site] = tier
+    return routes
+
+
+def get_route(call_site: str) -> str:
+    return get_routes().get(call_site, TIER_ORDER[-1])  # unknown call sites go to the largest model to be safe
+
+
+def get_fallback_retries() -> int:
+    return int(os.getenv("MODEL_FALLBACK_RETRIES") or DEFAULT_FALLBACK_RETRIES)
+
+
+def get_llm_timeout() -> int:
+    timeout = os.getenv("LLM_TIMEOUT")
+    return int(timeout) if timeout else DEFAULT_LLM_TIMEOUT
+
+
+# how long a model server keeps a model loaded after a call, can be overwritten with LLM_KEEP_ALIVE env (ollama duration eg. 30m, -1 to never unload)
+def get_keep_alive() -> str:
+    return os.getenv("LLM_KEEP_ALIVE") or DEFAULT_KEEP_ALIVE
+
+
+# tiers any call site can end up on, the routed tiers and the larger tiers they fall back to
+def get_used_tiers() -> list[str]:
+    return TIER_ORDER[min([TIER_ORDER.index(tier) for tier in get_routes().values()]):]
+
+
+class TierStats:
+    def __init__(self) -> None:
+        self.calls = 0
+        self.retries = 0
+        self.fallbacks = 0
+        self.total_time = 0.0
+        self.lock = threading.Lock()  # grpc handles simulations in different threads
+
+    def record_call(self, elapsed: float):
+        with self.lock:
+            self.calls += 1
+            self.total_time += elapsed
+
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def record_fallback(self):
+        with self.lock:
+            self.fallbacks += 1
+
+    def retry_rate(self) -> float:
+        return self.retries / self.calls if self.calls > 0 else 0.0
+
+    def string(self) -> str:
+        avg = self.total_time / self.calls if self.calls > 0 else 0.0
+        return f"calls={self.calls},retry_rate={self.retry_rate():.2f},fallbacks={self.fallbacks},avg_time={avg:.2f}s"
+
+
+tier_stats: dict[str, TierStats] = {tier: TierStats() for tier in TIER_ORDER}
+
+
+def format_tier_stats() -> str:
+    return "; ".join(
+        [f"{tier}({get_tier_model(tier)}): {tier_stats[tier].string()}" for tier in TIER_ORDER]
+    )
+
+
+# set while a simulation's work runs, every LLM call made in this context stops once it is set (eg. simulation paused)
+current_cancel_event: ContextVar[threading.Event] = ContextVar("current_cancel_event", default=None)
+
+
+@contextmanager
+def use_cancel_event(event: threading.Event):
+    token = current_cancel_event.set(event)
+    try:
+        yield
+    finally:
+        current_cancel_event.reset(token)
+
+
+def check_cancelled():
+    event = current_cancel_event.get()
+    if event is not None and event.is_set():
+        raise CancelledException
+
+
+# checks for cancellation before the request and on every streamed token, so a cancelled call stops mid generation
+# (latency is bounded by the time to the first token instead of the whole response)
+class CancelCallbackHandler(BaseCallbackHandler):
+    raise_error = True  # langchain swallows callback errors otherwise
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        check_cancelled()
+
+    def on_llm_new_token(self, token, **kwargs):
+        check_cancelled()
+
+
+cancel_callback_handler = CancelCallbackHandler()
+
+
+# deadline (in time.monotonic()) of the work being done, LLM calls made in this context time out once it passes (eg. cycle deadline, grpc deadline)
+current_deadline: ContextVar[float] = ContextVar("current_deadline", default=None)
+
+
+# None keeps the outer deadline, nested deadlines can only make it earlier
+@contextmanager
+def use_deadline(deadline: float):
+    outer = current_deadline.get()
+    if deadline is None or (outer is not None and outer < deadline):
+        deadline = outer
+    token = current_deadline.set(deadline)
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+
+def is_past_deadline() -> bool:
+    deadline = current_deadline.get()
+    return deadline is not None and time.monotonic() >= deadline
+
+
+# times out calls that run past LLM_TIMEOUT or the current deadline, checked before the request and on every streamed token
+# a server that stops sending anything at all is caught by the http read timeout instead (also LLM_TIMEOUT)
+class TimeoutCallbackHandler(BaseCallbackHandler):
+    raise_error = True
+
+    def __init__(self) -> None:
+        self.call_deadlines: dict[Any, float] = {}  # run id -> time the call times out
+
+    def on_llm_start(self, serialized, prompts, run_id=None, **kwargs):
+        timeout = get_llm_timeout()
+        if timeout > 0:
+            self.call_deadlines[run_id] = time.monotonic() + timeout
+        self.check(run_id)
+
+    def on_llm_new_token(self, token, run_id=None, **kwargs):
+        self.check(run_id)
+
+    def on_llm_end(self, response, run_id=None, **kwargs):
+        self.call_deadlines.pop(run_id, None)
+
+    def on_llm_error(self, error, run_id=None, **kwargs):
+        self.call_deadlines.pop(run_id, None)
+
+    def check(self, run_id):
+        if is_past_deadline():
+            self.call_deadlines.pop(run_id, None)
+            raise DeadlinePassedException("deadline passed")
+        call_deadline = self.call_deadlines.get(run_id)
+        if call_deadline is not None and time.monotonic() >= call_deadline:
+            self.call_deadlines.pop(run_id, None)
+            raise LLMTimeoutException(f"call took longer than {get_llm_timeout()}s")
+
+
+timeout_callback_handler = TimeoutCallbackHandler()
+
+
+# requests gives up on a server that stops responding with a Timeout before the response starts, and a ConnectionError once it is streaming
+@contextmanager
+def raise_http_timeouts():
+    try:
+        yield
+    except requests.exceptions.Timeout as e:
+        raise LLMTimeoutException(f"no response within {get_llm_timeout()}s") from e
+    except requests.exceptions.ConnectionError as e:
+        if "timed out" not in str(e):
+            raise
+        raise LLMTimeoutException(f"no response within {get_llm_timeout()}s") from e
+
+
+# tokens used by the LLM calls made while it is the current meter (eg. by a simulation, for its token budgets)
+class TokenMeter:
+    def __init__(self, total: int = 0) -> None:
+        self.total = total
+        self.lock = threading.Lock()
+
+    def add(self, tokens: int):
+        with self.lock:
+            self.total += tokens
+
+
+current_token_meter: ContextVar[TokenMeter] = ContextVar("current_token_meter", default=None)
+
+
+# pulls every item of the iterable with the meter set but yields it outside, so the meter never leaks across yields
+def iter_with_token_meter(meter: TokenMeter, iterable: Iterable[Any]) -> Generator[Any, None, None]:
+    it = iter(iterable)
+    while True:
+        token = current_token_meter.set(meter)
+        try:
+            item = next(it)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            current_token_meter.reset(token)
+        yield item
+
+
+# roughly 4 characters per token, only used when the server does not report the counts
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+# counts prompt and generated tokens with the counts ollama reports at the end of a generation
+class TokenCountCallbackHandler(BaseCallbackHandler):
+    def __init__(self) -> None:
+        self.prompt_estimates: dict[Any, int] = {}  # run id -> estimated prompt tokens
+
+    def on_llm_start(self, serialized, prompts, run_id=None, **kwargs):
+        if current_token_meter.get() is not None:
+            self.prompt_estimates[run_id] = sum([estimate_tokens(p) for p in prompts])
+
+    def on_chat_model_start(self, serialized, messages, run_id=None, **kwargs):
+        if current_token_meter.get() is not None:
+            self.prompt_estimates[run_id] = sum(
+                [estimate_tokens(str(m.content)) for batch in messages for m in batch]
+            )
+
+    def on_llm_end(self, response, run_id=None, **kwargs):
+        prompt_estimate = self.prompt_estimates.pop(run_id, 0)
+        meter = current_token_meter.get()
+        if meter is None:
+            return
+        tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                info = generation.generation_info or {}
+                tokens += info.get("prompt_eval_count") or prompt_estimate
+                tokens += info.get("eval_count") or estimate_tokens(generation.text)
+        meter.add(tokens)
+
+    def on_llm_error(self, error, run_id=None, **kwargs):
+        self.prompt_estimates.pop(run_id, None)
+
+
+token_count_callback_handler = TokenCountCallbackHandler()
+
+
+# wraps a chain so it is built against the model of its routed tier, and rebuilt against larger tiers for fallbacks
+# build_chain receives the llm and returns the chain (eg. lambda llm: prompt | llm | parser)
+# every call is sent to a model server picked by the backend pool, affinity_key keeps an agent's calls on the same server
+class RoutedChain:
+    def __init__(
+        self,
+        call_site: str,
+        build_chain: Callable[[Any], Any],
+        llm_class: type = Ollama,
+        **llm_kwargs,
+    ) -> None:
+        self.call_site = call_site
+        self.build_chain = build_chain
+        self.llm_class = llm_class
+        self.llm_kwargs = llm_kwargs
+        self.chains: dict[tuple[str, str], Any] = {}  # (tier, server url) -> built chain
+
+    def get_chain(self, tier: str, backend: Backend):
+        key = (tier, backend.url)
+        if key not in self.chains:
+            llm = self.llm_class(
+                model=get_tier_model(tier),
+                base_url=backend.url,
+                callbacks=[cancel_callback_handler, timeout_callback_handler, token_count_callback_handler],
+                timeout=get_llm_timeout() or None,
+                keep_alive=get_keep_alive(),
+                **self.llm_kwargs,
+            )
+            if get_cassette_mode() != "":
+                self.chains[key] = self.build_chain(
+                    RunnableLambda(lambda input, config: self.call_llm_with_cassette(tier, llm, input, config))
+                )
+            else:
+                self.chains[key] = self.build_chain(llm)
+        return self.chains[key]
+
+    # the LLM call is recorded to (or answered from) the current cassette, with the tokens it used and whether it timed out
+    # so the token budgets and timeouts of the replay play out the same way (see cassette.py)
+    def call_llm_with_cassette(self, tier: str, llm, input, config):
+        cassette = current_cassette.get()
+        if cassette is None:
+            return llm.invoke(input, config)
+        site = f"{self.call_site}:{tier}"
+        key = hash_key(input.to_string() if hasattr(input, "to_string") else str(input))
+        meter = current_token_meter.get()
+        if cassette.mode == "replay":
+            entry = cassette.replay("llm", site, key)
+            if meter is not None:
+                meter.add(entry["tokens"])
+            if "timeout" in entry:
+                raise (DeadlinePassedException if entry["deadline"] else LLMTimeoutException)(entry["timeout"])
+            return AIMessage(content=entry["output"]) if entry["chat"] else entry["output"]
+        start_tokens = meter.total if meter is not None else 0
+        entry = {"kind": "llm", "site": site, "key": key}
+        try:
+            with raise_http_timeouts():
+                output = llm.invoke(input, config)
+        except LLMTimeoutException as e:
+            entry["tokens"] = meter.total - start_tokens if meter is not None else 0
+            entry["timeout"] = str(e)
+            entry["deadline"] = isinstance(e, DeadlinePassedException) or is_past_deadline()
+            cassette.record(entry)
+            raise
+        entry["tokens"] = meter.total - start_tokens if meter is not None else 0
+        entry["output"] = output.content if isinstance(output, BaseMessage) else output
+        entry["chat"] = isinstance(output, BaseMessage)
+        cassette.record(entry)
+        return output
+
+    # calls call_chain with the tier's chain on the least loaded server, moving on to the next server if it cannot be reached
+    def call_backend(self, tier: str, call_chain: Callable[[Any], Any], affinity_key: str = None):
+        pool = get_backend_pool()
+        tried: list[Backend] = []
+        while True:
+            backend = pool.acquire(affinity_key, exclude=tried)
+            start = time.perf_counter()
+            ok = False
+            try:
+                with raise_http_timeouts():
+                    res = call_chain(self.get_chain(tier, backend))
+                ok = True
+                return res
+            except requests.exceptions.ConnectionError:
+                pool.eject(backend)
+                tried.append(backend)
+                if len(tried) >= len(pool.backends):
+                    raise
+                print(f"{self.call_site} could not reach {backend.url}, retrying on another server")
+            finally:
+                pool.release(backend, time.perf_counter() - start, ok=ok)
+
+    # tiers to try for this call site, the routed tier then every larger tier
+    def get_tiers(self) -> list[str]:
+        return TIER_ORDER[TIER_ORDER.index(get_route(self.call_site)):]
+
+    # for chains without structured output (eg. research report), nothing to validate so no fallback
+    def invoke(self, invoker: dict[str, Any], affinity_key: str = None):
+        tier = self.get_tiers()[0]
+        check_cancelled()
+        start = time.perf_counter()
+        try:
+            return self.call_backend(tier, lambda chain: chain.invoke(invoker), affinity_key)
+        except LLMTimeoutException as e:
+            raise LLMTimeoutException(f"{self.call_site} on {tier} tier: {e}") from e
+        finally:
+            tier_stats[tier].record_call(time.perf_counter() - start)
+
+    # same as get_chain_response_json, but falls back to the next larger tier when a tier keeps failing validation
+    # or a call times out (the last tier raises the timeout, so does any tier once the deadline passed)
+    def invoke_json(
+        self,
+        invoker: dict[str, Any],
+        expected_fields: list[str],
+        additional_check: Callable[[dict[str, Any]], bool] = None,
+        affinity_key: str = None,
+    ):
+        tiers = self.get_tiers()
+        for i, tier in enumerate(tiers):
+            is_last = i == len(tiers) - 1
+            stats = tier_stats[tier]
+            check_cancelled()
+            start = time.perf_counter()
+            try:
+                return self.call_backend(
+                    tier,
+                    lambda chain: get_chain_response_json(
+                        chain,
+                        invoker,
+                        expected_fields,
+                        additional_check=additional_check,
+                        max_retries=None if is_last else get_fallback_retries(),  # largest tier keeps retrying like before
+                        on_retry=stats.record_retry,
+                    ),
+                    affinity_key,
+                )
+            except RetryLimitExceededException:
+                stats.record_fallback()
+                print(f"{self.call_site} failed validation on {tier} tier, falling back to {tiers[i + 1]} tier")
+            except LLMTimeoutException as e:
+                if is_last or isinstance(e, DeadlinePassedException) or is_past_deadline():
+                    raise LLMTimeoutException(f"{self.call_site} on {tier} tier: {e}") from e
+                stats.record_fallback()
+                print(f"{self.call_site} timed out on {tier} tier ({e}), falling back to {tiers[i + 1]} tier")
+            finally:
+                stats.record_call(time.perf_counter() - start)
@@ -0,0 +1,435 @@
+# load generator for the core, drives a running MarcomService over grpc the way the backend does to find out how many simulations and streams an instance sustains
+# starts M simulations (roster and catalog sizes configurable), attaches N stream subscribers spread over them, and meanwhile pauses and resumes simulations,
+# asks for research and polls analytics, against a core started by the harness (--spawn-core) or one already running (--target)
+# reports rpc latency percentiles, event delivery lag (from SimulationUpdate.ready_at_ms, the core and harness have to share a clock), dropped streams
+# and the core's cpu and memory (--spawn-core or --core-pid, linux only), results are saved as json so runs of different versions can be compared (--compare)
+# python loadtest.py --spawn-core --fake-model --simulations 8 --agents 20 --cycles 3 --subscribers 8 --pause-every 5 --research-every 10
+# research calls do a real web search unless the core replays cassettes, --research-every 0 leaves them out
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import grpc
+
+from proto import marcom_core_pb2, marcom_core_pb2_grpc
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def percentile(values: list[float], p: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summarize(values: list[float]) -> dict[str, float]:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+        "max": max(values) if len(values) > 0 else 0.0,
+    }
+
+
+class RpcStats:
+    def __init__(self) -> None:
+        self.latencies: dict[str, list[float]] = {}  # rpc -> ms
+        self.errors: dict[str, dict[str, int]] = {}  # rpc -> status code -> count
+        self.lock = threading.Lock()
+
+    def record(self, rpc: str, ms: float):
+        with self.lock:
+            self.latencies.setdefault(rpc, []).append(ms)
+
+    def record_error(self, rpc: str, code: str):
+        with self.lock:
+            errors = self.errors.setdefault(rpc, {})
+            errors[code] = errors.get(code, 0) + 1
+
+    def summary(self) -> dict[str, dict]:
+        with self.lock:
+            return {
+                rpc: {**summarize(self.latencies.get(rpc, [])), "errors": self.errors.get(rpc, {})}
+                for rpc in sorted(set(self.latencies) | set(self.errors))
+            }
+
+
+# cpu and memory of the core process and its children (eg. simulation workers), sampled from /proc
+class ResourceSampler:
+    def __init__(self, pid: int, interval: float = 1.0) -> None:
+        self.pid = pid
+        self.interval = interval
+        self.cpu_percent: list[float] = []
+        self.rss_mb: list[float] = []
+        self.threads: list[int] = []
+        self.stopped = threading.Event()
+
+    def descendants(self) -> list[int]:
+        pids = [self.pid]
+        i = 0
+        while i < len(pids):
+            try:
+                with open(f"/proc/{pids[i]}/task/{pids[i]}/children") as f:
+                    pids.extend([int(p) for p in f.read().split()])
+            except OSError:
+                pass
+            i += 1
+        return pids
+
+    def sample(self) -> tuple[float, float, int]:
+        ticks, rss, threads = 0, 0.0, 0
+        for pid in self.descendants():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                ticks += int(fields[11]) + int(fields[12])  # utime and stime
+                threads += int(fields[17])
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            rss += int(line.split()[1]) / 1024
+            except (OSError, IndexError, ValueError):
+                pass  # exited in between
+        return ticks, rss, threads
+
+    def run(self):
+        last_ticks, _, _ = self.sample()
+        last_time = time.monotonic()
+        while not self.stopped.wait(self.interval):
+            ticks, rss, threads = self.sample()
+            now = time.monotonic()
+            self.cpu_percent.append(100 * (ticks - last_ticks) / CLOCK_TICKS / (now - last_time))
+            self.rss_mb.append(rss)
+            self.threads.append(threads)
+            last_ticks, last_time = ticks, now
+
+    def start(self):
+        if os.path.exists(f"/proc/{self.pid}/stat"):
+            threading.Thread(target=self.run, name="resource-sampler", daemon=True).start()
+        else:
+            print(f"Cannot read /proc/{self.pid}, not sampling the core's resource usage")
+
+    def summary(self) -> dict[str, float]:
+        return {
+            "cpu_percent_avg": sum(self.cpu_percent) / len(self.cpu_percent) if len(self.cpu_percent) > 0 else 0.0,
+            "cpu_percent_max": max(self.cpu_percent, default=0.0),
+            "rss_mb_max": max(self.rss_mb, default=0.0),
+            "rss_mb_end": self.rss_mb[-1] if len(self.rss_mb) > 0 else 0.0,
+            "threads_max": max(self.threads, default=0),
+        }
+
+
+class LoadTest:
+    def __init__(self, args, stub: marcom_core_pb2_grpc.MarcomServiceStub) -> None:
+        self.args = args
+        self.stub = stub
+        self.rpcs = RpcStats()
+        self.sim_ids = [args.first_id + i for i in range(args.simulations)]
+        self.requests = {sim_id: self.build_request(sim_id) for sim_id in self.sim_ids}
+        self.completed: set[int] = set()
+        self.paused: set[int] = set()
+        self.pauses: dict[int, int] = {sim_id: 0 for sim_id in self.sim_ids}  # times each simulation got paused, a stream ending after a pause is not dropped
+        self.lag_ms: list[float] = []
+        self.events = 0
+        self.dropped_streams = 0
+        self.streams: list[grpc.Call] = []  # open streams, cancelled when the test stops
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+
+    def build_request(self, sim_id: int) -> marcom_core_pb2.SimulationRequest:
+        return marcom_core_pb2.SimulationRequest(
+            id=sim_id,
+            env_desc="A small town with a weekend market",
+            total_cycles=self.args.cycles,
+            agents=[
+                marcom_core_pb2.Agent(
+                    id=i,
+                    name=f"Agent {i}",
+                    desc=f"A shopper who is {random.choice(['careful with money', 'into gadgets', 'a busy parent', 'a student'])}.",
+                    attrs=[
+                        marcom_core_pb2.AgentAttribute(key="age", value=str(random.randint(18, 70))),
+                        marcom_core_pb2.AgentAttribute(key="income", value=random.choice(["low", "middle", "high"])),
+                    ],
+                )
+                for i in range(1, self.args.agents + 1)
+            ],
+            products=[
+                marcom_core_pb2.Product(id=i, name=f"Product {i}", desc=f"Product number {i}", price=round(random.uniform(5, 200), 2), cost=2)
+                for i in range(1, self.args.products + 1)
+            ],
+        )
+
+    # calls the rpc and records how long it took, None when it failed
+    def call(self, rpc: str, method, request, **kwargs):
+        start = time.perf_counter()
+        try:
+            res = method(request, **kwargs)
+        except grpc.RpcError as e:
+            self.rpcs.record_error(rpc, e.code().name)
+            return None
+        self.rpcs.record(rpc, (time.perf_counter() - start) * 1000)
+        return res
+
+    # a subscriber keeps a stream open on its simulation until the simulation completes, streams end when the simulation is paused and are reopened once it is resumed
+    # a stream ending any other way (error or end without COMPLETE) is counted as dropped and reopened
+    def subscribe(self, sim_id: int):
+        while not self.stopping.is_set() and sim_id not in self.completed:
+            if sim_id in self.paused:
+                time.sleep(0.05)
+                continue
+            pauses = self.pauses[sim_id]
+            if self.args.batched:
+                stream = self.stub.StreamSimulationUpdatesBatched(marcom_core_pb2.BatchedStreamRequest(simulation_id=sim_id))
+            else:
+                stream = self.stub.StreamSimulationUpdates(marcom_core_pb2.StreamRequest(simulation_id=sim_id))
+            with self.lock:
+                self.streams.append(stream)
+            start = time.perf_counter()
+            first = True
+            failed = False
+            try:
+                for message in stream:
+                    if first:
+                        self.rpcs.record("StreamFirstMessage", (time.perf_counter() - start) * 1000)
+                        first = False
+                    for update in message.updates if self.args.batched else [message]:
+                        self.receive(update)
+            except grpc.RpcError as e:
+                if not self.stopping.is_set():
+                    self.rpcs.record_error("Stream", e.code().name)
+                failed = True
+            finally:
+                with self.lock:
+                    self.streams.remove(stream)
+            if not failed:
+                # another stream of the simulation may have got the COMPLETE, this one ends without it at about the same time
+                time.sleep(0.5)
+            if self.stopping.is_set() or (not failed and sim_id in self.completed) or self.pauses[sim_id] != pauses:
+                continue
+            with self.lock:
+                self.dropped_streams += 1
+            time.sleep(0.1)
+
+    def receive(self, update: marcom_core_pb2.SimulationUpdate):
+        now_ms = time.time() * 1000
+        with self.lock:
+            self.events += 1
+            if update.ready_at_ms > 0:
+                self.lag_ms.append(now_ms - update.ready_at_ms)
+            if update.action == "COMPLETE":
+                self.completed.add(update.simulation_id)
+
+    def pause_resume(self):
+        while not self.stopping.wait(self.args.pause_every):
+            running = [sim_id for sim_id in self.sim_ids if sim_id not in self.completed and sim_id not in self.paused]
+            if len(running) == 0:
+                continue
+            sim_id = random.choice(running)
+            with self.lock:
+                self.paused.add(sim_id)
+                self.pauses[sim_id] += 1
+            self.call("PauseSimulation", self.stub.PauseSimulation, marcom_core_pb2.PauseRequest(simulation_id=sim_id))
+            self.stopping.wait(self.args.pause_for)
+            self.call("StartSimulation(resume)", self.stub.StartSimulation, self.requests[sim_id])
+            with self.lock:
+                self.paused.discard(sim_id)
+
+    def research(self):
+        while not self.stopping.wait(self.args.research_every):
+            product = random.choice(self.requests[random.choice(self.sim_ids)].products)
+            self.call(
+                "ResearchProductCompetitor",
+                self.stub.ResearchProductCompetitor,
+                product,
+                timeout=self.args.research_timeout,
+            )
+
+    def poll_analytics(self):
+        while not self.stopping.wait(self.args.analytics_every):
+            self.call(
+                "GetSimulationAnalytics",
+                self.stub.GetSimulationAnalytics,
+                marcom_core_pb2.AnalyticsRequest(simulation_id=random.choice(self.sim_ids)),
+            )
+
+    def run(self) -> dict:
+        start = time.perf_counter()
+        for sim_id in self.sim_ids:
+            self.call("StartSimulation", self.stub.StartSimulation, self.requests[sim_id])
+        threads = [
+            threading.Thread(target=self.subscribe, args=(self.sim_ids[i % len(self.sim_ids)],), daemon=True)
+            for i in range(max(self.args.subscribers, len(self.sim_ids)))  # every simulation needs a stream to run
+        ]
+        if self.args.pause_every > 0:
+            threads.append(threading.Thread(target=self.pause_resume, daemon=True))
+        if self.args.research_every > 0:
+            threads.append(threading.Thread(target=self.research, daemon=True))
+        if self.args.analytics_every > 0:
+            threads.append(threading.Thread(target=self.poll_analytics, daemon=True))
+        for thread in threads:
+            thread.start()
+        while len(self.completed) < len(self.sim_ids) and time.perf_counter() - start < self.args.max_duration:
+            time.sleep(0.2)
+        elapsed = time.perf_counter() - start
+        self.stopping.set()
+        # whatever did not complete in time is paused so it stops using the core
+        for sim_id in self.sim_ids:
+            if sim_id not in self.completed:
+                self.call("PauseSimulation", self.stub.PauseSimulation, marcom_core_pb2.PauseRequest(simulation_id=sim_id))
+        with self.lock:
+            for stream in self.streams:
+                stream.cancel()
+        return {
+            "duration_s": elapsed,
+            "simulations_completed": len(self.completed),
+            "events": self.events,
+            "events_per_s": self.events / elapsed if elapsed > 0 else 0.0,
+            "dropped_streams": self.dropped_streams,
+            "delivery_lag_ms": summarize(self.lag_ms),
+            "rpc_latency_ms": self.rpcs.summary(),
+        }
+
+
+def git_version() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except OSError:
+        return ""
+
+
+# starts the fake model server and or the core for the test, stopped when the test ends
+def spawn(args, log_path: str) -> list[subprocess.Popen]:
+    here = os.path.dirname(os.path.abspath(__file__))
+    processes = []
+    env = dict(os.environ)
+    if args.fake_model:
+        processes.append(
+            subprocess.Popen(
+                [sys.executable, os.path.join(here, "fake_model_server.py"), "--port", str(args.fake_model_port),
+                 "--latency", str(args.model_latency), "--token-latency", str(args.model_token_latency)],
+                stdout=subprocess.DEVNULL,
+            )
+        )
+        env["LLM_ENDPOINTS"] = f"http://127.0.0.1:{args.fake_model_port}"
+    if args.spawn_core:
+        host, port = args.target.rsplit(":", 1)
+        env["GRPC_CONNECTION_HOST"] = host
+        env["GRPC_CONNECTION_PORT"] = port
+        env.setdefault("DB_FILE", os.path.join(tempfile.mkdtemp(prefix="marcom_loadtest_"), "loadtest.db"))
+        log = open(log_path, "w")
+        processes.append(subprocess.Popen([sys.executable, os.path.join(here, "main.py")], cwd=here, env=env, stdout=log, stderr=subprocess.STDOUT))
+    return processes
+
+
+def wait_until_ready(channel: grpc.Channel, stub: marcom_core_pb2_grpc.MarcomServiceStub, timeout: float) -> float:
+    start = time.perf_counter()
+    grpc.channel_ready_future(channel).result(timeout=timeout)
+    while time.perf_counter() - start < timeout:
+        try:
+            if stub.GetReadiness(marcom_core_pb2.ReadinessRequest(), timeout=5).ready:
+                break
+        except grpc.RpcError as e:
+            if e.code() == grpc.StatusCode.UNIMPLEMENTED:
+                break  # older core without readiness
+        time.sleep(0.2)
+    return time.perf_counter() - start
+
+
+def flatten(results: dict, prefix: str = "") -> dict[str, float]:
+    flat = {}
+    for k, v in results.items():
+        if isinstance(v, dict):
+            flat.update(flatten(v, f"{prefix}{k}."))
+        elif isinstance(v, (int, float)):
+            flat[f"{prefix}{k}"] = v
+    return flat
+
+
+def print_comparison(before: dict, after: dict):
+    old, new = flatten(before["results"]), flatten(after["results"])
+    print(f"\n{'metric':<60}{before['version'] or 'before':>14}{after['version'] or 'after':>14}{'change':>10}")
+    for key in sorted(set(old) | set(new)):
+        a, b = old.get(key), new.get(key)
+        change = f"{(b - a) / a * 100:+.0f}%" if a not in [None, 0] and b is not None else ""
+        print(f"{key:<60}{'' if a is None else f'{a:.1f}':>14}{'' if b is None else f'{b:.1f}':>14}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="grpc load test of the core")
+    parser.add_argument("--target", default=f"{os.getenv('GRPC_CONNECTION_HOST') or '127.0.0.1'}:{os.getenv('GRPC_CONNECTION_PORT') or 50051}")
+    parser.add_argument("--simulations", type=int, default=4)
+    parser.add_argument("--agents", type=int, default=10, help="roster size of every simulation")
+    parser.add_argument("--products", type=int, default=5, help="catalog size of every simulation")
+    parser.add_argument("--cycles", type=int, default=2)
+    parser.add_argument("--subscribers", type=int, default=0, help="streams spread over the simulations, at least one per simulation")
+    parser.add_argument("--batched", action="store_true", help="subscribe with StreamSimulationUpdatesBatched")
+    parser.add_argument("--pause-every", type=float, default=0, help="seconds between pausing a random simulation, 0 to never pause")
+    parser.add_argument("--pause-for", type=float, default=1.0, help="seconds a paused simulation stays paused")
+    parser.add_argument("--research-every", type=float, default=0, help="seconds between research calls, 0 for none")
+    parser.add_argument("--research-timeout", type=float, default=60)
+    parser.add_argument("--analytics-every", type=float, default=1.0, help="seconds between analytics polls, 0 for none")
+    parser.add_argument("--max-duration", type=float, default=600, help="seconds to wait for the simulations to complete")
+    parser.add_argument("--first-id", type=int, default=int(time.time()) % 1_000_000 * 1000, help="id of the first simulation, the rest follow")
+    parser.add_argument("--spawn-core", action="store_true", help="start the core (main.py) on --target with a fresh db for the test")
+    parser.add_argument("--core-pid", type=int, default=0, help="pid of an already running core to sample resource usage of")
+    parser.add_argument("--fake-model", action="store_true", help="start fake_model_server.py and point the spawned core to it")
+    parser.add_argument("--fake-model-port", type=int, default=11500)
+    parser.add_argument("--model-latency", type=float, default=0.2)
+    parser.add_argument("--model-token-latency", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated rosters and catalogs, same seed for runs that are compared")
+    parser.add_argument("--output-dir", default="loadtest_results")
+    parser.add_argument("--compare", default="", help="results json of an earlier run to compare with")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    name = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{git_version() or 'unknown'}"
+    processes = spawn(args, os.path.join(args.output_dir, f"{name}_core.log"))
+    channel = grpc.insecure_channel(args.target)
+    stub = marcom_core_pb2_grpc.MarcomServiceStub(channel)
+    try:
+        ready_s = wait_until_ready(channel, stub, timeout=600)
+        print(f"Core at {args.target} ready after {ready_s:.1f}s")
+        core_pid = processes[-1].pid if args.spawn_core else args.core_pid
+        sampler = ResourceSampler(core_pid) if core_pid > 0 else None
+        if sampler is not None:
+            sampler.start()
+        results = LoadTest(args, stub).run()
+        results["ready_s"] = ready_s
+        if sampler is not None:
+            sampler.stopped.set()
+            results["core_resources"] = sampler.summary()
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+    report = {
+        "name": name,
+        "version": git_version(),
+        "time": datetime.now().isoformat(),
+        "config": vars(args),
+        "results": results,
+    }
+    path = os.path.join(args.output_dir, f"{name}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"Results saved to {path}")
+    if args.compare != "":
+        with open(args.compare) as f:
+            print_comparison(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
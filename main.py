@@ -1,4 +1,4 @@
-from concurrent import futures
+import asyncio
 import logging
 import os
 
@@ -9,17 +9,18 @@ from product import Product
 from simulation import Simulation
 from dotenv import load_dotenv
 from proto import marcom_core_pb2_grpc
+from warmup import get_model_residency
 
 from db import *
 
 def main():
     # configure environment variables
     load_dotenv()
-    print(f"Env loaded: DB_FILE={os.getenv('DB_FILE')};")
+    print(f"Env loaded: DB_FILE={os.getenv('DB_FILE')}; DB_SHARDING={os.getenv('DB_SHARDING')};")
 
     # initialize the db
     db.connect()
-    db.create_tables([AgentInfo, AgentMemory, SimulationEvent])
+    migrate_db(SHARDED_TABLES + [SimulationShard, ResearchReport])  # simulation tables in the catalog are used when sharding is off
     print(f"Database initialized")
 
     # start grpc server
@@ -27,12 +28,19 @@ def main():
     init_core_servicer()
 
 def init_core_servicer():
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    marcom_core_pb2_grpc.add_MarcomServiceServicer_to_server(MarcomCoreServicer(), server)
+    asyncio.run(serve())
+
+# asyncio server, open streams only cost a coroutine while they wait, blocking work runs on the servicer's executors
+async def serve():
+    server = grpc.aio.server()
+    servicer = MarcomCoreServicer()
+    marcom_core_pb2_grpc.add_MarcomServiceServicer_to_server(servicer, server)
     server.add_insecure_port(f"{os.getenv('GRPC_CONNECTION_HOST')}:{os.getenv('GRPC_CONNECTION_PORT')}")
     print(f"Connecting to {os.getenv('GRPC_CONNECTION_HOST')}:{os.getenv('GRPC_CONNECTION_PORT')}")
-    server.start()
-    server.wait_for_termination()
+    await server.start()
+    # models load in the background, GetReadiness tells when they are done
+    get_model_residency().start(servicer.has_active_simulations)
+    await server.wait_for_termination()
 
 if __name__ == "__main__":
     main()
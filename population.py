@@ -0,0 +1,174 @@
+# population mode, clusters agents into archetypes so only a few agents per archetype needs the LLM to decide every cycle
+# the rest of the archetype follows the decisions of the agents most similar to them
+import math
+import re
+import zlib
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from agent import Agent
+
+if TYPE_CHECKING:
+    from simulation import ActionOutcome
+
+DESC_BUCKETS = 256  # hashed bag of words size for descriptions
+DESC_WEIGHT = 0.5  # attributes are more telling than free text descriptions
+KMEANS_ITERATIONS = 25
+FOLLOW_TEMPERATURE = 0.1  # lower means members follow the most similar decider more strictly
+
+
+def featurize(agents: list[Agent], descs: list[str]) -> np.ndarray:
+    n = len(agents)
+    # one hot of every key=value pair of the attributes
+    vocab: dict[str, int] = {}
+    rows, cols = [], []
+    for i, agent in enumerate(agents):
+        for attr in agent.attrs:
+            token = f"{attr.key.strip().lower()}={attr.value.strip().lower()}"
+            rows.append(i)
+            cols.append(vocab.setdefault(token, len(vocab)))
+    attr_features = np.zeros((n, max(len(vocab), 1)))
+    attr_features[np.array(rows, dtype=int), np.array(cols, dtype=int)] = 1.0
+    # hashed bag of words of the description (crc32 so it is stable across restarts unlike hash())
+    rows, cols = [], []
+    for i, desc in enumerate(descs):
+        for word in re.findall(r"[a-z0-9]+", desc.lower()):
+            rows.append(i)
+            cols.append(zlib.crc32(word.encode()) % DESC_BUCKETS)
+    desc_features = np.zeros((n, DESC_BUCKETS))
+    np.add.at(desc_features, (np.array(rows, dtype=int), np.array(cols, dtype=int)), 1.0)
+    features = np.hstack(
+        [normalize_rows(attr_features), DESC_WEIGHT * normalize_rows(desc_features)]
+    )
+    return normalize_rows(features)
+
+
+def normalize_rows(x: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / np.where(norms == 0, 1.0, norms)
+
+
+# squared euclidean distance of every row of x to every row of c without materialising n*k*features
+def squared_distances(x: np.ndarray, c: np.ndarray) -> np.ndarray:
+    d = (x * x).sum(1)[:, None] - 2 * x @ c.T + (c * c).sum(1)[None, :]
+    return np.maximum(d, 0.0)
+
+
+# k-means with k-means++ init, returns (labels, centroids)
+def kmeans(
+    x: np.ndarray, k: int, rng: np.random.Generator, iterations: int = KMEANS_ITERATIONS
+) -> tuple[np.ndarray, np.ndarray]:
+    n = x.shape[0]
+    centroids = np.empty((k, x.shape[1]))
+    centroids[0] = x[rng.integers(n)]
+    closest = squared_distances(x, centroids[:1])[:, 0]
+    for i in range(1, k):
+        total = closest.sum()
+        idx = rng.choice(n, p=closest / total) if total > 0 else rng.integers(n)
+        centroids[i] = x[idx]
+        closest = np.minimum(closest, squared_distances(x, centroids[i : i + 1])[:, 0])
+    labels = np.zeros(n, dtype=int)
+    for _ in range(iterations):
+        distances = squared_distances(x, centroids)
+        new_labels = distances.argmin(1)
+        counts = np.bincount(new_labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, new_labels, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty][:, None]
+        # reseed empty clusters with the points furthest from their centroid
+        if empty.any():
+            furthest = distances[np.arange(n), new_labels].argsort()[::-1]
+            centroids[empty] = x[furthest[: empty.sum()]]
+        if np.array_equal(new_labels, labels) and not empty.any():
+            break
+        labels = new_labels
+    return labels, centroids
+
+
+class Archetype:
+    def __init__(self, id: int, members: list[Agent], representative: Agent) -> None:
+        self.id = id
+        self.members = members
+        self.representative = representative
+
+
+class Population:
+    def __init__(
+        self,
+        agents: list[Agent],
+        descs: list[str],
+        num_archetypes: int = None,
+        sample_fraction: float = 0.1,
+        seed: int = None,
+    ) -> None:
+        self.agents = agents
+        self.sample_fraction = sample_fraction
+        self.rng = np.random.default_rng(seed)
+        self.features = featurize(agents, descs)
+        k = num_archetypes if num_archetypes is not None else math.ceil(math.sqrt(len(agents)))
+        k = max(1, min(k, len(agents)))
+        labels, centroids = kmeans(self.features, k, self.rng)
+        # representative is the member closest to the centroid
+        distances = squared_distances(self.features, centroids)
+        self.archetypes: list[Archetype] = []
+        self.agent_archetype: dict[int, Archetype] = {}  # agent id -> archetype
+        self.agent_index: dict[int, int] = {}  # agent id -> row in features
+        for i, agent in enumerate(agents):
+            self.agent_index[int(agent.id)] = i
+        for c in range(k):
+            member_idx = np.flatnonzero(labels == c)
+            if len(member_idx) == 0:
+                continue
+            rep_idx = member_idx[distances[member_idx, c].argmin()]
+            archetype = Archetype(
+                id=len(self.archetypes) + 1,
+                members=[agents[i] for i in member_idx],
+                representative=agents[rep_idx],
+            )
+            self.archetypes.append(archetype)
+            for agent in archetype.members:
+                self.agent_archetype[int(agent.id)] = archetype
+
+    def get_archetype(self, agent: Agent) -> Archetype:
+        return self.agent_archetype[int(agent.id)]
+
+    def get_representatives(self) -> list[Agent]:
+        return [archetype.representative for archetype in self.archetypes]
+
+    # representatives always decide, plus a random sample of each archetype so the archetype is not just one agent's opinion
+    def pick_deciders(self) -> list[Agent]:
+        deciders = []
+        for archetype in self.archetypes:
+            sampled = self.rng.random(len(archetype.members)) < self.sample_fraction
+            for agent, is_sampled in zip(archetype.members, sampled):
+                if agent is archetype.representative or is_sampled:
+                    deciders.append(agent)
+        return deciders
+
+    # pairs every agent that did not decide with an outcome of a decider of its archetype
+    # deciders more similar to the member are more likely to be followed
+    def expand(self, outcomes: list["ActionOutcome"]) -> list[tuple[Agent, "ActionOutcome"]]:
+        by_archetype: dict[int, list["ActionOutcome"]] = {}
+        for outcome in outcomes:
+            by_archetype.setdefault(self.get_archetype(outcome.agent).id, []).append(outcome)
+        decided = set([int(outcome.agent.id) for outcome in outcomes])
+        expanded = []
+        for archetype in self.archetypes:
+            archetype_outcomes = by_archetype.get(archetype.id, [])
+            followers = [a for a in archetype.members if int(a.id) not in decided]
+            if len(archetype_outcomes) == 0 or len(followers) == 0:
+                continue
+            follower_features = self.features[[self.agent_index[int(a.id)] for a in followers]]
+            decider_features = self.features[
+                [self.agent_index[int(o.agent.id)] for o in archetype_outcomes]
+            ]
+            similarity = follower_features @ decider_features.T
+            weights = np.exp((similarity - similarity.max(1, keepdims=True)) / FOLLOW_TEMPERATURE)
+            cumulative = np.cumsum(weights / weights.sum(1, keepdims=True), axis=1)
+            picks = (cumulative < self.rng.random(len(followers))[:, None]).sum(1)
+            picks = np.minimum(picks, len(archetype_outcomes) - 1)  # float rounding of the last cumulative value
+            for follower, pick in zip(followers, picks):
+                expanded.append((follower, archetype_outcomes[pick]))
+        return expanded
@@ -1,4 +1,6 @@
 class Product:
+    __slots__ = ("id", "name", "desc", "price", "cost", "simulation_id")  # no per instance dict, simulations can have a lot of products
+
     def __init__(
         self,
         id: int,
@@ -14,7 +14,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x17proto/marcom_core.proto\x12\rMarcomService\",\n\x0e\x41gentAttribute\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\t\"]\n\x05\x41gent\x12\n\n\x02id\x18\x01 \x01(\x05\x12\x0c\n\x04name\x18\x02 \x01(\t\x12\x0c\n\x04\x64\x65sc\x18\x03 \x01(\t\x12,\n\x05\x61ttrs\x18\x04 \x03(\x0b\x32\x1d.MarcomService.AgentAttribute\"N\n\x07Product\x12\n\n\x02id\x18\x01 \x01(\x05\x12\x0c\n\x04name\x18\x02 \x01(\t\x12\x0c\n\x04\x64\x65sc\x18\x03 \x01(\t\x12\r\n\x05price\x18\x04 \x01(\x02\x12\x0c\n\x04\x63ost\x18\x05 \x01(\x02\":\n\x19ProductCompetitorResponse\x12\r\n\x05query\x18\x01 \x01(\t\x12\x0e\n\x06report\x18\x02 \x01(\t\"\x97\x01\n\x11SimulationRequest\x12\n\n\x02id\x18\x01 \x01(\x05\x12\x10\n\x08\x65nv_desc\x18\x02 \x01(\t\x12$\n\x06\x61gents\x18\x03 \x03(\x0b\x32\x14.MarcomService.Agent\x12(\n\x08products\x18\x04 \x03(\x0b\x32\x16.MarcomService.Product\x12\x14\n\x0ctotal_cycles\x18\x05 \x01(\x05\"%\n\x12SimulationResponse\x12\x0f\n\x07message\x18\x01 \x01(\t\"%\n\x0cPauseRequest\x12\x15\n\rsimulation_id\x18\x01 \x01(\x05\" \n\rPauseResponse\x12\x0f\n\x07message\x18\x01 \x01(\t\"&\n\rStreamRequest\x12\x15\n\rsimulation_id\x18\x01 \x01(\x05\"k\n\x10SimulationUpdate\x12\x10\n\x08\x61gent_id\x18\x01 \x01(\x05\x12\x0e\n\x06\x61\x63tion\x18\x02 \x01(\t\x12\x0f\n\x07\x63ontent\x18\x03 \x01(\t\x12\r\n\x05\x63ycle\x18\x04 \x01(\x05\x12\x15\n\rsimulation_id\x18\x05 \x01(\x05\x32\xf0\x02\n\rMarcomService\x12V\n\x0fStartSimulation\x12 .MarcomService.SimulationRequest\x1a!.MarcomService.SimulationResponse\x12L\n\x0fPauseSimulation\x12\x1b.MarcomService.PauseRequest\x1a\x1c.MarcomService.PauseResponse\x12Z\n\x17StreamSimulationUpdates\x12\x1c.MarcomService.StreamRequest\x1a\x1f.MarcomService.SimulationUpdate0\x01\x12]\n\x19ResearchProductCompetitor\x12\x16.MarcomService.Product\x1a(.MarcomService.ProductCompetitorResponseB\tZ\x07./protob\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x17proto/marcom_core.proto\x12\rMarcomService\",\n\x0e\x41gentAttribute\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\t\"t\n\x05\x41gent\x12\n\n\x02id\x18\x01 \x01(\x05\x12\x0c\n\x04name\x18\x02 \x01(\t\x12\x0c\n\x04\x64\x65sc\x18\x03 \x01(\t\x12,\n\x05\x61ttrs\x18\x04 \x03(\x0b\x32\x1d.MarcomService.AgentAttribute\x12\x15\n\rneighbour_ids\x18\x05 \x03(\x05\"N\n\x07Product\x12\n\n\x02id\x18\x01 \x01(\x05\x12\x0c\n\x04name\x18\x02 \x01(\t\x12\x0c\n\x04\x64\x65sc\x18\x03 \x01(\t\x12\r\n\x05price\x18\x04 \x01(\x02\x12\x0c\n\x04\x63ost\x18\x05 \x01(\x02\"\xb4\x01\n\x19ProductCompetitorResponse\x12\r\n\x05query\x18\x01 \x01(\t\x12\x0e\n\x06report\x18\x02 \x01(\t\x12\x0e\n\x06\x63\x61\x63hed\x18\x03 \x01(\x08\x12\x19\n\x11source_product_id\x18\x04 \x01(\x05\x12\x1b\n\x13source_product_name\x18\x05 \x01(\t\x12\x12\n\nsimilarity\x18\x06 \x01(\x02\x12\x1c\n\x14source_created_at_ms\x18\x07 \x01(\x03\"\x97\x01\n\x11SimulationRequest\x12\n\n\x02id\x18\x01 \x01(\x05\x12\x10\n\x08\x65nv_desc\x18\x02 \x01(\t\x12$\n\x06\x61gents\x18\x03 \x03(\x0b\x32\x14.MarcomService.Agent\x12(\n\x08products\x18\x04 \x03(\x0b\x32\x16.MarcomService.Product\x12\x14\n\x0ctotal_cycles\x18\x05 \x01(\x05\"%\n\x12SimulationResponse\x12\x0f\n\x07message\x18\x01 \x01(\t\"%\n\x0cPauseRequest\x12\x15\n\rsimulation_id\x18\x01 \x01(\x05\" \n\rPauseResponse\x12\x0f\n\x07message\x18\x01 \x01(\t\"&\n\rStreamRequest\x12\x15\n\rsimulation_id\x18\x01 \x01(\x05\"\x80\x01\n\x10SimulationUpdate\x12\x10\n\x08\x61gent_id\x18\x01 \x01(\x05\x12\x0e\n\x06\x61\x63tion\x18\x02 \x01(\t\x12\x0f\n\x07\x63ontent\x18\x03 \x01(\t\x12\r\n\x05\x63ycle\x18\x04 \x01(\x05\x12\x15\n\rsimulation_id\x18\x05 \x01(\x05\x12\x13\n\x0bready_at_ms\x18\x06 \x01(\x03\"z\n\x14\x42\x61tchedStreamRequest\x12\x15\n\rsimulation_id\x18\x01 \x01(\x05\x12\x13\n\x0bmax_updates\x18\x02 \x01(\x05\x12\x11\n\tmax_bytes\x18\x03 \x01(\x05\x12\x11\n\tlinger_ms\x18\x04 \x01(\x05\x12\x10\n\x08\x63ompress\x18\x05 \x01(\x08\"I\n\x15SimulationUpdateBatch\x12\x30\n\x07updates\x18\x01 \x03(\x0b\x32\x1f.MarcomService.SimulationUpdate\"8\n\x10\x41nalyticsRequest\x12\x15\n\rsimulation_id\x18\x01 \x01(\x05\x12\r\n\x05\x63ycle\x18\x02 \x01(\x05\"Z\n\x10ProductAnalytics\x12\x12\n\nproduct_id\x18\x01 \x01(\x05\x12\x11\n\tpurchases\x18\x02 \x01(\x05\x12\x0f\n\x07revenue\x18\x03 \x01(\x01\x12\x0e\n\x06margin\x18\x04 \x01(\x01\"\xec\x01\n\x13SimulationAnalytics\x12\x15\n\rsimulation_id\x18\x01 \x01(\x05\x12\r\n\x05\x63ycle\x18\x02 \x01(\x05\x12\x14\n\x0clatest_cycle\x18\x03 \x01(\x05\x12\x11\n\tdecisions\x18\x04 \x01(\x05\x12\r\n\x05skips\x18\x05 \x01(\x05\x12\x11\n\tskip_rate\x18\x06 \x01(\x01\x12\x10\n\x08messages\x18\x07 \x01(\x05\x12\x0f\n\x07revenue\x18\x08 \x01(\x01\x12\x0e\n\x06margin\x18\t \x01(\x01\x12\x31\n\x08products\x18\n \x03(\x0b\x32\x1f.MarcomService.ProductAnalytics\"u\n\rExportRequest\x12\x15\n\rsimulation_id\x18\x01 \x01(\x05\x12\x12\n\nfrom_cycle\x18\x02 \x01(\x05\x12\x10\n\x08to_cycle\x18\x03 \x01(\x05\x12\x12\n\nchunk_size\x18\x04 \x01(\x05\x12\x13\n\x0b\x65vents_only\x18\x05 \x01(\x08\"P\n\x0b\x45xportChunk\x12\r\n\x05table\x18\x01 \x01(\t\x12\x11\n\tarrow_ipc\x18\x02 \x01(\x0c\x12\x0c\n\x04rows\x18\x03 \x01(\x05\x12\x11\n\tmax_cycle\x18\x04 \x01(\x05\"j\n\x0b\x46orkRequest\x12\x11\n\tparent_id\x18\x01 \x01(\x05\x12\x12\n\nfork_cycle\x18\x02 \x01(\x05\x12\x34\n\nsimulation\x18\x03 \x01(\x0b\x32 .MarcomService.SimulationRequest\"r\n\x0cSweepRequest\x12.\n\x04\x62\x61se\x18\x01 \x01(\x0b\x32 .MarcomService.SimulationRequest\x12\x32\n\x08variants\x18\x02 \x03(\x0b\x32 .MarcomService.SimulationRequest\"\xc3\x01\n\x0bSweepUpdate\x12/\n\x06update\x18\x01 \x01(\x0b\x32\x1f.MarcomService.SimulationUpdate\x12\r\n\x05\x63ycle\x18\x02 \x01(\x05\x12\x39\n\rcycle_results\x18\x03 \x03(\x0b\x32\".MarcomService.SimulationAnalytics\x12\x39\n\rtotal_results\x18\x04 \x03(\x0b\x32\".MarcomService.SimulationAnalytics\"\x12\n\x10ReadinessRequest\"d\n\x0eModelReadiness\x12\x0e\n\x06server\x18\x01 \x01(\t\x12\r\n\x05model\x18\x02 \x01(\t\x12\x0e\n\x06loaded\x18\x03 \x01(\x08\x12\x14\n\x0cload_seconds\x18\x04 \x01(\x02\x12\r\n\x05\x65rror\x18\x05 \x01(\t\"b\n\x11ReadinessResponse\x12\r\n\x05ready\x18\x01 \x01(\x08\x12\x0f\n\x07message\x18\x02 \x01(\t\x12-\n\x06models\x18\x03 \x03(\x0b\x32\x1d.MarcomService.ModelReadiness\"\x89\x01\n\x17UpdateSimulationRequest\x12\x15\n\rsimulation_id\x18\x01 \x01(\x05\x12(\n\x08products\x18\x02 \x03(\x0b\x32\x16.MarcomService.Product\x12\x1b\n\x13removed_product_ids\x18\x03 \x03(\x05\x12\x10\n\x08\x65nv_desc\x18\x04 \x01(\t\">\n\x18UpdateSimulationResponse\x12\x0f\n\x07message\x18\x01 \x01(\t\x12\x11\n\tupdate_id\x18\x02 \x01(\t\"B\n\x15\x44ropSimulationRequest\x12\x15\n\rsimulation_id\x18\x01 \x01(\x05\x12\x12\n\nwith_forks\x18\x02 \x01(\x08\">\n\x16\x44ropSimulationResponse\x12\x0f\n\x07message\x18\x01 \x01(\t\x12\x13\n\x0b\x64ropped_ids\x18\x02 \x03(\x05\x32\xc4\x08\n\rMarcomService\x12V\n\x0fStartSimulation\x12 .MarcomService.SimulationRequest\x1a!.MarcomService.SimulationResponse\x12L\n\x0fPauseSimulation\x12\x1b.MarcomService.PauseRequest\x1a\x1c.MarcomService.PauseResponse\x12Z\n\x17StreamSimulationUpdates\x12\x1c.MarcomService.StreamRequest\x1a\x1f.MarcomService.SimulationUpdate0\x01\x12m\n\x1eStreamSimulationUpdatesBatched\x12#.MarcomService.BatchedStreamRequest\x1a$.MarcomService.SimulationUpdateBatch0\x01\x12]\n\x19ResearchProductCompetitor\x12\x16.MarcomService.Product\x1a(.MarcomService.ProductCompetitorResponse\x12]\n\x16GetSimulationAnalytics\x12\x1f.MarcomService.AnalyticsRequest\x1a\".MarcomService.SimulationAnalytics\x12U\n\x17\x45xportSimulationHistory\x12\x1c.MarcomService.ExportRequest\x1a\x1a.MarcomService.ExportChunk0\x01\x12O\n\x0e\x46orkSimulation\x12\x1a.MarcomService.ForkRequest\x1a!.MarcomService.SimulationResponse\x12\x45\n\x08RunSweep\x12\x1b.MarcomService.SweepRequest\x1a\x1a.MarcomService.SweepUpdate0\x01\x12Q\n\x0cGetReadiness\x12\x1f.MarcomService.ReadinessRequest\x1a .MarcomService.ReadinessResponse\x12\x63\n\x10UpdateSimulation\x12&.MarcomService.UpdateSimulationRequest\x1a\'.MarcomService.UpdateSimulationResponse\x12]\n\x0e\x44ropSimulation\x12$.MarcomService.DropSimulationRequest\x1a%.MarcomService.DropSimulationResponseB\tZ\x07./protob\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
@@ -25,23 +25,57 @@ if not _descriptor._USE_C_DESCRIPTORS:
   _globals['_AGENTATTRIBUTE']._serialized_start=42
   _globals['_AGENTATTRIBUTE']._serialized_end=86
   _globals['_AGENT']._serialized_start=88
-  _globals['_AGENT']._serialized_end=181
-  _globals['_PRODUCT']._serialized_start=183
-  _globals['_PRODUCT']._serialized_end=261
-  _globals['_PRODUCTCOMPETITORRESPONSE']._serialized_start=263
-  _globals['_PRODUCTCOMPETITORRESPONSE']._serialized_end=321
-  _globals['_SIMULATIONREQUEST']._serialized_start=324
-  _globals['_SIMULATIONREQUEST']._serialized_end=475
-  _globals['_SIMULATIONRESPONSE']._serialized_start=477
-  _globals['_SIMULATIONRESPONSE']._serialized_end=514
-  _globals['_PAUSEREQUEST']._serialized_start=516
-  _globals['_PAUSEREQUEST']._serialized_end=553
-  _globals['_PAUSERESPONSE']._serialized_start=555
-  _globals['_PAUSERESPONSE']._serialized_end=587
-  _globals['_STREAMREQUEST']._serialized_start=589
-  _globals['_STREAMREQUEST']._serialized_end=627
-  _globals['_SIMULATIONUPDATE']._serialized_start=629
-  _globals['_SIMULATIONUPDATE']._serialized_end=736
-  _globals['_MARCOMSERVICE']._serialized_start=739
-  _globals['_MARCOMSERVICE']._serialized_end=1107
+  _globals['_AGENT']._serialized_end=204
+  _globals['_PRODUCT']._serialized_start=206
+  _globals['_PRODUCT']._serialized_end=284
+  _globals['_PRODUCTCOMPETITORRESPONSE']._serialized_start=287
+  _globals['_PRODUCTCOMPETITORRESPONSE']._serialized_end=467
+  _globals['_SIMULATIONREQUEST']._serialized_start=470
+  _globals['_SIMULATIONREQUEST']._serialized_end=621
+  _globals['_SIMULATIONRESPONSE']._serialized_start=623
+  _globals['_SIMULATIONRESPONSE']._serialized_end=660
+  _globals['_PAUSEREQUEST']._serialized_start=662
+  _globals['_PAUSEREQUEST']._serialized_end=699
+  _globals['_PAUSERESPONSE']._serialized_start=701
+  _globals['_PAUSERESPONSE']._serialized_end=733
+  _globals['_STREAMREQUEST']._serialized_start=735
+  _globals['_STREAMREQUEST']._serialized_end=773
+  _globals['_SIMULATIONUPDATE']._serialized_start=776
+  _globals['_SIMULATIONUPDATE']._serialized_end=904
+  _globals['_BATCHEDSTREAMREQUEST']._serialized_start=906
+  _globals['_BATCHEDSTREAMREQUEST']._serialized_end=1028
+  _globals['_SIMULATIONUPDATEBATCH']._serialized_start=1030
+  _globals['_SIMULATIONUPDATEBATCH']._serialized_end=1103
+  _globals['_ANALYTICSREQUEST']._serialized_start=1105
+  _globals['_ANALYTICSREQUEST']._serialized_end=1161
+  _globals['_PRODUCTANALYTICS']._serialized_start=1163
+  _globals['_PRODUCTANALYTICS']._serialized_end=1253
+  _globals['_SIMULATIONANALYTICS']._serialized_start=1256
+  _globals['_SIMULATIONANALYTICS']._serialized_end=1492
+  _globals['_EXPORTREQUEST']._serialized_start=1494
+  _globals['_EXPORTREQUEST']._serialized_end=1611
+  _globals['_EXPORTCHUNK']._serialized_start=1613
+  _globals['_EXPORTCHUNK']._serialized_end=1693
+  _globals['_FORKREQUEST']._serialized_start=1695
+  _globals['_FORKREQUEST']._serialized_end=1801
+  _globals['_SWEEPREQUEST']._serialized_start=1803
+  _globals['_SWEEPREQUEST']._serialized_end=1917
+  _globals['_SWEEPUPDATE']._serialized_start=1920
+  _globals['_SWEEPUPDATE']._serialized_end=2115
+  _globals['_READINESSREQUEST']._serialized_start=2117
+  _globals['_READINESSREQUEST']._serialized_end=2135
+  _globals['_MODELREADINESS']._serialized_start=2137
+  _globals['_MODELREADINESS']._serialized_end=2237
+  _globals['_READINESSRESPONSE']._serialized_start=2239
+  _globals['_READINESSRESPONSE']._serialized_end=2337
+  _globals['_UPDATESIMULATIONREQUEST']._serialized_start=2340
+  _globals['_UPDATESIMULATIONREQUEST']._serialized_end=2477
+  _globals['_UPDATESIMULATIONRESPONSE']._serialized_start=2479
+  _globals['_UPDATESIMULATIONRESPONSE']._serialized_end=2541
+  _globals['_DROPSIMULATIONREQUEST']._serialized_start=2543
+  _globals['_DROPSIMULATIONREQUEST']._serialized_end=2609
+  _globals['_DROPSIMULATIONRESPONSE']._serialized_start=2611
+  _globals['_DROPSIMULATIONRESPONSE']._serialized_end=2673
+  _globals['_MARCOMSERVICE']._serialized_start=2676
+  _globals['_MARCOMSERVICE']._serialized_end=3768
 # @@protoc_insertion_point(module_scope)
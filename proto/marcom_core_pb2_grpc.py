@@ -54,11 +54,51 @@ class MarcomServiceStub(object):
                 request_serializer=proto_dot_marcom__core__pb2.StreamRequest.SerializeToString,
                 response_deserializer=proto_dot_marcom__core__pb2.SimulationUpdate.FromString,
                 _registered_method=True)
+        self.StreamSimulationUpdatesBatched = channel.unary_stream(
+                '/MarcomService.MarcomService/StreamSimulationUpdatesBatched',
+                request_serializer=proto_dot_marcom__core__pb2.BatchedStreamRequest.SerializeToString,
+                response_deserializer=proto_dot_marcom__core__pb2.SimulationUpdateBatch.FromString,
+                _registered_method=True)
         self.ResearchProductCompetitor = channel.unary_unary(
                 '/MarcomService.MarcomService/ResearchProductCompetitor',
                 request_serializer=proto_dot_marcom__core__pb2.Product.SerializeToString,
                 response_deserializer=proto_dot_marcom__core__pb2.ProductCompetitorResponse.FromString,
                 _registered_method=True)
+        self.GetSimulationAnalytics = channel.unary_unary(
+                '/MarcomService.MarcomService/GetSimulationAnalytics',
+                request_serializer=proto_dot_marcom__core__pb2.AnalyticsRequest.SerializeToString,
+                response_deserializer=proto_dot_marcom__core__pb2.SimulationAnalytics.FromString,
+                _registered_method=True)
+        self.ExportSimulationHistory = channel.unary_stream(
+                '/MarcomService.MarcomService/ExportSimulationHistory',
+                request_serializer=proto_dot_marcom__core__pb2.ExportRequest.SerializeToString,
+                response_deserializer=proto_dot_marcom__core__pb2.ExportChunk.FromString,
+                _registered_method=True)
+        self.ForkSimulation = channel.unary_unary(
+                '/MarcomService.MarcomService/ForkSimulation',
+                request_serializer=proto_dot_marcom__core__pb2.ForkRequest.SerializeToString,
+                response_deserializer=proto_dot_marcom__core__pb2.SimulationResponse.FromString,
+                _registered_method=True)
+        self.RunSweep = channel.unary_stream(
+                '/MarcomService.MarcomService/RunSweep',
+                request_serializer=proto_dot_marcom__core__pb2.SweepRequest.SerializeToString,
+                response_deserializer=proto_dot_marcom__core__pb2.SweepUpdate.FromString,
+                _registered_method=True)
+        self.GetReadiness = channel.unary_unary(
+                '/MarcomService.MarcomService/GetReadiness',
+                request_serializer=proto_dot_marcom__core__pb2.ReadinessRequest.SerializeToString,
+                response_deserializer=proto_dot_marcom__core__pb2.ReadinessResponse.FromString,
+                _registered_method=True)
+        self.UpdateSimulation = channel.unary_unary(
+                '/MarcomService.MarcomService/UpdateSimulation',
+                request_serializer=proto_dot_marcom__core__pb2.UpdateSimulationRequest.SerializeToString,
+                response_deserializer=proto_dot_marcom__core__pb2.UpdateSimulationResponse.FromString,
+                _registered_method=True)
+        self.DropSimulation = channel.unary_unary(
+                '/MarcomService.MarcomService/DropSimulation',
+                request_serializer=proto_dot_marcom__core__pb2.DropSimulationRequest.SerializeToString,
+                response_deserializer=proto_dot_marcom__core__pb2.DropSimulationResponse.FromString,
+                _registered_method=True)
 
 
 class MarcomServiceServicer(object):
@@ -82,12 +122,60 @@ class MarcomServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def StreamSimulationUpdatesBatched(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def ResearchProductCompetitor(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def GetSimulationAnalytics(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def ExportSimulationHistory(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def ForkSimulation(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def RunSweep(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def GetReadiness(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def UpdateSimulation(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def DropSimulation(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_MarcomServiceServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -106,11 +194,51 @@ def add_MarcomServiceServicer_to_server(servicer, server):
                     request_deserializer=proto_dot_marcom__core__pb2.StreamRequest.FromString,
                     response_serializer=proto_dot_marcom__core__pb2.SimulationUpdate.SerializeToString,
             ),
+            'StreamSimulationUpdatesBatched': grpc.unary_stream_rpc_method_handler(
+                    servicer.StreamSimulationUpdatesBatched,
+                    request_deserializer=proto_dot_marcom__core__pb2.BatchedStreamRequest.FromString,
+                    response_serializer=proto_dot_marcom__core__pb2.SimulationUpdateBatch.SerializeToString,
+            ),
             'ResearchProductCompetitor': grpc.unary_unary_rpc_method_handler(
                     servicer.ResearchProductCompetitor,
                     request_deserializer=proto_dot_marcom__core__pb2.Product.FromString,
                     response_serializer=proto_dot_marcom__core__pb2.ProductCompetitorResponse.SerializeToString,
             ),
+            'GetSimulationAnalytics': grpc.unary_unary_rpc_method_handler(
+                    servicer.GetSimulationAnalytics,
+                    request_deserializer=proto_dot_marcom__core__pb2.AnalyticsRequest.FromString,
+                    response_serializer=proto_dot_marcom__core__pb2.SimulationAnalytics.SerializeToString,
+            ),
+            'ExportSimulationHistory': grpc.unary_stream_rpc_method_handler(
+                    servicer.ExportSimulationHistory,
+                    request_deserializer=proto_dot_marcom__core__pb2.ExportRequest.FromString,
+                    response_serializer=proto_dot_marcom__core__pb2.ExportChunk.SerializeToString,
+            ),
+            'ForkSimulation': grpc.unary_unary_rpc_method_handler(
+                    servicer.ForkSimulation,
+                    request_deserializer=proto_dot_marcom__core__pb2.ForkRequest.FromString,
+                    response_serializer=proto_dot_marcom__core__pb2.SimulationResponse.SerializeToString,
+            ),
+            'RunSweep': grpc.unary_stream_rpc_method_handler(
+                    servicer.RunSweep,
+                    request_deserializer=proto_dot_marcom__core__pb2.SweepRequest.FromString,
+                    response_serializer=proto_dot_marcom__core__pb2.SweepUpdate.SerializeToString,
+            ),
+            'GetReadiness': grpc.unary_unary_rpc_method_handler(
+                    servicer.GetReadiness,
+                    request_deserializer=proto_dot_marcom__core__pb2.ReadinessRequest.FromString,
+                    response_serializer=proto_dot_marcom__core__pb2.ReadinessResponse.SerializeToString,
+            ),
+            'UpdateSimulation': grpc.unary_unary_rpc_method_handler(
+                    servicer.UpdateSimulation,
+                    request_deserializer=proto_dot_marcom__core__pb2.UpdateSimulationRequest.FromString,
+                    response_serializer=proto_dot_marcom__core__pb2.UpdateSimulationResponse.SerializeToString,
+            ),
+            'DropSimulation': grpc.unary_unary_rpc_method_handler(
+                    servicer.DropSimulation,
+                    request_deserializer=proto_dot_marcom__core__pb2.DropSimulationRequest.FromString,
+                    response_serializer=proto_dot_marcom__core__pb2.DropSimulationResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'MarcomService.MarcomService', rpc_method_handlers)
@@ -203,6 +331,33 @@ class MarcomService(object):
             metadata,
             _registered_method=True)
 
+    @staticmethod
+    def StreamSimulationUpdatesBatched(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/MarcomService.MarcomService/StreamSimulationUpdatesBatched',
+            proto_dot_marcom__core__pb2.BatchedStreamRequest.SerializeToString,
+            proto_dot_marcom__core__pb2.SimulationUpdateBatch.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
     @staticmethod
     def ResearchProductCompetitor(request,
             target,
@@ -229,3 +384,192 @@ class MarcomService(object):
             timeout,
             metadata,
             _registered_method=True)
+
+    @staticmethod
+    def GetSimulationAnalytics(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/MarcomService.MarcomService/GetSimulationAnalytics',
+            proto_dot_marcom__core__pb2.AnalyticsRequest.SerializeToString,
+            proto_dot_marcom__core__pb2.SimulationAnalytics.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def ExportSimulationHistory(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/MarcomService.MarcomService/ExportSimulationHistory',
+            proto_dot_marcom__core__pb2.ExportRequest.SerializeToString,
+            proto_dot_marcom__core__pb2.ExportChunk.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def ForkSimulation(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/MarcomService.MarcomService/ForkSimulation',
+            proto_dot_marcom__core__pb2.ForkRequest.SerializeToString,
+            proto_dot_marcom__core__pb2.SimulationResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def RunSweep(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/MarcomService.MarcomService/RunSweep',
+            proto_dot_marcom__core__pb2.SweepRequest.SerializeToString,
+            proto_dot_marcom__core__pb2.SweepUpdate.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def GetReadiness(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/MarcomService.MarcomService/GetReadiness',
+            proto_dot_marcom__core__pb2.ReadinessRequest.SerializeToString,
+            proto_dot_marcom__core__pb2.ReadinessResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def UpdateSimulation(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/MarcomService.MarcomService/UpdateSimulation',
+            proto_dot_marcom__core__pb2.UpdateSimulationRequest.SerializeToString,
+            proto_dot_marcom__core__pb2.UpdateSimulationResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def DropSimulation(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/MarcomService.MarcomService/DropSimulation',
+            proto_dot_marcom__core__pb2.DropSimulationRequest.SerializeToString,
+            proto_dot_marcom__core__pb2.DropSimulationResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
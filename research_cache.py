@@ -0,0 +1,125 @@
+# reuses competitor research reports for near duplicate products (same item with slightly different wording or price) instead of rewriting the query,
+# searching and generating a long report again, reports are indexed by a minhash signature of the name and description words and a log scale price band
+# a request is answered from the most similar report within the similarity threshold, price tolerance and freshness window, reports past it are dropped
+import math
+import os
+import zlib
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from cassette import get_cassette_mode
+from catalog import tokenize
+from db import ResearchReport
+from product import Product
+
+SIGNATURE_SIZE = 128  # hash functions of the signature, the standard error of a similarity estimate is at most 0.5 / sqrt(128) ~ 0.04
+PRIME = 4294967291  # largest prime below 2^32, a * x + b stays within 64 bits
+DEFAULT_SIMILARITY = 0.8  # estimated jaccard similarity of the words
+DEFAULT_PRICE_TOLERANCE = 0.15  # the higher price is at most this much more than the lower one
+DEFAULT_MAX_AGE_HOURS = 24  # competitors and prices change, an old report is not worth reusing
+
+# fixed seed so signatures stored before a restart still compare
+rng = np.random.default_rng(20240917)
+hash_a = rng.integers(1, PRIME, SIGNATURE_SIZE, dtype=np.uint64)[:, None]
+hash_b = rng.integers(0, PRIME, SIGNATURE_SIZE, dtype=np.uint64)[:, None]
+
+
+# cassettes record and replay the actual calls, a report from the cache would skip them
+def is_research_cache_enabled() -> bool:
+    return os.getenv("RESEARCH_CACHE") != "false" and get_cassette_mode() == ""
+
+
+# words of the name and description, name words are also added tagged so a different name lowers the similarity more than a different description word
+def shingles(p: Product) -> set[str]:
+    words = set(tokenize(p.desc))
+    for word in tokenize(p.name):
+        words.add(word)
+        words.add(f"name:{word}")
+    return words
+
+
+# minimum of every hash function over the words (crc32 so it is stable across restarts), None for a product without any words
+def minhash(words: set[str]) -> np.ndarray:
+    if len(words) == 0:
+        return None
+    x = np.array([zlib.crc32(w.encode()) for w in words], dtype=np.uint64)[None, :]
+    return ((hash_a * x + hash_b) % PRIME).min(axis=1).astype(np.uint32)
+
+
+# share of equal minimums estimates the jaccard similarity of the word sets
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    return float((a == b).mean())
+
+
+# bands as wide as the price tolerance, a price within the tolerance is at most one band away
+def get_price_band(price: float, tolerance: float) -> int:
+    if price <= 0:
+        return -1
+    return math.floor(math.log(price) / math.log(1 + tolerance))
+
+
+class CachedReport:
+    def __init__(self, row: ResearchReport, similarity: float) -> None:
+        self.row = row
+        self.similarity = similarity
+
+
+class ResearchCache:
+    def __init__(
+        self,
+        min_similarity: float = DEFAULT_SIMILARITY,
+        price_tolerance: float = DEFAULT_PRICE_TOLERANCE,
+        max_age: timedelta = timedelta(hours=DEFAULT_MAX_AGE_HOURS),
+    ) -> None:
+        self.min_similarity = min_similarity
+        self.price_tolerance = price_tolerance
+        self.max_age = max_age
+
+    # most similar fresh report of a product within the price tolerance, newest first on ties
+    def lookup(self, p: Product) -> CachedReport:
+        signature = minhash(shingles(p))
+        if signature is None:
+            return None
+        band = get_price_band(float(p.price), self.price_tolerance)
+        rows = (
+            ResearchReport.select()
+            .where(
+                ResearchReport.price_band.between(band - 1, band + 1),
+                ResearchReport.time_created > datetime.now() - self.max_age,
+            )
+            .order_by(ResearchReport.time_created.desc())
+        )
+        best: CachedReport = None
+        for row in rows:
+            if max(row.price, float(p.price)) > (1 + self.price_tolerance) * min(row.price, float(p.price)):
+                continue
+            s = similarity(signature, np.frombuffer(row.signature, dtype=np.uint32))
+            if s >= self.min_similarity and (best is None or s > best.similarity):
+                best = CachedReport(row, s)
+        return best
+
+    def store(self, p: Product, query: str, report: str):
+        signature = minhash(shingles(p))
+        if signature is None:
+            return
+        ResearchReport.create(
+            product_id=int(p.id),
+            name=p.name,
+            desc=p.desc,
+            price=float(p.price),
+            price_band=get_price_band(float(p.price), self.price_tolerance),
+            signature=signature.tobytes(),
+            query=query,
+            report=report,
+        )
+        # expired reports are never served again
+        ResearchReport.delete().where(ResearchReport.time_created <= datetime.now() - self.max_age).execute()
+
+
+def get_research_cache() -> ResearchCache:
+    return ResearchCache(
+        min_similarity=float(os.getenv("RESEARCH_CACHE_SIMILARITY") or DEFAULT_SIMILARITY),
+        price_tolerance=float(os.getenv("RESEARCH_CACHE_PRICE_TOLERANCE") or DEFAULT_PRICE_TOLERANCE),
+        max_age=timedelta(hours=float(os.getenv("RESEARCH_CACHE_MAX_AGE_HOURS") or DEFAULT_MAX_AGE_HOURS)),
+    )
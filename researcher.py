@@ -6,13 +6,11 @@ from langchain_community.chat_models import ChatOllama
 from langchain_community.tools import DuckDuckGoSearchResults
 from langchain_community.utilities import DuckDuckGoSearchAPIWrapper
 
+from cassette import hash_key, recorded
+from llm import RoutedChain
 from product import Product
-from utils import get_chain_response_json
 
-# default to llama3.1 now, dont have the ability to switch models yet becuz llama need structured prompt guidelines and the guidelines aren't exactly usable with other models
-llm = ChatOllama(
-    model="llama3.1", format="json", temperature=0
-)  # set temp to 0 so the model dont do anything too creative :)) which is bad when doing some serious researching tasks
+# models are decided by the routing config in llm.py, only llama models are supported becuz llama need structured prompt guidelines and the guidelines aren't exactly usable with other models
 
 # Web Search Tool initialisation, using duckduckgo cuz it's free and doesn't require too much setup
 wrapper = DuckDuckGoSearchAPIWrapper(max_results=25)
@@ -21,7 +19,7 @@ web_search_tool = DuckDuckGoSearchResults(api_wrapper=wrapper)
 
 def do_web_search(query: str) -> list[dict[str, str]]:
     print("Searching on DuckDuckGo")
-    return web_search_tool.invoke(query)
+    return recorded("search", "duckduckgo", hash_key(query), lambda: web_search_tool.invoke(query))
 
 
 # transform the query given to smtg more optimised for searches first (will provide product name, description and price)
@@ -43,16 +41,19 @@ query_prompt = PromptTemplate(
     input_variables=["name", "desc", "price"],
 )
 
-query_chain = (
-    query_prompt | llm | JsonOutputParser()
-)  # such simple json shouldnt need to much guidance gua
+query_chain = RoutedChain(
+    "research_query",
+    lambda llm: query_prompt | llm | JsonOutputParser(),  # such simple json shouldnt need to much guidance gua
+    llm_class=ChatOllama,
+    format="json",
+    temperature=0,  # set temp to 0 so the model dont do anything too creative :)) which is bad when doing some serious researching tasks
+)
 
 
 def reconstruct_query_with_product(p: Product):
     print("Reconstructing query from product")
     # but still, check if it follows the format
-    return get_chain_response_json(
-        query_chain,
+    return query_chain.invoke_json(
         {
             "name": p.name,
             "desc": p.desc,
@@ -85,10 +86,12 @@ report_prompt = PromptTemplate(
     <|start_header_id|>assistant<|end_header_id|>""",
     input_variables=["name", "desc", "price", "ori_query", "context"],
 )
-llm_text = ChatOllama(
-    model="llama3.1", temperature=0
-)  # set temp to 0 so the model dont do anything too creative :)) which is bad when doing some serious researching tasks
-report_chain = report_prompt | llm_text | StrOutputParser()
+report_chain = RoutedChain(
+    "research_report",
+    lambda llm: report_prompt | llm | StrOutputParser(),
+    llm_class=ChatOllama,
+    temperature=0,  # set temp to 0 so the model dont do anything too creative :)) which is bad when doing some serious researching tasks
+)
 
 
 def get_product_comp_report(p: Product, ori_query: str, web_context: Any):
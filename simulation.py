@@ -1,13 +1,28 @@
+import json
 import random
-from agent import Agent
-from db import AgentInfo, SimulationEvent
+import threading
+import time
+from contextlib import contextmanager
+from agent import MEMORY_WINDOW, Agent, get_shared_prompt_prefix
+from analytics import SimulationAnalytics, register_simulation_analytics, save_simulation_products
+from datetime import datetime
+from db import AgentMemory, BroadcastMemory, EventRecord, SimulationChange, SimulationEvent, create_event, db, get_lineage, in_lineage, iter_lineage
 from product import Product
 from pydantic import BaseModel, Field
-from langchain_community.llms import Ollama
 from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.prompts import PromptTemplate
+from peewee import fn
 
-from utils import get_chain_response_json, get_format_instruction_of_pydantic_object
+from backend_pool import format_backend_stats
+from cassette import cassette_unit, recorded
+from catalog import CatalogIndex
+from social import SocialGraph, configured_graph, knn_graph, small_world_graph
+from live_update import LiveUpdate, load_live_update
+from llm import RoutedChain, TokenMeter, format_tier_stats, iter_with_token_meter, use_deadline
+from population import Population
+from surrogate import SKIP, TIMEOUT_REASON, SurrogateModel, SurrogatePrediction
+from utils import CancelledException, LLMTimeoutException, get_format_instruction_of_pydantic_object
+from warmup import prefill_prompt_prefix
 
 class Simulation:
     # total_cycle is negative means should run infinitely
@@ -18,48 +33,329 @@ class Simulation:
         agents: list[Agent],
         products: list[Product],
         total_cycle: int = -1,
+        batch_feedback: bool = False,  # generate feedbacks of a cycle together in batches instead of one LLM call per BUY/SKIP
+        feedback_batch_size: int = 8,
+        population_mode: bool = False,  # cluster agents into archetypes and only run the LLM for representatives and a sampled fraction
+        num_archetypes: int = None,  # defaults to sqrt of the number of agents
+        population_sample_fraction: float = 0.1,
+        surrogate_mode: bool = False,  # answer routine BUY/SKIP decisions with a model trained on the simulation's own events
+        surrogate_confidence: float = 0.8,
+        surrogate_calibration_rate: float = 0.1,
+        surrogate_min_cycles: int = 2,
+        max_dialogue_turns: int = 3,  # messages an agent can send in its turn before it has to BUY or SKIP, 0 for no limit
+        cycle_token_budget: int = 0,  # LLM tokens a cycle can use before every agent left has to BUY or SKIP, 0 for no limit
+        simulation_token_budget: int = 0,  # LLM tokens of the whole simulation, it ends early at the start of a cycle once used up, 0 for no limit
+        cycle_deadline: float = 0,  # seconds of LLM work a cycle gets, agents that have not decided by then get a fallback decision, 0 for no limit
+        catalog_shortlist_size: int = 20,  # products in an agent's prompt when the catalog is larger than this (plus the exploration slots), 0 to always list every product
+        catalog_exploration_slots: int = 2,  # products outside the shortlist added to the prompt, rotating every cycle
+        social_graph: str = None,  # "small_world" or "knn" for agents to only see and message their neighbours, None for everyone to see everyone
+        social_degree: int = 8,  # neighbours per agent of a generated graph
+        social_rewire: float = 0.1,  # chance of each link of the small world graph to go to a random agent instead
+        neighbours: dict[int, list[int]] = None,  # agent id -> neighbour ids, takes over from social_graph when given
     ) -> None:
         self.id = id
         self.env_desc = env_desc
         self.agents = agents
         self.products = products
         self.total_cycle = total_cycle
+        self.batch_feedback = batch_feedback
+        self.feedback_batch_size = feedback_batch_size
+        self.population_mode = population_mode
+        self.num_archetypes = num_archetypes
+        self.population_sample_fraction = population_sample_fraction
+        self.population: Population = None  # built when initialising the simulation
+        self.analytics = SimulationAnalytics(id, products)
+        register_simulation_analytics(self.analytics)
+        self.max_dialogue_turns = max_dialogue_turns
+        self.cycle_token_budget = cycle_token_budget
+        self.simulation_token_budget = simulation_token_budget
+        self.tokens = TokenMeter()  # tokens used by the simulation's LLM calls
+        self.cycle_deadline = cycle_deadline
+        self.catalog = CatalogIndex(products, catalog_shortlist_size, catalog_exploration_slots)
+        self.agents_by_id = {int(a.id): a for a in agents}
+        self.social_graph = social_graph
+        self.social_degree = social_degree
+        self.social_rewire = social_rewire
+        self.neighbours = neighbours
+        self.social: SocialGraph = None  # built once the agents are initialised
+        self.surrogate: SurrogateModel = None
+        if surrogate_mode:
+            self.surrogate = SurrogateModel(
+                agents,
+                products,
+                confidence_threshold=surrogate_confidence,
+                calibration_rate=surrogate_calibration_rate,
+                min_cycles=surrogate_min_cycles,
+                seed=id,
+            )
+        # simulation wide memory shared by reference with every agent, only the window that can be in a prompt is kept
+        self.broadcasts: list[tuple[datetime, str]] = []
         self.cycle = 0 # for init
+        # simulations whose history this one continues (see db.get_lineage), a fork starts at the cycle it was forked at instead of 1
+        self.lineage: list[tuple[int, int]] = [(id, None)]
+        self.start_cycle = 1
+        self.progress: CycleProgress = None  # progress of the current cycle, kept across interruptions so the cycle continues where it stopped
         self.inited = False
         self.paused = False
+        # set to stop the LLM call in progress (pause, stream gone), the interrupted turn is undone and replayed by a new run_simulation
+        self.cancel_event = threading.Event()
+        self.step_lock = threading.Lock()  # held while the simulation runs to its next event
+        # set when the simulation is restarted after the process running it died, it continues from the first cycle it did not complete
+        self.resume = False
+        self.resume_cycle: int = None
+        # live updates (UpdateSimulation) waiting for the next cycle, queued from the rpc threads
+        self.pending_updates: list[LiveUpdate] = []
+        self.applied_updates: set[str] = set()  # ids of the updates applied so far
+        self.update_lock = threading.Lock()
 
     def init_simulation(self):
+        with db.atomic():
+            save_simulation_products(self.id, self.products)
+        self.lineage[:] = get_lineage(self.id)  # in place, agents hold a reference to this list
+        for a in self.agents:
+            a.lineage = self.lineage
+        if len(self.lineage) > 1:
+            # the parent's cycles before the fork are the fork's own history, nothing before the fork cycle is rerun
+            self.start_cycle = self.lineage[1][1]
+            if SimulationEvent.get_or_none(SimulationEvent.sim_id == self.id) is None:
+                yield self.new_event(
+                    "SIMULATION",
+                    f"Forked from simulation {self.lineage[1][0]} at cycle {self.start_cycle}",
+                )
+        if self.resume:
+            yield from self.rollback_unfinished_cycle()
+        self.replay_updates()
+        self.analytics.rebuild()  # continue counting from the events alrd in db if resuming
+        self.load_token_usage()
+        self.load_broadcasts()
+        for a in self.agents:
+            a.broadcasts = self.broadcasts
+        if self.surrogate is not None:
+            self.surrogate.load_history(self.id)  # continue learning from where it was before a restart
+        if self.population_mode:
+            yield from self.init_population()
+            self.build_social_graph()
+            self.inited = True
+            return
         # actually initialising the agents
         for a in self.agents:
-            first_time = a.init_agent()
+            with cassette_unit(self.tokens):
+                first_time = a.init_agent()
             if first_time:
-                agent = AgentInfo.create(
-                    agent_id=a.id,
-                    sim_id=self.id,
-                    rewritten_desc=a.sim_desc,
-                    rewritten_desc_third_person=a.sim_desc_3rd,
-                )
-                yield SimulationEvent.create(
-                    agent=agent,
-                    sim_id=self.id,
-                    type="SIMULATION",
-                    content=f"Initialised Agent {a.name} with rewritten description: {a.sim_desc}",
-                    cycle=self.cycle,
+                yield self.new_event(
+                    "SIMULATION",
+                    f"Initialised Agent {a.name} with rewritten description: {a.sim_desc}",
+                    agent=a,  # init_agent alrd created the AgentInfo
                 )
+        self.build_social_graph()
         self.inited = True
 
+    # the progress of a cycle (whose turn it is, pending feedbacks) is only kept in memory, a cycle is only done once its BUDGET event is written
+    # so what was written of the cycle in progress when the process died is dropped and the cycle is rerun from its start
+    def rollback_unfinished_cycle(self):
+        last_completed = (
+            SimulationEvent.select(fn.MAX(SimulationEvent.cycle))
+            .where((SimulationEvent.sim_id == self.id) & (SimulationEvent.type == "BUDGET"))
+            .scalar()
+        )
+        self.resume_cycle = max(self.start_cycle, (last_completed or 0) + 1)
+        with db.atomic():
+            dropped = SimulationEvent.delete().where(
+                (SimulationEvent.sim_id == self.id) & (SimulationEvent.cycle >= self.resume_cycle)
+            ).execute()
+            AgentMemory.delete().where((AgentMemory.sim_id == self.id) & (AgentMemory.cycle >= self.resume_cycle)).execute()
+            BroadcastMemory.delete().where(
+                (BroadcastMemory.sim_id == self.id) & (BroadcastMemory.cycle >= self.resume_cycle)
+            ).execute()
+            # updates of the rerun cycle are applied again at its start, the supervisor sends them again
+            SimulationChange.delete().where(
+                (SimulationChange.sim_id == self.id) & (SimulationChange.cycle >= self.resume_cycle)
+            ).execute()
+        if dropped > 0:
+            # in the rerun cycle rather than the initialisation
+            yield create_event(self.id, "SIMULATION", f"Simulation restarted, cycle {self.resume_cycle} is rerun from its start", self.resume_cycle)
+
+    # updates applied before the simulation was initialised again (restart, worker died) on top of the request's products and environment description
+    def replay_updates(self):
+        query = (
+            SimulationChange.select()
+            .where(SimulationChange.sim_id == self.id)
+            .order_by(SimulationChange.cycle, SimulationChange.id)
+        )
+        for change in query:
+            update = load_live_update(change.change_id, change.content, self.id)
+            self.set_catalog(update.apply_to(self.products), update.env_desc)
+            self.applied_updates.add(change.change_id)
+
+    # why the update cannot be applied after the ones alrd waiting, empty if it can
+    def check_update(self, update: LiveUpdate) -> str:
+        with self.update_lock:
+            product_ids = set([int(p.id) for p in self.products])
+            for pending in self.pending_updates:
+                product_ids = pending.product_ids(product_ids)
+        return update.check(product_ids)
+
+    def queue_update(self, update: LiveUpdate):
+        with self.update_lock:
+            self.pending_updates.append(update)
+
+    # applies the waiting updates at the start of a cycle, an update sent again after it was applied (eg. to a restarted worker) is skipped
+    def apply_updates(self):
+        with self.update_lock:
+            updates, self.pending_updates = self.pending_updates, []
+        for update in updates:
+            if update.id in self.applied_updates:
+                continue
+            products = update.apply_to(self.products)
+            if len(products) == 0:
+                yield self.new_event("SIMULATION", f"Simulation update {update.id} not applied, it removes every product")
+                continue
+            with db.atomic():
+                SimulationChange.create(sim_id=self.id, change_id=update.id, cycle=self.cycle, content=update.to_json())
+                event = self.new_event("SIMULATION", update.describe(self.products))
+            env_changed = update.env_desc != "" and update.env_desc != self.env_desc
+            self.set_catalog(products, update.env_desc)
+            self.applied_updates.add(update.id)
+            print(f"Simulation {self.id} cycle {self.cycle}: {event.content}")
+            if env_changed:
+                prefill_prompt_prefix("agent_action", get_shared_prompt_prefix(self.env_desc))  # the cached prefix is of the old description
+            yield event
+
+    # swaps the catalog and environment description, only what is built from them is rebuilt, the agents' memory and state stay
+    def set_catalog(self, products: list[Product], env_desc: str = ""):
+        self.products = products
+        if env_desc != "":
+            self.env_desc = env_desc
+        self.catalog.set_products(products)
+        self.analytics.update_prices(products)
+        if self.surrogate is not None:
+            self.surrogate.set_products(products)
+
+    # clusters the agents into archetypes, only representatives gets their description rewritten by the LLM, the rest uses a template description
+    def init_population(self):
+        # always clustered on the descriptions and attributes of the request, the rewrites in db (representatives by the LLM, the rest from a template)
+        # would give other clusters when the simulation is recreated after a restart, and a follower could become a representative without a rewrite
+        self.population = Population(
+            self.agents,
+            descs=[a.desc for a in self.agents],
+            num_archetypes=self.num_archetypes,
+            sample_fraction=self.population_sample_fraction,
+            seed=self.lineage[-1][0],  # same clusters when the simulation is recreated after restart, and in every fork of it
+        )
+        representatives = set([int(a.id) for a in self.population.get_representatives()])
+        events = []
+        with cassette_unit(self.tokens), db.atomic():  # a cancelled initialisation is rolled back as a whole
+            for a in self.agents:
+                first_time = a.init_agent(rewrite=int(a.id) in representatives)
+                if first_time:
+                    events.append(
+                        self.new_event(
+                            "SIMULATION",
+                            f"Initialised Agent {a.name} of archetype {self.population.get_archetype(a).id} with description: {a.sim_desc}",
+                            agent=a,
+                        )
+                    )
+            events.append(
+                self.new_event(
+                    "SIMULATION",
+                    f"Clustered {len(self.agents)} agents into {len(self.population.archetypes)} archetypes",
+                )
+            )
+        yield from events
+
+    # generated graphs only depend on the roster, descriptions and seed, so the same graph is built again after a restart (and in every fork)
+    def build_social_graph(self):
+        if self.neighbours:
+            self.social = configured_graph(self.agents, self.neighbours)
+        elif self.social_graph == "small_world":
+            self.social = small_world_graph(self.agents, self.social_degree, self.social_rewire, seed=self.lineage[-1][0])
+        elif self.social_graph == "knn":
+            self.social = knn_graph(self.agents, [a.sim_desc or a.desc for a in self.agents], self.social_degree)
+        else:
+            return
+        print(f"Simulation {self.id} social {self.social.string()}")
+
+    # creates the event in db and returns its record, agent is None for simulation level events
+    def new_event(self, type: str, content: str, agent: Agent = None, decided_by: str = None) -> EventRecord:
+        if agent is None:
+            return create_event(self.id, type, content, self.cycle)
+        return create_event(
+            self.id, type, content, self.cycle, info_id=agent.info_id, agent_id=int(agent.id), decided_by=decided_by
+        )
+
+    # tokens used before a restart, from the latest budget report
+    def load_token_usage(self):
+        last_report = (
+            SimulationEvent.select()
+            .where((SimulationEvent.sim_id == self.id) & (SimulationEvent.type == "BUDGET"))
+            .order_by(SimulationEvent.id.desc())
+            .first()
+        )
+        if last_report is not None:
+            self.tokens.total = max(self.tokens.total, json.loads(last_report.content)["simulation_tokens"])
+
+    def cycle_tokens(self) -> int:
+        return self.tokens.total - self.progress.start_tokens
+
+    def is_simulation_budget_used_up(self) -> bool:
+        return self.simulation_token_budget > 0 and self.tokens.total >= self.simulation_token_budget
+
+    # once the cycle (or the whole simulation) used up its tokens, agents have to decide instead of messaging
+    def is_over_budget(self) -> bool:
+        if self.cycle_token_budget > 0 and self.cycle_tokens() >= self.cycle_token_budget:
+            return True
+        return self.is_simulation_budget_used_up()
+
+    # LLM calls made in this context time out once the cycle's deadline passes
+    # only the time spent in here counts towards the deadline, so a paused cycle does not run out of time while waiting
+    @contextmanager
+    def cycle_clock(self):
+        start = time.monotonic()
+        deadline = None
+        if self.cycle_deadline > 0:
+            deadline = start + self.cycle_deadline - self.progress.time_used
+        try:
+            with use_deadline(deadline):
+                yield
+        finally:
+            self.progress.time_used += time.monotonic() - start
+
+    def load_broadcasts(self):
+        broadcasts = iter_lineage(
+            self.lineage,
+            lambda sim_id, until_cycle: BroadcastMemory.select()
+            .where(in_lineage([(sim_id, until_cycle)], BroadcastMemory.sim_id, BroadcastMemory.cycle))
+            .order_by(BroadcastMemory.time_created.desc())
+            .limit(MEMORY_WINDOW),
+        )
+        self.broadcasts[:] = [(mem.time_created, mem.content) for mem in sorted(broadcasts, key=lambda m: m.time_created)[-MEMORY_WINDOW:]]
+
+    # memory for every agent of the simulation, one row instead of one per agent
+    def broadcast_memory(self, content: str):
+        mem = BroadcastMemory.create(sim_id=self.id, content=content, cycle=self.cycle)
+        self.broadcasts.append((mem.time_created, content))
+        del self.broadcasts[:-MEMORY_WINDOW]  # in place, agents hold a reference to this list
+
     def pause_simulation(self):
         self.paused = True
+        self.cancel_event.set()  # dont wait for the turn in progress to finish
 
     def resume_simulation(self):
         self.paused = False
+        self.cancel_event.clear()
+
+    # stops the work in progress without pausing, eg. the stream driving the simulation is gone
+    def cancel(self):
+        self.cancel_event.set()
 
     # use another LLM and generate events for feedbacks on "BUY" and "SKIP" actions
     # also provide the product details and maybe the agent description so the LLM can get more context
+    # should_positive is only passed in when the feedback was already rolled (eg. batched feedback falling back to single call)
     def simulation_response_helper(
-        self, action: str, reason: str, env_desc: str, product: Product, agent: Agent
+        self, action: str, reason: str, env_desc: str, product: Product, agent: Agent, should_positive: bool = None
     ) -> str:
-        should_positive = random.randrange(1, 10) > 6 # 5050 chance to be positive
+        if should_positive is None:
+            should_positive = roll_should_positive()
         prompt_template = """
             <|begin_of_text|>
             <|start_header_id|>system<|end_header_id|>
@@ -72,7 +368,6 @@ class Simulation:
             Action:{agent_action}
             Reason:{action_reason}
         """
-        llm = Ollama(model="llama3.1", format="json")
         parser = JsonOutputParser(pydantic_object=SimulationActionResp)
         prompt = PromptTemplate(
             template=prompt_template,
@@ -89,9 +384,10 @@ class Simulation:
                 "should_positive_enforcement": "The event should clearly benefit the agent." if should_positive else "The event should clearly harm the agent without any potential for positive interpretation."
             },
         )
-        chain = prompt | llm | parser
-        return get_chain_response_json(
-            chain,
+        chain = RoutedChain(
+            "action_feedback", lambda llm: prompt | llm | parser, format="json"
+        )
+        return chain.invoke_json(
             {
                 "env_desc": env_desc,
                 "product_desc": product.desc if product is not None else "Agent did not buy any product",
@@ -102,225 +398,551 @@ class Simulation:
             ["feedback"],
         )
 
-    # progresses the cycle
+    # same as simulation_response_helper, but generates the feedbacks of multiple BUY/SKIP actions in a single LLM call
+    # returns agent_id -> feedback, only for items that passed validation (caller fallbacks to single calls for the rest)
+    def simulation_response_batch_helper(
+        self, env_desc: str, pending: list["ActionOutcome"]
+    ) -> dict[int, str]:
+        prompt_template = """
+            <|begin_of_text|>
+            <|start_header_id|>system<|end_header_id|>
+            You are managing a simulation where LLM agents are being used to simulate consumer behavior where they can either buy or skip a certain product. For each of the following agent actions, generate a random event in first person point of view that is positive or negative as stated in the action's event field (positive or negative) relative to the environment description and provide a single short sentence on how effective the product is to the agent relative to the agent description based on the product purchase details, the random event and the environment description. If action is SKIP, generate random events that are not related to the product but relates to the environment description and the agent's aim. A positive event should clearly benefit the agent, a negative event should clearly harm the agent without any potential for positive interpretation.
+            Response format:{format_instructions}
+            <|eot_id|>
+            Environment Description:{env_desc}
+            Agent Actions:
+            {agent_actions}
+        """
+        parser = JsonOutputParser(pydantic_object=SimulationActionRespBatch)
+        prompt = PromptTemplate(
+            template=prompt_template,
+            input_variables=["env_desc", "agent_actions"],
+            partial_variables={
+                "format_instructions": get_format_instruction_of_pydantic_object(SimulationActionRespBatch),
+            },
+        )
+        chain = RoutedChain(
+            "action_feedback", lambda llm: prompt | llm | parser, format="json"
+        )
+        res = chain.invoke_json(
+            {
+                "env_desc": env_desc,
+                "agent_actions": "\n".join([p.to_prompt_str() for p in pending]),
+            },
+            ["feedbacks"],
+            additional_check=lambda res: type(res["feedbacks"]) is list,
+        )
+        # validate per item, anything that is not for an agent in this batch or has no proper feedback is dropped
+        wanted = set([int(p.agent.id) for p in pending])
+        feedbacks = {}
+        for item in res["feedbacks"]:
+            if type(item) is not dict or "feedback" not in item or "agent_id" not in item:
+                continue
+            if not str(item["agent_id"]).isdigit() or int(item["agent_id"]) not in wanted:
+                continue
+            if type(item["feedback"]) is not str or item["feedback"].strip() == "":
+                continue
+            feedbacks[int(item["agent_id"])] = item["feedback"]
+        return feedbacks
+
+    # generates the feedback event for a BUY/SKIP action, in batch mode only queues it to be generated at the end of the cycle
+    # returns the outcome so the caller knows the agent's decision (feedback is filled in once generated)
+    def give_feedback(
+        self,
+        pending: list["ActionOutcome"],
+        action: str,
+        reason: str,
+        product: Product,
+        agent: Agent,
+    ):
+        outcome = ActionOutcome(action, reason, product, agent, roll_should_positive())
+        if self.batch_feedback:
+            pending.append(outcome)
+            return outcome
+        outcome.feedback = self.simulation_response_helper(
+            action=action,
+            reason=reason,
+            env_desc=self.env_desc,
+            product=product,
+            agent=agent,
+            should_positive=outcome.should_positive,
+        )["feedback"]
+        agent.add_to_memory(outcome.feedback)
+        yield self.new_event("ACTION_RESP", outcome.feedback, agent=agent)
+        return outcome
+
+    # generates the queued feedbacks in batches and yields the ACTION_RESP event of each agent
+    # a batch is only applied once all its feedbacks are generated, so an interruption never leaves a batch half applied
+    def flush_feedbacks(self, pending: list["ActionOutcome"]):
+        remaining = [p for p in pending if p.feedback is None]  # the rest was applied before the cycle got interrupted
+        for i in range(0, len(remaining), self.feedback_batch_size):
+            batch = remaining[i : i + self.feedback_batch_size]
+            try:
+                with self.cycle_clock(), cassette_unit(self.tokens):
+                    feedbacks = self.generate_feedbacks(batch)
+            except LLMTimeoutException as e:
+                # the cycle ran out of time, the decisions stand without feedback
+                late = remaining[i:]
+                for p in late:
+                    p.feedback = ""
+                yield self.new_event("TIMEOUT", f"Feedback of {len(late)} actions not generated, {e}")
+                return
+            events = []
+            for p in batch:
+                p.feedback = feedbacks[int(p.agent.id)]
+                p.agent.add_to_memory(p.feedback)
+                events.append(self.new_event("ACTION_RESP", p.feedback, agent=p.agent))
+            yield from events
+
+    def generate_feedbacks(self, batch: list["ActionOutcome"]) -> dict[int, str]:
+        feedbacks = self.simulation_response_batch_helper(self.env_desc, batch)
+        for p in batch:
+            if int(p.agent.id) not in feedbacks:
+                print(f"Batched feedback for agent {p.agent.id} failed validation, falling back to single call")
+                feedbacks[int(p.agent.id)] = self.simulation_response_helper(
+                    action=p.action,
+                    reason=p.reason,
+                    env_desc=self.env_desc,
+                    product=p.product,
+                    agent=p.agent,
+                    should_positive=p.should_positive,
+                )["feedback"]
+        return feedbacks
+
+    # adds a BUY/SKIP decision to the agent's memory and creates its event, BUY content is PRODUCT_ID:REASON, SKIP content is the reason
+    # decided_by is kept with the event so the surrogate only learns from the LLM's decisions when its history is reloaded
+    def create_decision_event(
+        self, agent: Agent, action: str, product: Product, reason: str, decided_by: str
+    ) -> EventRecord:
+        if action == "BUY":
+            agent.add_to_memory(f"You bought Product {product.name} with reason \"{reason}\"")
+            content = f"{product.id}:{reason}"
+        else:
+            agent.add_to_memory(f"You did not buy anything with reason \"{reason}\"")
+            content = reason
+        return self.new_event(action, content, agent=agent, decided_by=decided_by)
+
+    # gives every agent that did not ask the LLM this cycle a decision sampled from the deciders of its archetype
+    def expand_outcomes(self, outcomes: list["ActionOutcome"]):
+        events = []
+        with db.atomic():  # yield after commit so the transaction is not held open across yields
+            # fallback decisions of agents that timed out are not the archetype's opinion, nobody follows them
+            for member, outcome in self.population.expand([o for o in outcomes if not o.timed_out]):
+                events.append(
+                    self.create_decision_event(
+                        member, outcome.action, outcome.product, outcome.reason, "follower"
+                    )
+                )
+                if outcome.feedback == "":
+                    continue  # feedback was not generated in time
+                # members share the experience of the agent they follow, generating one per member would defeat the purpose
+                member.add_to_memory(outcome.feedback)
+                events.append(self.new_event("ACTION_RESP", outcome.feedback, agent=member))
+        yield from events
+
+    # progresses the cycle, continuing from the turn that was interrupted if any
     def proceed_cycle(self):
+        cycle_start = time.perf_counter()
+        if self.progress is None:
+            if self.is_simulation_budget_used_up():
+                print(f"Simulation {self.id} used up its token budget, ending at cycle {self.cycle}")
+                yield self.new_event(
+                    "SIMULATION",
+                    f"Simulation token budget of {self.simulation_token_budget} used up ({self.tokens.total} tokens), ending the simulation",
+                )
+                self.total_cycle = self.cycle - 1
+                return
+            yield from self.apply_updates()
+            for agent in self.agents:
+                agent.cycle = self.cycle
+            self.broadcast_memory(f"Cycle {self.cycle} start")
+            # in population mode only archetype representatives and a sampled fraction asks the LLM, the rest follows them
+            deciders = self.agents if self.population is None else self.population.pick_deciders()
+            self.progress = CycleProgress(deciders, self.tokens.total)
+        progress = self.progress
+        while progress.next_decider < len(progress.deciders):
+            agent = progress.deciders[progress.next_decider]
+            events, outcome = self.take_turn(agent, progress.pending_feedbacks)
+            progress.outcomes.append(outcome)
+            progress.next_decider += 1  # before yielding, the turn is done even if the events are not streamed yet
+            yield from events
+        yield from self.flush_feedbacks(progress.pending_feedbacks)
+        if self.population is not None:
+            yield from self.expand_outcomes(progress.outcomes)
+        if self.surrogate is not None:
+            report = self.surrogate.end_cycle()
+            print(f"Simulation {self.id} cycle {self.cycle} surrogate: {report}")
+            yield self.new_event("SIMULATION", f"Surrogate decisions: {report}")
+        yield self.new_event(
+            "BUDGET",
+            json.dumps(
+                {
+                    "cycle_tokens": self.cycle_tokens(),
+                    "cycle_budget": self.cycle_token_budget,
+                    "simulation_tokens": self.tokens.total,
+                    "simulation_budget": self.simulation_token_budget,
+                    "forced_decisions": self.progress.forced_decisions,
+                }
+            ),
+        )
+        print(
+            f"Simulation {self.id} cycle {self.cycle} completed in {time.perf_counter() - cycle_start:.2f}s, {format_tier_stats()}"
+        )
+        print(f"LLM backends: {format_backend_stats()}")
+        self.progress = None
+        self.cycle += 1
+
+    # runs the whole turn of an agent before its events are yielded, so a turn is either fully done or (when interrupted) undone
+    def take_turn(
+        self, agent: Agent, pending_feedbacks: list["ActionOutcome"]
+    ) -> tuple[list[EventRecord], "ActionOutcome"]:
+        turn_start = self.turn_mark()
+        turn_pending: list[ActionOutcome] = []  # only added to the cycle's pending feedbacks once the turn is done
+        prediction = self.surrogate.predict(agent) if self.surrogate is not None else None
+        try:
+            with self.cycle_clock(), cassette_unit(self.tokens):
+                if self.surrogate is not None and self.surrogate.is_confident(prediction) and not self.surrogate.should_calibrate():
+                    events, outcome = collect(self.surrogate_turn(agent, prediction, turn_pending))
+                else:
+                    events, outcome = collect(self.agent_turn(agent, turn_pending))
+        except CancelledException:
+            self.rollback_turn(turn_start)
+            print(f"Simulation {self.id} interrupted during cycle {self.cycle}, the turn will be replayed")
+            raise
+        except LLMTimeoutException as e:
+            # the agent did not decide in time (call timed out or the cycle deadline passed), its partial turn is replaced with a fallback decision
+            self.rollback_turn(turn_start)
+            print(f"Simulation {self.id} agent {agent.id} timed out during cycle {self.cycle}: {e}")
+            return collect(self.timeout_turn(agent, prediction, str(e)))
+        pending_feedbacks.extend(turn_pending)
+        if self.surrogate is not None:
+            self.surrogate.observe(
+                agent,
+                self.cycle,
+                int(outcome.product.id) if outcome.product is not None else SKIP,
+                outcome.reason,
+                prediction,
+                llm_decided=not outcome.from_surrogate,
+            )
+        return events, outcome
+
+    # last event and memory ids of the simulation's db before a turn, everything after them was written by the turn (turns run one at a time)
+    def turn_mark(self) -> tuple[int, int]:
+        return (
+            SimulationEvent.select(fn.MAX(SimulationEvent.id)).scalar() or 0,
+            AgentMemory.select(fn.MAX(AgentMemory.id)).scalar() or 0,
+        )
+
+    # removes the events and memories written by an interrupted turn (the message partner's too) so it can be replayed without duplicates
+    # by id rather than by time, so rows are not missed or taken along when the clock moves (eg. ntp adjustments) or rows share a timestamp
+    def rollback_turn(self, turn_start: tuple[int, int]):
+        last_event_id, last_memory_id = turn_start
+        SimulationEvent.delete().where((SimulationEvent.sim_id == self.id) & (SimulationEvent.id > last_event_id)).execute()
+        written = AgentMemory.select(AgentMemory.agent).where((AgentMemory.sim_id == self.id) & (AgentMemory.id > last_memory_id))
+        info_ids = set([mem.agent_id for mem in written])
+        AgentMemory.delete().where((AgentMemory.sim_id == self.id) & (AgentMemory.id > last_memory_id)).execute()
         for agent in self.agents:
-            agent.add_to_memory(f"Cycle {self.cycle} start")
-        for agent in self.agents:
-            prompt_message = f"What action would you like to perform?"
-            # obtaining action from agent
-            action = agent.get_action(
+            if agent.info_id in info_ids:
+                agent.load_memory()
+
+    # records the timeout and a decision without any LLM call, the surrogate's prediction if it has one otherwise SKIP
+    # the decision has no feedback and is not used to train the surrogate
+    def timeout_turn(self, agent: Agent, prediction: SurrogatePrediction, cause: str):
+        choice = prediction.choice if prediction is not None else SKIP
+        action = "SKIP" if choice == SKIP else "BUY"
+        product = None
+        if action == "BUY":
+            product = [p for p in self.products if int(p.id) == choice][0]
+        yield self.new_event("TIMEOUT", f"Agent did not decide in time ({cause}), {action} taken as fallback", agent=agent)
+        yield self.create_decision_event(agent, action, product, TIMEOUT_REASON, "fallback")
+        outcome = ActionOutcome(action, TIMEOUT_REASON, product, agent, roll_should_positive())
+        outcome.feedback = ""
+        outcome.timed_out = True
+        return outcome
+
+    # agents the agent can see and message, its neighbours when there is a social graph
+    # in population mode only the representatives otherwise the prompt grows with the population
+    def get_visible_agents(self, agent: Agent) -> list[Agent]:
+        if self.social is not None:
+            return self.social.neighbours(agent)
+        if self.population is None:
+            return self.agents
+        return self.population.get_representatives()
+
+    def render_visible_agents(self, agent: Agent) -> str:
+        if self.social is not None:
+            return self.social.render(agent)
+        return agent.render_agents(self.get_visible_agents(agent))
+
+    # the agent with the id as a list (empty if there is no such agent), what the message validation expects
+    def find_agents(self, agent_id) -> list[Agent]:
+        target = self.agents_by_id.get(int(agent_id))
+        return [target] if target is not None else []
+
+    # takes the surrogate's decision for the agent without asking the LLM (feedback is still generated as usual)
+    def surrogate_turn(
+        self, agent: Agent, prediction: SurrogatePrediction, pending_feedbacks: list["ActionOutcome"]
+    ):
+        action = "SKIP" if prediction.choice == SKIP else "BUY"
+        product = None
+        if action == "BUY":
+            product = [p for p in self.products if int(p.id) == prediction.choice][0]
+        reason = self.surrogate.get_reason(agent, prediction.choice)  # reuse the agent's own reason from when it last made this choice
+        yield self.create_decision_event(agent, action, product, reason, "surrogate")
+        outcome = yield from self.give_feedback(
+            pending_feedbacks,
+            action=action,
+            reason=reason,
+            product=product,
+            agent=agent,
+        )
+        outcome.from_surrogate = True
+        return outcome
+
+    # runs a single agent's turn until it BUY or SKIP, returns the outcome of its decision
+    def agent_turn(self, agent: Agent, pending_feedbacks: list["ActionOutcome"]):
+        visible_agents = self.render_visible_agents(agent)  # rendered once for the whole turn
+        visible_ids = ','.join([str(a.id) for a in self.get_visible_agents(agent) if int(a.id) != int(agent.id)])
+        shown_products = self.catalog.shortlist(agent, self.cycle)  # what the agent sees, it can still buy anything in the catalog
+        shown_ids = ','.join([str(p.id) for p in shown_products])
+        dialogue_turns = 0  # messages sent by the agent this turn
+        forced = False
+
+        # asks the agent for its next action, only BUY and SKIP are allowed once it used up its messages or the cycle used up its tokens
+        def decide(message: str, should_add_memory: bool = False):
+            nonlocal forced
+            if not forced and (
+                (self.max_dialogue_turns > 0 and dialogue_turns >= self.max_dialogue_turns)
+                or self.is_over_budget()
+            ):
+                forced = True
+                self.progress.forced_decisions += 1
+            if forced:
+                message = f"{message}\nYou cannot send any more messages this cycle, decide whether to BUY a product or SKIP"
+            return agent.get_action(
                 self.env_desc,
-                prompt_message,
-                self.products,
-                self.agents,
+                message,
+                shown_products,
+                visible_agents,
+                actions=DECISION_ACTIONS if forced else None,
+                should_add_memory=should_add_memory,
             )
-            agent_model = AgentInfo.select().where(AgentInfo.agent_id == agent.id)
-            # talk can go for very long
-            while True:
-                match action["action"]:
-                    case "BUY":
-                        # obtain the product purchased by the agent (check if is valid as well)
-                        product_to_buy = None
-                        prompt_message = ""
-                        data_bundle = action["additional_data_id"]
-                        # try give bigger tolerance, LLM output hard to control
-                        # tolerate two cases: agent_id:id or id
-                        if str(data_bundle).isdigit():
+
+        prompt_message = f"What action would you like to perform?"
+        # obtaining action from agent
+        action = decide(prompt_message)
+        # talk is bounded by max_dialogue_turns and the token budgets
+        while True:
+            match action["action"]:
+                case "BUY":
+                    # obtain the product purchased by the agent (check if is valid as well)
+                    product_to_buy = None
+                    prompt_message = ""
+                    data_bundle = action["additional_data_id"]
+                    # try give bigger tolerance, LLM output hard to control
+                    # tolerate two cases: agent_id:id or id
+                    if str(data_bundle).isdigit():
+                        product_to_buy = [
+                            p for p in self.products if int(p.id) == int(data_bundle)
+                        ]
+                        if len(product_to_buy) != 1:
+                            prompt_message = f"product do not exist in environment, valid IDs are [{shown_ids}]"  # id should be unique
+                    else:
+                        split = data_bundle.split(":")
+                        if len(split) > 2:
+                            prompt_message = "invalid buy additional data format, please only provide product id or product_id:id"
+                        if len(split) == 1 and split[0].isdigit():
                             product_to_buy = [
-                                p for p in self.products if int(p.id) == int(data_bundle)
+                                p for p in self.products if int(p.id) == int(split[0])
                             ]
                             if len(product_to_buy) != 1:
-                                prompt_message = f"product do not exist in environment, valid IDs are [{','.join([str(p.id) for p in self.products])}]"  # id should be unique
-                        else:
-                            split = data_bundle.split(":")
-                            if len(split) > 2:
-                                prompt_message = "invalid buy additional data format, please only provide product id or product_id:id"
-                            if len(split) == 1 and split[0].isdigit():
-                                product_to_buy = [
-                                    p for p in self.products if int(p.id) == int(split[0])
-                                ]
-                                if len(product_to_buy) != 1:
-                                    prompt_message = f"product do not exist in environment, valid IDs are [{','.join([str(p.id) for p in self.products])}]"  # id should be unique
-                            elif len(split) == 2 and not split[1].isdigit() or len(split) != 2:
-                                prompt_message = "invalid buy additional data format, please only provide product id or product_id:id"
-                            elif len(split) == 2 and split[1].isdigit():
-                                product_to_buy = [
-                                    p for p in self.products if int(p.id) == int(split[1])
-                                ]
-                                if len(product_to_buy) != 1:
-                                    prompt_message = f"product do not exist in environment, valid IDs are [{','.join([str(p.id) for p in self.products])}]"  # id should be unique
-                        if (
-                            product_to_buy is None
-                            or len(product_to_buy) != 1
-                        ):
-                            prompt_message = f"Attempted to buy product with id {data_bundle}, but {prompt_message}"
-                            print("Obtained invalid action, retrying:", prompt_message)
-                            action = agent.get_action(
-                                self.env_desc,
-                                prompt_message,
-                                self.products,
-                                self.agents,
-                            )
-                        else:
-                            # add BUY action to memory and also db
-                            agent.add_to_memory(
-                                f"You bought Product {product_to_buy[0].name} with reason \"{action['reason']}\""
-                            )
-                            # create the BUY event and yield it out to facilitate returning to backend
-                            event = SimulationEvent.create(
-                                agent=agent_model,
-                                sim_id=self.id,
-                                type="BUY",
-                                content=f"{product_to_buy[0].id}:{action['reason']}",
-                                cycle=self.cycle,
-                            )
-                            yield event
-                            # generate feedback
-                            feedback = self.simulation_response_helper(
+                                prompt_message = f"product do not exist in environment, valid IDs are [{shown_ids}]"  # id should be unique
+                        elif len(split) == 2 and not split[1].isdigit() or len(split) != 2:
+                            prompt_message = "invalid buy additional data format, please only provide product id or product_id:id"
+                        elif len(split) == 2 and split[1].isdigit():
+                            product_to_buy = [
+                                p for p in self.products if int(p.id) == int(split[1])
+                            ]
+                            if len(product_to_buy) != 1:
+                                prompt_message = f"product do not exist in environment, valid IDs are [{shown_ids}]"  # id should be unique
+                    if (
+                        product_to_buy is None
+                        or len(product_to_buy) != 1
+                    ):
+                        prompt_message = f"Attempted to buy product with id {data_bundle}, but {prompt_message}"
+                        print("Obtained invalid action, retrying:", prompt_message)
+                        action = decide(prompt_message)
+                    else:
+                        # add BUY action to memory and also db, and yield the event out to facilitate returning to backend
+                        yield self.create_decision_event(
+                            agent, "BUY", product_to_buy[0], action["reason"], "llm"
+                        )
+                        # generate feedback
+                        return (
+                            yield from self.give_feedback(
+                                pending_feedbacks,
                                 action="BUY",
                                 reason=action["reason"],
-                                env_desc=self.env_desc,
                                 product=product_to_buy[0],
                                 agent=agent,
                             )
-                            agent.add_to_memory(feedback["feedback"])
-                            feedback_event = SimulationEvent.create(
-                                agent=agent_model,
-                                sim_id=self.id,
-                                type="ACTION_RESP",
-                                content=feedback["feedback"],
-                                cycle=self.cycle,
-                            )
-                            yield feedback_event
-                            break
-                    case "SKIP":
-                        # add SKIP action to memory and also db
-                        agent.add_to_memory(f"You did not buy anything with reason \"{action['reason']}\"")
-                        # create the SKIP event and yield it out to facilitate returning to backend
-                        event = SimulationEvent.create(
-                            agent=agent_model,
-                            sim_id=self.id,
-                            type="SKIP",
-                            content=action['reason'],
-                            cycle=self.cycle,
                         )
-                        yield event
-                        # generate feedback
-                        feedback = self.simulation_response_helper(
+                case "SKIP":
+                    # add SKIP action to memory and also db, and yield the event out to facilitate returning to backend
+                    yield self.create_decision_event(
+                        agent, "SKIP", None, action["reason"], "llm"
+                    )
+                    # generate feedback
+                    return (
+                        yield from self.give_feedback(
+                            pending_feedbacks,
                             action="SKIP",
                             reason=action["reason"],
-                            env_desc=self.env_desc,
                             product=None,
                             agent=agent,
                         )
-                        agent.add_to_memory(feedback["feedback"])
-                        feedback_event = SimulationEvent.create(
-                            agent=agent_model,
-                            sim_id=self.id,
-                            type="ACTION_RESP",
-                            content=feedback["feedback"],
-                            cycle=self.cycle,
-                        )
-                        yield feedback_event
-                        break
-                    case "MESSAGE":
-                        prompt_message = ""
-                        agent_to_talk = None
-                        # check if recepient exist
-                        data_bundle = action["additional_data_id"]
-                        # try give bigger tolerance, LLM output hard to control
-                        # tolerate two cases: agent_id:id or id
-                        if str(data_bundle).isdigit():
-                            agent_to_talk = [
-                                a for a in self.agents if int(a.id) == int(data_bundle)
-                            ]
+                    )
+                case "MESSAGE":
+                    prompt_message = ""
+                    agent_to_talk = None
+                    # check if recepient exist
+                    data_bundle = action["additional_data_id"]
+                    # try give bigger tolerance, LLM output hard to control
+                    # tolerate two cases: agent_id:id or id
+                    if str(data_bundle).isdigit():
+                        agent_to_talk = self.find_agents(data_bundle)
+                        if len(agent_to_talk) != 1:
+                            prompt_message = f"agent do not exist in environment, valid IDs are [{visible_ids}]"  # id should be unique
+                    else:
+                        split = data_bundle.split(":")
+                        if len(split) > 2:
+                            prompt_message = "invalid message additional data format, please provide only the agent id or agent_id:id"
+                        if len(split) == 1 and split[0].isdigit():
+                            agent_to_talk = self.find_agents(split[0])
                             if len(agent_to_talk) != 1:
-                                prompt_message = f"agent do not exist in environment, valid IDs are [{','.join([str(a.id) for a in self.agents if int(a.id) != agent.id])}]"  # id should be unique
-                        else:
-                            split = data_bundle.split(":")
-                            if len(split) > 2:
-                                prompt_message = "invalid message additional data format, please provide only the agent id or agent_id:id"
-                            if len(split) == 1 and split[0].isdigit():
-                                agent_to_talk = [
-                                    a for a in self.agents if int(a.id) == int(split[0])
-                                ]
-                                if len(agent_to_talk) != 1:
-                                    prompt_message = f"agent do not exist in environment, , valid IDs are [{','.join([str(a.id) for a in self.agents if int(a.id) != agent.id])}]"  # id should be unique
-                            elif len(split) == 2 and not split[1].isdigit() or len(split) != 2:
-                                prompt_message = "invalid talk additional data format, please provide only the agent id or agent_id:id"
-                            elif len(split) == 2 and split[1].isdigit():
-                                agent_to_talk = [
-                                    a for a in self.agents if int(a.id) == int(split[1])
-                                ]
-                                if len(agent_to_talk) != 1:
-                                    prompt_message = f"agent do not exist in environment, , valid IDs are [{','.join([str(a.id) for a in self.agents if int(a.id) != agent.id])}]"  # id should be unique
-
-                        if (len(agent_to_talk) == 1 and int(agent_to_talk[0].id) == int(agent.id)):
-                            prompt_message = f"you cannot message yourself, valid IDs are [{','.join([str(a.id) for a in self.agents if int(a.id) != agent.id])}]"
-
-                        if agent_to_talk is None or len(agent_to_talk) != 1:
-                            prompt_message = f"Attempted to message agent with id {data_bundle}, but {prompt_message}"
-                            print("Obtained invalid action, retrying:", prompt_message)
-                            action = agent.get_action(
-                                self.env_desc,
-                                prompt_message,
-                                self.products,
-                                self.agents,
-                            )
-                        else:
-                            # if prompt message has not been set then should be no error alrd
-                            if prompt_message == "":
-                                prompt_message = f"Agent {agent.id} sends you a message:{action['additional_data_content']}, what would you like to reply?"
-                            # add to memory of the sending agent so it is aware that it sent a message to another agent
-                            agent.add_to_memory(
-                                f"You sent agent {agent_to_talk[0].id} a message: {action['additional_data_content']}"
-                            )
-                            # create the MESSAGE event and yield it out to facilitate returning to backend
-                            event = SimulationEvent.create(
-                                agent=agent_model,
-                                sim_id=self.id,
-                                type="MESSAGE",
-                                content=f"{agent_to_talk[0].id}:{action['additional_data_content']}",
-                                cycle=self.cycle,
-                            )
-                            yield event
-                            # agent_to_talk model
-                            agent_model_next = AgentInfo.select().where(AgentInfo.agent_id == agent_to_talk[0].id)
-                            action_next = agent_to_talk[0].get_talk_response(
-                                self.env_desc, prompt_message, self.products, [agent]
-                            )  # message obtained from other agent, reforward to this agent and can rerun this big while loop
-                            reply_event = SimulationEvent.create(
-                                agent=agent_model_next,
-                                sim_id=self.id,
-                                type="MESSAGE",
-                                content=f"{agent.id}:{action_next['message']}",
-                                cycle=self.cycle,
-                            )
-                            yield reply_event
-                            # can no need care if it's return to this agent d, just forward back
-                            action = agent.get_action(
-                                self.env_desc,
-                                f"Agent {agent_to_talk[0].id} replies you:{action_next['message']}",
-                                self.products,
-                                self.agents,
-                                should_add_memory=True,
-                            )
-        self.cycle += 1
+                                prompt_message = f"agent do not exist in environment, , valid IDs are [{visible_ids}]"  # id should be unique
+                        elif len(split) == 2 and not split[1].isdigit() or len(split) != 2:
+                            prompt_message = "invalid talk additional data format, please provide only the agent id or agent_id:id"
+                        elif len(split) == 2 and split[1].isdigit():
+                            agent_to_talk = self.find_agents(split[1])
+                            if len(agent_to_talk) != 1:
+                                prompt_message = f"agent do not exist in environment, , valid IDs are [{visible_ids}]"  # id should be unique
+
+                    if agent_to_talk is not None and len(agent_to_talk) == 1 and int(agent_to_talk[0].id) == int(agent.id):
+                        prompt_message = f"you cannot message yourself, valid IDs are [{visible_ids}]"
+                        agent_to_talk = None
+                    elif agent_to_talk is not None and len(agent_to_talk) == 1 and self.social is not None and not self.social.is_neighbour(agent, agent_to_talk[0].id):
+                        prompt_message = f"you do not know agent {agent_to_talk[0].id}, valid IDs are [{visible_ids}]"
+                        agent_to_talk = None
+
+                    if agent_to_talk is None or len(agent_to_talk) != 1:
+                        prompt_message = f"Attempted to message agent with id {data_bundle}, but {prompt_message}"
+                        print("Obtained invalid action, retrying:", prompt_message)
+                        action = decide(prompt_message)
+                    else:
+                        # if prompt message has not been set then should be no error alrd
+                        if prompt_message == "":
+                            prompt_message = f"Agent {agent.id} sends you a message:{action['additional_data_content']}, what would you like to reply?"
+                        # add to memory of the sending agent so it is aware that it sent a message to another agent
+                        agent.add_to_memory(
+                            f"You sent agent {agent_to_talk[0].id} a message: {action['additional_data_content']}"
+                        )
+                        # create the MESSAGE event and yield it out to facilitate returning to backend
+                        yield self.new_event(
+                            "MESSAGE",
+                            f"{agent_to_talk[0].id}:{action['additional_data_content']}",
+                            agent=agent,
+                        )
+                        dialogue_turns += 1
+                        action_next = agent_to_talk[0].get_talk_response(
+                            self.env_desc, prompt_message, self.products, [agent]
+                        )  # message obtained from other agent, reforward to this agent and can rerun this big while loop
+                        yield self.new_event(
+                            "MESSAGE",
+                            f"{agent.id}:{action_next['message']}",
+                            agent=agent_to_talk[0],
+                        )
+                        # can no need care if it's return to this agent d, just forward back
+                        action = decide(
+                            f"Agent {agent_to_talk[0].id} replies you:{action_next['message']}",
+                            should_add_memory=True,
+                        )
 
     def run_simulation(self):
         if not self.inited:
-            for simulation_init_event in self.init_simulation():
+            prefill_prompt_prefix("agent_action", get_shared_prompt_prefix(self.env_desc))
+            for simulation_init_event in iter_with_token_meter(self.tokens, self.init_simulation()):
                 yield simulation_init_event
-            self.cycle = 1 # init is 0, init finish become 1
+            self.cycle = self.start_cycle if not self.resume else self.resume_cycle # init is 0, init finish become 1 (or the fork cycle for a fork)
         while self.cycle <= self.total_cycle:
-            for event in self.proceed_cycle():
+            for event in iter_with_token_meter(self.tokens, self.proceed_cycle()):
+                self.analytics.record(event)
                 yield event
         print("Simulation completed")
 
 
+# runs a generator to the end, returns what it yielded and what it returned
+def collect(gen) -> tuple[list, any]:
+    items = []
+    while True:
+        try:
+            items.append(next(gen))
+        except StopIteration as stop:
+            return items, stop.value
+
+
+DECISION_ACTIONS = {k: v for k, v in Agent.actions.items() if k != "MESSAGE"}
+
+
+def roll_should_positive() -> bool:
+    return recorded("random", "should_positive", None, lambda: random.randrange(1, 10)) > 6 # 5050 chance to be positive
+
+
+class CycleProgress:
+    def __init__(self, deciders: list[Agent], start_tokens: int) -> None:
+        self.deciders = deciders  # kept so a resumed cycle does not pick a different sample in population mode
+        self.next_decider = 0  # index of the decider taking the next turn
+        self.outcomes: list[ActionOutcome] = []
+        self.pending_feedbacks: list[ActionOutcome] = []  # only used in batch feedback mode
+        self.start_tokens = start_tokens  # tokens the simulation used before the cycle
+        self.forced_decisions = 0  # turns where the agent had to BUY or SKIP because of a dialogue limit or budget
+        self.time_used = 0.0  # seconds spent on the cycle's LLM work, for the cycle deadline
+
+
+# a BUY/SKIP decision of an agent and its feedback (filled in later in batch feedback mode), should_positive is rolled when the action is taken so every agent keeps its own roll
+class ActionOutcome:
+    __slots__ = ("action", "reason", "product", "agent", "should_positive", "feedback", "from_surrogate", "timed_out")
+
+    def __init__(
+        self,
+        action: str,
+        reason: str,
+        product: Product,
+        agent: Agent,
+        should_positive: bool,
+    ) -> None:
+        self.action = action
+        self.reason = reason
+        self.product = product
+        self.agent = agent
+        self.should_positive = should_positive
+        self.feedback: str = None
+        self.from_surrogate = False
+        self.timed_out = False  # fallback decision of an agent that did not decide in time
+
+    def to_prompt_str(self):
+        product_desc = self.product.desc if self.product is not None else "Agent did not buy any product"
+        return f"(agent_id:{self.agent.id},event:{'positive' if self.should_positive else 'negative'},action:{self.action},reason:{self.reason},purchased_product_details:{product_desc},agent_description:{self.agent.sim_desc_3rd})"
+
+
 # helper object to get structured response
 class SimulationActionResp(BaseModel):
     feedback: str = Field(
         description="the feedback to be given to the agent that performed the action"
     )
+
+
+class SimulationActionRespBatch(BaseModel):
+    feedbacks: list[dict] = Field(
+        description="a list with one object for every agent action, each object has key agent_id with the id of the agent that performed the action and key feedback with the feedback to be given to that agent"
+    )
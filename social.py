@@ -0,0 +1,92 @@
+# social graph of a simulation, each agent only sees and can message its neighbours so the agent list in a prompt stays the same size however large the roster is
+# neighbours are either given with the agents, or generated as a small world (ring of neighbours with a few random shortcuts) or the k nearest agents by persona
+# adjacency is kept as CSR arrays (offsets + sorted neighbour indices), the rendered neighbour list of an agent is built once and reused in every prompt
+import numpy as np
+
+from agent import Agent
+from population import featurize
+
+KNN_BLOCK = 1024  # agents compared at a time when finding nearest neighbours, bounds the similarity matrix to block x agents
+
+
+class SocialGraph:
+    # src and dst are indices into agents, edges are made undirected and duplicates and self loops are dropped
+    def __init__(self, agents: list[Agent], src: np.ndarray, dst: np.ndarray, kind: str) -> None:
+        self.agents = agents
+        self.kind = kind
+        self.index = {int(a.id): i for i, a in enumerate(agents)}  # agent id -> index
+        src, dst = np.concatenate([src, dst]), np.concatenate([dst, src])
+        keep = src != dst
+        edges = np.unique(np.stack([src[keep], dst[keep]], axis=1).astype(np.int32), axis=0)  # sorted by src then dst
+        self.indices = edges[:, 1].copy()
+        self.offsets = np.zeros(len(agents) + 1, dtype=np.int64)  # neighbours of agent i are indices[offsets[i]:offsets[i + 1]]
+        np.cumsum(np.bincount(edges[:, 0], minlength=len(agents)), out=self.offsets[1:])
+        self.rendered: dict[int, str] = {}  # agent id -> neighbour list as put in the prompt
+
+    def neighbour_indices(self, agent: Agent) -> np.ndarray:
+        i = self.index[int(agent.id)]
+        return self.indices[self.offsets[i] : self.offsets[i + 1]]
+
+    def neighbours(self, agent: Agent) -> list[Agent]:
+        return [self.agents[j] for j in self.neighbour_indices(agent)]
+
+    def is_neighbour(self, agent: Agent, other_id: int) -> bool:
+        j = self.index.get(int(other_id))
+        if j is None:
+            return False
+        row = self.neighbour_indices(agent)
+        k = np.searchsorted(row, j)
+        return k < len(row) and row[k] == j
+
+    def render(self, agent: Agent) -> str:
+        if int(agent.id) not in self.rendered:
+            self.rendered[int(agent.id)] = f"[{','.join([a.to_prompt_str() for a in self.neighbours(agent)])}]"
+        return self.rendered[int(agent.id)]
+
+    def string(self) -> str:
+        degrees = np.diff(self.offsets)
+        return f"{self.kind} graph of {len(self.agents)} agents, degree avg {degrees.mean() if len(degrees) > 0 else 0:.1f} max {degrees.max() if len(degrees) > 0 else 0}"
+
+
+# neighbours given with the agents (agent id -> neighbour ids), ids not in the roster are ignored
+def configured_graph(agents: list[Agent], neighbours: dict[int, list[int]]) -> SocialGraph:
+    index = {int(a.id): i for i, a in enumerate(agents)}
+    pairs = [
+        (index[agent_id], index[int(n)])
+        for agent_id, ids in neighbours.items()
+        if agent_id in index
+        for n in ids
+        if int(n) in index
+    ]
+    src = np.array([p[0] for p in pairs], dtype=np.int32)
+    dst = np.array([p[1] for p in pairs], dtype=np.int32)
+    return SocialGraph(agents, src, dst, "configured")
+
+
+# watts-strogatz: every agent knows the degree/2 agents on each side of it in the roster, each of those links is rewired to a random agent with probability rewire
+def small_world_graph(agents: list[Agent], degree: int, rewire: float, seed: int = None) -> SocialGraph:
+    n = len(agents)
+    rng = np.random.default_rng(seed)
+    half = max(1, min(degree // 2, (n - 1) // 2))
+    src = np.repeat(np.arange(n), half)
+    dst = (src + np.tile(np.arange(1, half + 1), n)) % n
+    rewired = rng.random(len(dst)) < rewire
+    dst[rewired] = rng.integers(0, n, rewired.sum())  # self loops and duplicates are dropped by SocialGraph
+    return SocialGraph(agents, src, dst, "small world")
+
+
+# every agent knows the degree agents with the most similar persona (attributes and description, same features as population mode)
+def knn_graph(agents: list[Agent], descs: list[str], degree: int) -> SocialGraph:
+    n = len(agents)
+    k = max(1, min(degree, n - 1))
+    features = featurize(agents, descs)
+    src, dst = [], []
+    for start in range(0, n, KNN_BLOCK):
+        block = features[start : start + KNN_BLOCK]
+        similarity = block @ features.T
+        rows = np.arange(len(block))
+        similarity[rows, rows + start] = -np.inf  # not your own neighbour
+        nearest = np.argpartition(-similarity, k - 1, axis=1)[:, :k]
+        src.append(np.repeat(rows + start, k))
+        dst.append(nearest.reshape(-1))
+    return SocialGraph(agents, np.concatenate(src), np.concatenate(dst), "nearest persona")
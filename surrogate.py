@@ -0,0 +1,292 @@
+# optional surrogate that answers routine BUY/SKIP decisions locally instead of asking the LLM
+# it is a conditional logit (multinomial logistic regression over the options SKIP and every product) trained online from the simulation's own events
+import threading
+
+import numpy as np
+
+from agent import Agent
+from db import AgentInfo, SimulationEvent, get_lineage, in_lineage, iter_lineage
+from product import Product
+
+SKIP = 0  # choice key of SKIP, any other choice key is the id of the bought product
+FIT_ITERATIONS = 200
+LEARNING_RATE = 0.5
+L2 = 1e-3
+DEFAULT_REASON = "Sticking to what I usually do"
+# fits use the latest LLM decisions only, the dataset is records x options x features so it would grow with the run length and the catalog size
+FIT_MAX_RECORDS = 2000
+FIT_MAX_VALUES = 4_000_000  # ~32MB of float64, fewer records are used for large catalogs
+TIMEOUT_REASON = "Ran out of time to decide"  # reason of the fallback decisions (see Simulation.timeout_turn)
+
+
+class SurrogatePrediction:
+    __slots__ = ("choice", "confidence")
+
+    def __init__(self, choice: int, confidence: float) -> None:
+        self.choice = choice
+        self.confidence = confidence
+
+
+# a BUY/SKIP decision seen by the surrogate, only decisions made by the LLM are used as training labels
+class SurrogateRecord:
+    __slots__ = ("agent_id", "cycle", "choice", "price", "llm_decided")  # one per decision for the whole simulation
+
+    def __init__(
+        self, agent_id: int, cycle: int, choice: int, price: float, llm_decided: bool
+    ) -> None:
+        self.agent_id = agent_id
+        self.cycle = cycle
+        self.choice = choice
+        self.price = price
+        self.llm_decided = llm_decided
+
+
+class SurrogateStats:
+    def __init__(self) -> None:
+        self.local = 0  # decisions answered by the surrogate
+        self.llm = 0  # decisions that went to the LLM (low confidence, calibration or not trained yet)
+        self.checks = 0  # LLM decisions that had a surrogate prediction to compare against
+        self.agreements = 0
+        self.calibration_checks = 0  # confident predictions sent to the LLM anyways
+        self.calibration_agreements = 0
+
+    def string(self) -> str:
+        total = self.local + self.llm
+        return (
+            f"local={self.local}/{total},"
+            f"agreement={rate_str(self.agreements, self.checks)},"
+            f"calibration_agreement={rate_str(self.calibration_agreements, self.calibration_checks)}"
+        )
+
+
+def rate_str(n: int, d: int) -> str:
+    return f"{n}/{d}({n / d:.0%})" if d > 0 else "0/0"
+
+
+class SurrogateModel:
+    def __init__(
+        self,
+        agents: list[Agent],
+        products: list[Product],
+        confidence_threshold: float = 0.8,
+        calibration_rate: float = 0.1,
+        min_cycles: int = 2,
+        seed: int = None,
+    ) -> None:
+        self.confidence_threshold = confidence_threshold
+        self.calibration_rate = calibration_rate
+        self.min_cycles = min_cycles
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.records: list[SurrogateRecord] = []
+        self.reasons: dict[tuple[int, int], str] = {}  # (agent id, choice) -> latest reason, for the decisions made locally
+        self.total_stats = SurrogateStats()
+        self.cycle_stats = SurrogateStats()
+        self.weights: np.ndarray = None
+        self.fitted_cycles = 0  # cycles of LLM decisions the current weights were trained on
+        self.set_agents(agents)
+        self.set_products(products)
+
+    def set_agents(self, agents: list[Agent]):
+        self.attr_vocab: dict[str, int] = {}
+        self.agent_attrs: dict[int, list[int]] = {}  # agent id -> indices of its attributes in vocab
+        for agent in agents:
+            self.agent_attrs[int(agent.id)] = [
+                self.attr_vocab.setdefault(
+                    f"{attr.key.strip().lower()}={attr.value.strip().lower()}",
+                    len(self.attr_vocab),
+                )
+                for attr in agent.attrs
+            ]
+        self.weights = None
+
+    # options are SKIP and every product, changing products changes the shape of the features so the model is refitted
+    def set_products(self, products: list[Product]):
+        self.options = [SKIP] + [int(p.id) for p in products]
+        self.option_index = {choice: i for i, choice in enumerate(self.options)}
+        self.prices = {int(p.id): float(p.price) for p in products}
+        self.weights = None
+        # running history per agent so predicting does not replay every record
+        self.counts: dict[int, np.ndarray] = {}  # agent id -> number of times each option was chosen
+        self.last: dict[int, int] = {}  # agent id -> index of the last option chosen
+        for record in self.records:
+            self.update_history(record)
+
+    def update_history(self, record: SurrogateRecord):
+        if record.choice not in self.option_index:
+            return
+        idx = self.option_index[record.choice]
+        self.counts.setdefault(record.agent_id, np.zeros(len(self.options)))[idx] += 1
+        self.last[record.agent_id] = idx
+
+    # rebuilds the records from the BUY/SKIP events in db (eg. after a restart or an interrupted initialisation, or the parent's events for a fork)
+    # same records as the live path: the LLM's decisions as labels, the surrogate's own only for the habit features, followers and fallbacks not at all
+    def load_history(self, sim_id: int):
+        with self.lock:
+            self.records = []
+            self.counts = {}
+            self.last = {}
+        events = iter_lineage(
+            get_lineage(sim_id),
+            lambda sim_id, until_cycle: SimulationEvent.select(SimulationEvent, AgentInfo)
+            .join(AgentInfo)
+            .where(
+                in_lineage([(sim_id, until_cycle)], SimulationEvent.sim_id, SimulationEvent.cycle)
+                & (SimulationEvent.type.in_(["BUY", "SKIP"]))
+                & ((SimulationEvent.decided_by.in_(["llm", "surrogate"])) | (SimulationEvent.decided_by.is_null()))
+            )
+            .order_by(SimulationEvent.id),
+        )
+        for event in events:
+            if event.type == "BUY":
+                product_id, reason = event.content.split(":", 1)
+                choice = int(product_id)
+            else:
+                choice, reason = SKIP, event.content
+            if event.decided_by is None and reason == TIMEOUT_REASON:
+                continue  # fallback written before decided_by was stored, followers from then cannot be told apart from the LLM
+            self.add_record(int(event.agent.agent_id), event.cycle, choice, reason, event.decided_by != "surrogate")
+        self.fit()
+
+    def add_record(self, agent_id: int, cycle: int, choice: int, reason: str, llm_decided: bool):
+        with self.lock:
+            record = SurrogateRecord(agent_id, cycle, choice, self.prices.get(choice, 0.0), llm_decided)
+            self.records.append(record)
+            self.update_history(record)
+            self.reasons[(agent_id, choice)] = reason
+
+    def feature_size(self) -> int:
+        # skip indicator, product one hot, price, attrs x skip, attrs x price, habit, last choice
+        return 1 + (len(self.options) - 1) + 1 + 2 * len(self.attr_vocab) + 2
+
+    # features of every option for an agent given its past choices (counts per option and last option index)
+    def option_features(
+        self, agent_id: int, prices: np.ndarray, counts: np.ndarray, last: int
+    ) -> np.ndarray:
+        n_options = len(self.options)
+        n_attrs = len(self.attr_vocab)
+        x = np.zeros((n_options, self.feature_size()))
+        x[0, 0] = 1.0
+        x[np.arange(1, n_options), np.arange(1, n_options)] = 1.0
+        scaled_price = np.log1p(prices)
+        x[:, n_options] = scaled_price
+        attrs = np.zeros(n_attrs)
+        attrs[self.agent_attrs.get(agent_id, [])] = 1.0
+        offset = n_options + 1
+        x[0, offset : offset + n_attrs] = attrs
+        x[:, offset + n_attrs : offset + 2 * n_attrs] = scaled_price[:, None] * attrs[None, :]
+        total = counts.sum()
+        x[:, -2] = counts / total if total > 0 else 0.0
+        if last >= 0:
+            x[last, -1] = 1.0
+        return x
+
+    def current_prices(self) -> np.ndarray:
+        return np.array([0.0] + [self.prices[choice] for choice in self.options[1:]])
+
+    # replays the records in order, building the features each decision had at the time it was made
+    # only the latest LLM decisions that fit in the window become training rows, the older ones still count for the habit features
+    def build_dataset(self) -> tuple[np.ndarray, np.ndarray]:
+        window = min(FIT_MAX_RECORDS, max(1, FIT_MAX_VALUES // (len(self.options) * self.feature_size())))
+        labelled = [r for r in self.records if r.llm_decided and r.choice in self.option_index]
+        skip = len(labelled) - window
+        counts: dict[int, np.ndarray] = {}
+        last: dict[int, int] = {}
+        xs, ys = [], []
+        for record in self.records:
+            if record.choice not in self.option_index:
+                continue  # product no longer in the simulation
+            agent_counts = counts.setdefault(record.agent_id, np.zeros(len(self.options)))
+            idx = self.option_index[record.choice]
+            if record.llm_decided and skip > 0:
+                skip -= 1
+            elif record.llm_decided:
+                prices = self.current_prices()
+                if record.choice != SKIP:
+                    prices[idx] = record.price  # price at the time of the decision
+                xs.append(
+                    self.option_features(record.agent_id, prices, agent_counts, last.get(record.agent_id, -1))
+                )
+                ys.append(idx)
+            agent_counts[idx] += 1
+            last[record.agent_id] = idx
+        if len(xs) == 0:
+            return None, None
+        return np.stack(xs), np.array(ys)
+
+    # full batch gradient descent on the softmax over options, warm started from the last fit
+    def fit(self):
+        with self.lock:
+            x, y = self.build_dataset()
+            if x is None:
+                return
+            n = x.shape[0]
+            w = self.weights if self.weights is not None else np.zeros(x.shape[2])
+            targets = np.zeros((n, x.shape[1]))
+            targets[np.arange(n), y] = 1.0
+            for _ in range(FIT_ITERATIONS):
+                logits = x @ w
+                probs = softmax(logits)
+                grad = np.einsum("nod,no->d", x, probs - targets) / n + L2 * w
+                w = w - LEARNING_RATE * grad
+            self.weights = w
+            self.fitted_cycles = len(set([record.cycle for record in self.records if record.llm_decided]))
+
+    # returns None when the surrogate has not seen enough cycles to be trusted
+    def predict(self, agent: Agent) -> SurrogatePrediction:
+        with self.lock:
+            if self.weights is None or self.fitted_cycles < self.min_cycles:
+                return None
+            agent_id = int(agent.id)
+            counts = self.counts.get(agent_id, np.zeros(len(self.options)))
+            x = self.option_features(agent_id, self.current_prices(), counts, self.last.get(agent_id, -1))
+            probs = softmax(x @ self.weights)
+            best = int(probs.argmax())
+            return SurrogatePrediction(self.options[best], float(probs[best]))
+
+    def is_confident(self, prediction: SurrogatePrediction) -> bool:
+        return prediction is not None and prediction.confidence >= self.confidence_threshold
+
+    # confident predictions still go to the LLM once in a while to keep measuring how often the surrogate agrees
+    def should_calibrate(self) -> bool:
+        return self.rng.random() < self.calibration_rate
+
+    def get_reason(self, agent: Agent, choice: int) -> str:
+        return self.reasons.get((int(agent.id), choice), DEFAULT_REASON)
+
+    # records a decision and compares it against the surrogate's prediction if the LLM made it
+    def observe(
+        self,
+        agent: Agent,
+        cycle: int,
+        choice: int,
+        reason: str,
+        prediction: SurrogatePrediction,
+        llm_decided: bool,
+    ):
+        self.add_record(int(agent.id), cycle, choice, reason, llm_decided)
+        for stats in [self.total_stats, self.cycle_stats]:
+            if not llm_decided:
+                stats.local += 1
+                continue
+            stats.llm += 1
+            if prediction is None:
+                continue
+            agreed = prediction.choice == choice
+            stats.checks += 1
+            stats.agreements += agreed
+            if self.is_confident(prediction):
+                stats.calibration_checks += 1
+                stats.calibration_agreements += agreed
+
+    # refits with the cycle's decisions and returns the report of the cycle
+    def end_cycle(self) -> str:
+        self.fit()
+        report = f"this cycle {self.cycle_stats.string()}; overall {self.total_stats.string()}"
+        self.cycle_stats = SurrogateStats()
+        return report
+
+
+def softmax(logits: np.ndarray) -> np.ndarray:
+    e = np.exp(logits - logits.max(-1, keepdims=True))
+    return e / e.sum(-1, keepdims=True)
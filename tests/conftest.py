@@ -0,0 +1,82 @@
+# shared setup of the tests that run simulations in process against stand-in model servers (see fake_model_server.py)
+# the core reads its env when a simulation is created, so every test sets its own with monkeypatch, only the catalog db is picked on import
+# every test uses its own simulation ids since they share the catalog db
+import os
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+os.environ["DB_FILE"] = os.path.join(tempfile.mkdtemp(), "tests.db")  # read when db is imported, never the db of the machine running the tests
+
+import backend_pool  # noqa: E402
+from backend_pool import BackendPool  # noqa: E402
+from fake_model_server import FakeModelHandler  # noqa: E402
+from proto import marcom_core_pb2  # noqa: E402
+
+
+def to_request(sim_id: int, num_agents: int, cycles: int, prices: list[float] = None) -> marcom_core_pb2.SimulationRequest:
+    prices = prices or [10, 20, 30]
+    return marcom_core_pb2.SimulationRequest(
+        id=sim_id,
+        env_desc="a small town",
+        total_cycles=cycles,
+        agents=[
+            marcom_core_pb2.Agent(id=i, name=f"agent {i}", desc="a shopper", attrs=[marcom_core_pb2.AgentAttribute(key="age", value="30")])
+            for i in range(1, num_agents + 1)
+        ],
+        products=[
+            marcom_core_pb2.Product(id=i, name=f"product {i}", desc="a product", price=price, cost=price * 0.4)
+            for i, price in enumerate(prices, start=1)
+        ],
+    )
+
+
+# steps the simulation the way a stream does until it completes, or until stop_after returns True for an update
+def run(servicer, request_or_sim, stop_after=None) -> list[marcom_core_pb2.SimulationUpdate]:
+    sim = servicer.add_simulation(request_or_sim) if isinstance(request_or_sim, marcom_core_pb2.SimulationRequest) else request_or_sim
+    updates = []
+    while True:
+        update = servicer.next_update(sim)
+        assert update is not None
+        updates.append(update)
+        if update.action == "COMPLETE" or (stop_after is not None and stop_after(update)):
+            return updates
+
+
+# a simulation run in this process with the db in the test's own dir and nothing from the env of the machine running the tests
+@pytest.fixture
+def core(monkeypatch, tmp_path):
+    monkeypatch.setenv("DB_SHARDING", "false")
+    monkeypatch.setenv("DB_SHARD_DIR", str(tmp_path / "shards"))
+    monkeypatch.setenv("DB_ARCHIVE_DIR", str(tmp_path / "archive"))
+    monkeypatch.setenv("LLM_CASSETTE", "")
+    monkeypatch.setenv("CASSETTE_DIR", str(tmp_path / "cassettes"))
+    monkeypatch.setenv("LLM_WARM_UP", "false")
+    monkeypatch.setenv("RESEARCH_CACHE", "false")
+    monkeypatch.setenv("SIMULATION_WORKERS", "0")
+    monkeypatch.setenv("BATCH_FEEDBACK", "false")
+    from db import SHARDED_TABLES, ResearchReport, SimulationShard, db, migrate_db
+
+    db.connect(reuse_if_open=True)
+    migrate_db(SHARDED_TABLES + [SimulationShard, ResearchReport])
+    return tmp_path
+
+
+# starts a stand-in model server answering with the handler and routes the core's calls to it, stopped after the test
+@pytest.fixture
+def model_server(monkeypatch):
+    servers = []
+
+    def start(handler: type = FakeModelHandler) -> ThreadingHTTPServer:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        monkeypatch.setattr(backend_pool, "backend_pool", BackendPool([f"http://127.0.0.1:{server.server_address[1]}"], health_interval=0))
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,108 @@
+# the backend pool against several stand-in model servers on local ports, calls go through RoutedChain like the core's call sites
+# python -m pytest tests
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import backend_pool
+from backend_pool import BackendPool
+from fake_model_server import FakeModelHandler
+from llm import RoutedChain
+
+PROMPT = 'Reply with a JSON object with the key "message"'
+
+
+class SlowHandler(FakeModelHandler):
+    latency = 0.3  # long enough for concurrent calls to overlap
+
+
+def start_server(port: int = 0) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", port), SlowHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get_url(server: ThreadingHTTPServer) -> str:
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# a port nothing listens on
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def servers():
+    servers = [start_server() for _ in range(3)]
+    yield servers
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+# the pool the core's calls go through for the test, no background health checks so the test decides when they run
+def use_pool(monkeypatch, urls: list[str]) -> BackendPool:
+    pool = BackendPool(urls, health_interval=0, health_timeout=1)
+    monkeypatch.setattr(backend_pool, "backend_pool", pool)
+    return pool
+
+
+def call(affinity_key: str = None) -> str:
+    return RoutedChain("talk_response", lambda llm: llm).invoke(PROMPT, affinity_key)
+
+
+def test_calls_spread_over_servers(monkeypatch, servers):
+    pool = use_pool(monkeypatch, [get_url(s) for s in servers])
+    with ThreadPoolExecutor(max_workers=9) as executor:
+        results = list(executor.map(lambda _: call(), range(9)))
+    assert all(['"message"' in r for r in results])
+    calls = [b.calls for b in pool.backends]
+    assert sum(calls) == 9
+    assert min(calls) >= 2  # least loaded first, no server gets left out
+    assert all([b.in_flight == 0 and b.latency is not None for b in pool.backends])
+
+
+def test_agent_stays_on_its_server(monkeypatch, servers):
+    pool = use_pool(monkeypatch, [get_url(s) for s in servers])
+    for _ in range(4):
+        call("1:7")
+    assert sorted([b.calls for b in pool.backends]) == [0, 0, 4]
+    assert pool.affinity["1:7"].calls == 4
+
+
+def test_unreachable_server_is_ejected_until_it_is_back(monkeypatch, servers):
+    down_port = get_free_port()
+    pool = use_pool(monkeypatch, [f"http://127.0.0.1:{down_port}", get_url(servers[0])])
+    down, up = pool.backends
+    for _ in range(3):
+        assert '"message"' in call()  # retried on the other server
+    assert not down.healthy and down.failures == 1  # no more calls once ejected
+    assert up.healthy and up.calls == 3
+
+    pool.check_all()
+    assert not down.healthy
+    server = start_server(down_port)
+    try:
+        pool.check_all()
+        assert down.healthy
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda _: call(), range(4)))
+        assert down.calls >= 2  # 1 failed call before, the rest spread over both
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_affinity_keys_are_bounded():
+    pool = BackendPool(["http://127.0.0.1:1", "http://127.0.0.1:2"], health_interval=0, max_affinity_keys=10)
+    for i in range(25):
+        pool.release(pool.acquire(f"1:{i}"), 0.1)
+        pool.release(pool.acquire("1:0"), 0.1)  # called every time, never the least recently called
+    assert len(pool.affinity) == 10
+    assert "1:0" in pool.affinity
+    assert "1:1" not in pool.affinity and "1:24" in pool.affinity
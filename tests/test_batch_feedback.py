@@ -0,0 +1,54 @@
+# batched feedbacks are mapped back to their agents by the agent id in each item, not by position in the reply
+# the stand-in answers a batch in reverse order, leaves out the first agent of the batch and adds an agent that is not in it
+# python -m pytest tests
+import json
+import re
+
+from conftest import run, to_request
+
+from db import AgentInfo, AgentMemory
+from fake_model_server import FakeModelHandler
+from MarcomCoreServicer import MarcomCoreServicer
+
+SIM = 2701
+NUM_AGENTS = 5
+
+
+class ShufflingHandler(FakeModelHandler):
+    message_rate = 0.0  # only BUY and SKIP, every agent gets one feedback
+    left_out: list[int] = []  # first agent of every batch, answered with a single call instead
+
+    def get_answer(self, prompt: str) -> str:
+        if '"feedbacks"' not in prompt:
+            return super().get_answer(prompt)
+        agent_ids = [int(i) for i in re.findall(r"\(agent_id:(\d+),event:", prompt)]
+        self.left_out.append(agent_ids[0])
+        items = [{"agent_id": i, "feedback": f"feedback for agent {i}"} for i in reversed(agent_ids[1:])]
+        items.append({"agent_id": 999, "feedback": "feedback for someone else"})
+        return json.dumps({"feedbacks": items})
+
+
+def test_batched_feedbacks_go_to_their_agents(core, model_server, monkeypatch):
+    monkeypatch.setenv("BATCH_FEEDBACK", "true")
+    monkeypatch.setenv("FEEDBACK_BATCH_SIZE", "2")
+    model_server(ShufflingHandler)
+    updates = run(MarcomCoreServicer(), to_request(SIM, NUM_AGENTS, 1))
+
+    decided = sorted([u.agent_id for u in updates if u.action in ["BUY", "SKIP"]])
+    feedbacks = {u.agent_id: u.content for u in updates if u.action == "ACTION_RESP"}
+    assert decided == list(range(1, NUM_AGENTS + 1))
+    assert sorted(feedbacks) == decided  # one feedback per decision, none for agent 999
+    assert len(ShufflingHandler.left_out) == 3  # 5 agents in batches of 2
+    for agent_id, content in feedbacks.items():
+        if agent_id in ShufflingHandler.left_out:
+            assert content == "it was alright"  # the single call fallback
+        else:
+            assert content == f"feedback for agent {agent_id}"
+    # and remembered by the agent it was for
+    remembered = (
+        AgentMemory.select(AgentInfo.agent_id, AgentMemory.content)
+        .join(AgentInfo)
+        .where((AgentMemory.sim_id == SIM) & (AgentMemory.content.startswith("feedback for")))
+        .tuples()
+    )
+    assert sorted(remembered) == sorted([(i, c) for i, c in feedbacks.items() if c.startswith("feedback for")])
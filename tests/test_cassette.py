@@ -0,0 +1,65 @@
+# a recorded run replays to the same events without a model server, also when a turn of the recorded run was cancelled (paused) and rerun
+# the cancelled turn's calls are left out of the recording, only the tokens they used are kept so the replay's BUDGET events match
+# python -m pytest tests
+import threading
+
+from conftest import run, to_request
+
+from db import SimulationEvent
+from fake_model_server import FakeModelHandler
+from MarcomCoreServicer import MarcomCoreServicer, drop_simulations
+
+SIM = 4301
+
+
+class HoldingHandler(FakeModelHandler):
+    message_rate = 0.3
+    calls = 0
+    reached = threading.Event()
+    release = threading.Event()
+
+    def get_latency(self, prompt: str) -> float:
+        HoldingHandler.calls += 1
+        if '"feedback"' in prompt and "additional_data_id" not in prompt and not self.release.is_set():
+            self.reached.set()
+            self.release.wait(10)
+        return 0.0
+
+
+def step_until_interrupted(servicer: MarcomCoreServicer, sim):
+    while servicer.next_update(sim) is not None:
+        pass
+
+
+def get_events() -> list[tuple]:
+    query = SimulationEvent.select().where(SimulationEvent.sim_id == SIM).order_by(SimulationEvent.id)
+    return [(e.type, e.agent_id, e.content, e.cycle, e.decided_by) for e in query]
+
+
+def test_replay_matches_recording_with_a_cancelled_turn(core, model_server, monkeypatch):
+    monkeypatch.setenv("LLM_CASSETTE", "record")
+    model_server(HoldingHandler)
+    servicer = MarcomCoreServicer()
+    sim = servicer.add_simulation(to_request(SIM, 3, 2))
+
+    # pause in the middle of the first turn, its decision was made (and recorded in the unit) but its feedback is held
+    stepping = threading.Thread(target=step_until_interrupted, args=(servicer, sim))
+    stepping.start()
+    assert HoldingHandler.reached.wait(10)
+    sim.pause_simulation()
+    HoldingHandler.release.set()
+    stepping.join(10)
+    assert not stepping.is_alive()
+    sim.resume_simulation()
+    assert run(servicer, sim)[-1].action == "COMPLETE"
+    recorded_events = get_events()
+    assert len([e for e in recorded_events if e[0] in ["BUY", "SKIP"]]) == 3 * 2
+
+    # replayed from scratch, nothing asks the model server
+    drop_simulations([SIM])
+    assert get_events() == []
+    monkeypatch.setenv("LLM_CASSETTE", "replay")
+    HoldingHandler.calls = 0
+    assert run(MarcomCoreServicer(), to_request(SIM, 3, 2))[-1].action == "COMPLETE"
+    assert HoldingHandler.calls == 0
+    assert get_events() == recorded_events
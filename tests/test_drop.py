@@ -0,0 +1,50 @@
+# dropping a simulation and its forks with sharding, and a shard file deleted by hand not being started over in an empty shard
+# python -m pytest tests
+import os
+
+import pytest
+from conftest import run, to_request
+
+from db import SimulationShard, close_shard, get_shard, simulation_ids
+from MarcomCoreServicer import MarcomCoreServicer, create_fork, drop_simulations, find_simulation_and_forks
+from utils import MissingShardException
+
+PARENT, FORK, FORK_OF_FORK, OTHER, MISSING = 3201, 3202, 3203, 3204, 3205
+
+
+def test_simulation_is_dropped_with_its_forks(core, model_server, monkeypatch):
+    monkeypatch.setenv("DB_SHARDING", "true")
+    model_server()
+    servicer = MarcomCoreServicer()
+    run(servicer, to_request(PARENT, 2, 2))
+    assert create_fork(FORK, PARENT, 2) is None
+    run(servicer, to_request(FORK, 2, 2))
+    assert create_fork(FORK_OF_FORK, FORK, 2) is None
+    run(servicer, to_request(OTHER, 2, 1))
+
+    assert find_simulation_and_forks(PARENT) == [PARENT, FORK, FORK_OF_FORK]
+    assert find_simulation_and_forks(FORK) == [FORK, FORK_OF_FORK]
+    assert find_simulation_and_forks(9999) == []
+
+    paths = [SimulationShard.get(SimulationShard.sim_id == sim_id).path for sim_id in [PARENT, FORK, FORK_OF_FORK]]
+    drop_simulations(find_simulation_and_forks(PARENT))
+    assert not any([os.path.exists(path) for path in paths])
+    assert set(simulation_ids()) & set([PARENT, FORK, FORK_OF_FORK]) == set()
+    assert OTHER in simulation_ids()
+
+
+def test_missing_shard_is_not_recreated(core, model_server, monkeypatch):
+    monkeypatch.setenv("DB_SHARDING", "true")
+    model_server()
+    run(MarcomCoreServicer(), to_request(MISSING, 2, 1))
+    path = SimulationShard.get(SimulationShard.sim_id == MISSING).path
+    close_shard(MISSING)
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    with pytest.raises(MissingShardException):
+        get_shard(MISSING)
+    assert not os.path.exists(path)
+
+    drop_simulations(find_simulation_and_forks(MISSING))  # only the catalog entry is left to drop, then it can be started again
+    assert get_shard(MISSING, create=False) is None
@@ -0,0 +1,61 @@
+# a fork reads the parent's history before the fork cycle from the parent's shard, nothing of it is copied and nothing after it is read
+# python -m pytest tests
+import pyarrow as pa
+from conftest import run, to_request
+
+from agent import Agent
+from db import AgentInfo, AgentMemory, SimulationEvent, get_lineage, use_simulation_db
+from export import iter_event_batches, iter_memory_batches
+from MarcomCoreServicer import MarcomCoreServicer, create_fork
+
+PARENT, FORK, FORK_CYCLE = 4101, 4102, 3
+
+
+def export_rows(batches) -> list[dict]:
+    return pa.Table.from_batches(list(batches)).to_pylist()
+
+
+def test_fork_reads_parent_history_before_fork_cycle(core, model_server, monkeypatch):
+    monkeypatch.setenv("DB_SHARDING", "true")
+    model_server()
+    servicer = MarcomCoreServicer()
+    run(servicer, to_request(PARENT, 3, 4))
+    assert create_fork(FORK, PARENT, FORK_CYCLE) is None
+
+    with use_simulation_db(PARENT, create=False):
+        parent_events = list(SimulationEvent.select().where(SimulationEvent.cycle < FORK_CYCLE).order_by(SimulationEvent.id))
+        parent_memories = [
+            m.content
+            for m in AgentMemory.select()
+            .join(AgentInfo)
+            .where((AgentMemory.cycle < FORK_CYCLE) & (AgentInfo.agent_id == 1))
+            .order_by(AgentMemory.time_created)
+        ]
+        later_memories = AgentMemory.select().where(AgentMemory.cycle >= FORK_CYCLE).count()
+    assert len(parent_memories) > 0 and later_memories > 0
+
+    # an agent of the fork remembers the parent's cycles before the fork cycle, none of the later ones
+    agent = Agent(1, "agent 1", "a shopper", [], FORK)
+    agent.lineage = get_lineage(FORK)
+    assert agent.lineage == [(FORK, None), (PARENT, FORK_CYCLE)]
+    with use_simulation_db(FORK, create=False):
+        assert not agent.init_agent()  # the parent's rewritten description, no LLM call
+    assert [content for _, content in agent.memory] == parent_memories[-len(agent.memory):]
+
+    updates = run(servicer, to_request(FORK, 3, 4))
+    assert set([u.cycle for u in updates if u.action in ["BUY", "SKIP"]]) == {3, 4}  # only its own cycles are run
+
+    # the fork's shard only holds what the fork wrote
+    with use_simulation_db(FORK, create=False):
+        assert SimulationEvent.select().where(SimulationEvent.sim_id != FORK).count() == 0
+        assert AgentMemory.select().where(AgentMemory.sim_id != FORK).count() == 0
+        fork_events = SimulationEvent.select().count()
+
+    # its history is the parent's rows before the fork cycle followed by its own
+    with use_simulation_db(FORK, create=False):
+        events = export_rows(iter_event_batches(FORK))
+        memories = export_rows(iter_memory_batches(FORK))
+    assert [(e["sim_id"], e["id"]) for e in events] == [(PARENT, e.id) for e in parent_events] + [(FORK, e["id"]) for e in events[len(parent_events):]]
+    assert len(events) == len(parent_events) + fork_events
+    assert all([m["cycle"] < FORK_CYCLE for m in memories if m["sim_id"] == PARENT])
+    assert all([m["agent_id"] is not None for m in memories])
@@ -0,0 +1,63 @@
+# the running analytics of a fork (the parent's cycles before the fork cycle at the parent's prices, then its own) match a full
+# recompute from the events of its lineage, and a rebuild from db (eg. after a restart) gives the same
+# python -m pytest tests
+from conftest import run, to_request
+
+from analytics import CycleAggregates, SimulationAnalytics, get_simulation_analytics, load_simulation_products
+from db import ProductInfo, SimulationEvent, get_lineage, use_simulation_db
+from MarcomCoreServicer import MarcomCoreServicer, create_fork
+
+PARENT, FORK, FORK_CYCLE, CYCLES = 3001, 3002, 2, 3
+
+
+def summarize(aggregates: CycleAggregates) -> tuple:
+    products = sorted([(product_id, p.purchases, round(p.revenue, 6), round(p.cost, 6)) for product_id, p in aggregates.products.items()])
+    return products, aggregates.skips, aggregates.messages
+
+
+# the aggregates straight from the events of every simulation of the lineage, each priced at its own request's prices
+def recompute(sim_id: int) -> dict[int, CycleAggregates]:
+    cycles: dict[int, CycleAggregates] = {}
+    for lineage_id, until_cycle in get_lineage(sim_id):
+        with use_simulation_db(lineage_id, create=False):
+            prices = {p.product_id: (p.price, p.cost) for p in ProductInfo.select().where(ProductInfo.sim_id == lineage_id)}
+            events = SimulationEvent.select().where(
+                (SimulationEvent.sim_id == lineage_id) & (SimulationEvent.type.in_(["BUY", "SKIP", "MESSAGE"]))
+            )
+            for event in events:
+                if until_cycle is not None and event.cycle >= until_cycle:
+                    continue
+                aggregates = cycles.setdefault(event.cycle, CycleAggregates())
+                if event.type == "BUY":
+                    product_id = int(event.content.split(":", 1)[0])
+                    aggregates.add_purchase(product_id, *prices[product_id])
+                elif event.type == "SKIP":
+                    aggregates.skips += 1
+                else:
+                    aggregates.messages += 1
+    return cycles
+
+
+def test_fork_analytics_match_full_recompute(core, model_server, monkeypatch):
+    monkeypatch.setenv("DB_SHARDING", "true")
+    model_server()
+    servicer = MarcomCoreServicer()
+    run(servicer, to_request(PARENT, 4, CYCLES, prices=[10, 20, 30]))
+    assert create_fork(FORK, PARENT, FORK_CYCLE) is None
+    run(servicer, to_request(FORK, 4, CYCLES, prices=[100, 200, 300]))
+
+    expected = recompute(FORK)
+    assert sorted(expected) == list(range(1, CYCLES + 1))
+    assert expected[1].revenue() < 4 * 30 + 1e-6  # the shared cycle is priced at the parent's prices
+
+    live = get_simulation_analytics(FORK)  # kept up to date while the fork ran
+    with use_simulation_db(FORK, create=False):
+        rebuilt = SimulationAnalytics(FORK, load_simulation_products(FORK))
+        rebuilt.rebuild()
+    total = CycleAggregates()
+    for cycle, aggregates in expected.items():
+        total.merge(aggregates)
+        assert summarize(live.get(cycle)) == summarize(aggregates)
+        assert summarize(rebuilt.get(cycle)) == summarize(aggregates)
+    assert summarize(live.get(0)) == summarize(total)
+    assert summarize(rebuilt.get(0)) == summarize(total)
@@ -0,0 +1,99 @@
+# a product added, one removed and one repriced with UpdateSimulation while the simulation runs, applied from the start of its next cycle
+# the stand-in buys the products of the catalog in its prompt in turn, and tries the removed product once after the update
+# python -m pytest tests
+import asyncio
+import json
+import re
+
+import pytest
+from conftest import run, to_request
+
+from analytics import get_simulation_analytics
+from db import SimulationChange, SimulationEvent
+from fake_model_server import FakeModelHandler
+from MarcomCoreServicer import MarcomCoreServicer
+from proto import marcom_core_pb2
+
+SIM = 5001
+NUM_AGENTS, CYCLES = 3, 3
+
+
+class CatalogHandler(FakeModelHandler):
+    catalogs: list[list[int]] = []  # product ids shown in every decision prompt
+    decisions = 0
+    tried_removed = False
+
+    def get_answer(self, prompt: str) -> str:
+        if "additional_data_id" not in prompt:
+            return super().get_answer(prompt)
+        product_ids = [int(i) for i in re.findall(r"\(product_id:(\d+),name:", prompt)]
+        self.catalogs.append(product_ids)
+        product_id = product_ids[CatalogHandler.decisions % len(product_ids)]
+        if 1 not in product_ids and not CatalogHandler.tried_removed:
+            CatalogHandler.tried_removed = True
+            product_id = 1  # still remembered from the cycle before
+        else:
+            CatalogHandler.decisions += 1
+        return json.dumps({"action": "BUY", "reason": "looks good", "additional_data_id": product_id, "additional_data_content": "product"})
+
+
+class AbortingContext:
+    async def abort(self, code, details):
+        raise Exception(f"{code}: {details}")
+
+
+def update_simulation(servicer: MarcomCoreServicer, **kwargs) -> marcom_core_pb2.UpdateSimulationResponse:
+    request = marcom_core_pb2.UpdateSimulationRequest(simulation_id=SIM, **kwargs)
+    return asyncio.run(servicer.UpdateSimulation(request, AbortingContext()))
+
+
+def test_product_added_and_removed_mid_run(core, model_server):
+    model_server(CatalogHandler)
+    servicer = MarcomCoreServicer()
+    sim = servicer.add_simulation(to_request(SIM, NUM_AGENTS, CYCLES))
+    first_cycle = run(servicer, sim, stop_after=lambda u: u.action == "ACTION_RESP" and u.cycle == 1 and u.agent_id == NUM_AGENTS)
+
+    with pytest.raises(Exception, match="No such products to remove: 7"):
+        update_simulation(servicer, removed_product_ids=[7])
+    response = update_simulation(
+        servicer,
+        products=[
+            marcom_core_pb2.Product(id=4, name="product 4", desc="a new product", price=40, cost=16),
+            marcom_core_pb2.Product(id=2, name="product 2", desc="a product", price=25, cost=8),
+        ],
+        removed_product_ids=[1],
+    )
+    with pytest.raises(Exception, match="No such products to remove: 1"):
+        update_simulation(servicer, removed_product_ids=[1])  # checked against the catalog after the queued update
+    rest = run(servicer, sim)
+    assert rest[-1].action == "COMPLETE"
+
+    # applied once, at the start of cycle 2 before any decision of it
+    announced = [u for u in rest if u.action == "SIMULATION" and response.update_id in u.content]
+    assert len(announced) == 1 and announced[0].cycle == 2
+    assert "added product 4 (product_id:4) at RM40" in announced[0].content
+    assert "removed product 1 (product_id:1)" in announced[0].content
+    assert rest.index(announced[0]) < min([i for i, u in enumerate(rest) if u.action == "BUY"])
+    assert [c.change_id for c in SimulationChange.select().where(SimulationChange.sim_id == SIM)] == [response.update_id]
+
+    # the agents only see the catalog of their cycle, and the removed product cannot be bought
+    assert CatalogHandler.catalogs[:NUM_AGENTS] == [[1, 2, 3]] * NUM_AGENTS
+    assert all([sorted(c) == [2, 3, 4] for c in CatalogHandler.catalogs[NUM_AGENTS:]])
+    assert CatalogHandler.tried_removed
+    bought = [
+        (e.cycle, int(e.content.split(":", 1)[0]))
+        for e in SimulationEvent.select().where((SimulationEvent.sim_id == SIM) & (SimulationEvent.type == "BUY"))
+    ]
+    assert sorted([p for c, p in bought if c == 1]) == [1, 2, 3]
+    for cycle in range(2, CYCLES + 1):
+        assert sorted([p for c, p in bought if c == cycle]) == [2, 3, 4]
+    assert len([u for u in first_cycle + rest if u.action == "BUY"]) == len(bought)
+
+    # each purchase at the price of its cycle
+    analytics = get_simulation_analytics(SIM)
+    assert analytics.get(1).products[2].revenue == pytest.approx(20)
+    for cycle in range(2, CYCLES + 1):
+        assert analytics.get(cycle).products[2].revenue == pytest.approx(25)
+        assert analytics.get(cycle).products[4].revenue == pytest.approx(40)
+        assert 1 not in analytics.get(cycle).products
+    assert analytics.get(0).revenue() == pytest.approx(10 + 20 + 30 + (CYCLES - 1) * (25 + 30 + 40))
@@ -0,0 +1,92 @@
+# pausing a simulation in the middle of an agent's turn, the turn's events and memories are removed and the turn is replayed on resume
+# the stand-in holds the agent's feedback call, by then the turn alrd wrote its decision and the agent's memory of it
+# python -m pytest tests
+import threading
+from datetime import datetime
+
+from conftest import run, to_request
+
+from agent import MEMORY_WINDOW
+from db import AgentInfo, AgentMemory, SimulationEvent
+from fake_model_server import FakeModelHandler
+from MarcomCoreServicer import MarcomCoreServicer
+
+SIM = 3701
+
+
+class HoldingHandler(FakeModelHandler):
+    message_rate = 0.0  # only BUY and SKIP, one decision per turn
+    reached = threading.Event()
+    release = threading.Event()
+
+    def get_latency(self, prompt: str) -> float:
+        if '"feedback"' in prompt and "additional_data_id" not in prompt and not self.release.is_set():
+            self.reached.set()
+            self.release.wait(10)
+        return 0.0
+
+
+def count_events() -> int:
+    return SimulationEvent.select().where(SimulationEvent.sim_id == SIM).count()
+
+
+def decisions() -> list[SimulationEvent]:
+    return list(SimulationEvent.select().where((SimulationEvent.sim_id == SIM) & (SimulationEvent.type.in_(["BUY", "SKIP"]))))
+
+
+# what the agent remembers is what is in db
+def assert_memory_matches_db(agent):
+    in_db = (
+        AgentMemory.select()
+        .join(AgentInfo)
+        .where((AgentInfo.agent_id == agent.id) & (AgentMemory.sim_id == SIM))
+        .order_by(AgentMemory.time_created)
+    )
+    assert [content for _, content in agent.memory] == [m.content for m in in_db][-MEMORY_WINDOW:]
+
+
+def test_turn_paused_midway_is_undone_and_replayed(core, model_server):
+    model_server(HoldingHandler)
+    servicer = MarcomCoreServicer()
+    sim = servicer.add_simulation(to_request(SIM, 2, 2))
+    updates = []
+
+    def step_until_interrupted():
+        while True:
+            update = servicer.next_update(sim)
+            if update is None:
+                return
+            updates.append(update)
+
+    stepping = threading.Thread(target=step_until_interrupted)
+    stepping.start()
+    assert HoldingHandler.reached.wait(10)
+    # the first turn is waiting for its feedback, its decision and the memory of it are in db but not streamed yet
+    held = decisions()
+    assert len(held) == 1
+    assert count_events() == len(updates) + 1
+    # the clock stepped back during the turn (eg. an ntp adjustment), the turn's rows look older than the turn
+    stepped_back = datetime(2000, 1, 1)
+    SimulationEvent.update(time_created=stepped_back).where(SimulationEvent.id == held[0].id).execute()
+    AgentMemory.update(time_created=stepped_back).where((AgentMemory.sim_id == SIM) & (AgentMemory.cycle > 0)).execute()
+
+    sim.pause_simulation()
+    HoldingHandler.release.set()
+    stepping.join(10)
+    assert not stepping.is_alive()
+
+    # undone: the db only has what was streamed, the agent forgot the decision
+    assert decisions() == []
+    assert count_events() == len(updates)
+    assert AgentMemory.select().where((AgentMemory.sim_id == SIM) & (AgentMemory.cycle > 0)).count() == 0
+    for agent in sim.agents:
+        assert_memory_matches_db(agent)
+
+    sim.resume_simulation()
+    resumed = run(servicer, sim)
+    assert resumed[-1].action == "COMPLETE"
+    # replayed once, one decision per agent per cycle and every event streamed exactly once
+    assert sorted([(e.agent.agent_id, e.cycle) for e in decisions()]) == [(a, c) for a in [1, 2] for c in [1, 2]]
+    assert count_events() == len(updates) + len(resumed) - 1  # COMPLETE is not an event
+    for agent in sim.agents:
+        assert_memory_matches_db(agent)
@@ -0,0 +1,87 @@
+# the timeout path against a stand-in model server that stalls on feedback calls, an agent's decision is written before its feedback is asked for
+# so a turn that times out has rows to roll back, the decision must be replaced with a TIMEOUT and a fallback SKIP
+# python -m pytest tests
+import os
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer
+
+from fake_model_server import FakeModelHandler
+
+STALL = 5  # seconds the stand-in waits before answering a feedback call, well past LLM_TIMEOUT
+
+
+class StallingHandler(FakeModelHandler):
+    message_rate = 0.0  # only BUY and SKIP, no one to message
+
+    def get_latency(self, prompt: str) -> float:
+        if '"feedback"' in prompt and "additional_data_id" not in prompt:
+            return STALL
+        return 0.0
+
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), StallingHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+
+# read when the core's modules are imported
+tmp_dir = tempfile.mkdtemp()
+os.environ["DB_FILE"] = os.path.join(tmp_dir, "timeouts.db")
+os.environ["DB_SHARDING"] = "false"
+os.environ["LLM_ENDPOINTS"] = f"http://127.0.0.1:{server.server_address[1]}"
+os.environ["LLM_TIMEOUT"] = "1"
+os.environ["LLM_CASSETTE"] = ""
+os.environ["BATCH_FEEDBACK"] = "false"
+os.environ["SIMULATION_WORKERS"] = "0"
+
+from MarcomCoreServicer import MarcomCoreServicer  # noqa: E402
+from db import SHARDED_TABLES, AgentMemory, ResearchReport, SimulationEvent, SimulationShard, db, migrate_db  # noqa: E402
+from proto import marcom_core_pb2  # noqa: E402
+from surrogate import TIMEOUT_REASON  # noqa: E402
+
+db.connect(reuse_if_open=True)
+migrate_db(SHARDED_TABLES + [SimulationShard, ResearchReport])
+
+
+def to_request(sim_id: int, num_agents: int, cycles: int) -> marcom_core_pb2.SimulationRequest:
+    return marcom_core_pb2.SimulationRequest(
+        id=sim_id,
+        env_desc="a small town",
+        total_cycles=cycles,
+        agents=[
+            marcom_core_pb2.Agent(id=i, name=f"agent {i}", desc="a shopper", attrs=[marcom_core_pb2.AgentAttribute(key="age", value="30")])
+            for i in range(1, num_agents + 1)
+        ],
+        products=[marcom_core_pb2.Product(id=i, name=f"product {i}", desc="a product", price=10 * i, cost=4 * i) for i in range(1, 4)],
+    )
+
+
+# steps the simulation the way a stream does until it completes
+def run(servicer: MarcomCoreServicer, request) -> list[marcom_core_pb2.SimulationUpdate]:
+    sim = servicer.add_simulation(request)
+    updates = []
+    while True:
+        update = servicer.next_update(sim)
+        assert update is not None
+        updates.append(update)
+        if update.action == "COMPLETE":
+            return updates
+
+
+def test_timed_out_turn_is_rolled_back():
+    num_agents, cycles = 2, 1
+    updates = run(MarcomCoreServicer(), to_request(1, num_agents, cycles))
+
+    timeouts = [u for u in updates if u.action == "TIMEOUT"]
+    assert sorted([u.agent_id for u in timeouts]) == list(range(1, num_agents + 1))
+    assert all(["did not decide in time" in u.content for u in timeouts])
+    assert not any([u.action == "ACTION_RESP" for u in updates])  # no feedback was ever generated
+
+    # the LLM's decisions were deleted with their turns, only the fallbacks are left
+    decisions = list(SimulationEvent.select().where((SimulationEvent.sim_id == 1) & (SimulationEvent.type.in_(["BUY", "SKIP"]))))
+    assert len(decisions) == num_agents * cycles
+    assert all([e.type == "SKIP" and e.decided_by == "fallback" and TIMEOUT_REASON in e.content for e in decisions])
+    # so were their memories, the stand-in's reasons are "looks good" and "too pricey"
+    memories = AgentMemory.select().where(
+        (AgentMemory.sim_id == 1) & (AgentMemory.content.contains("looks good") | AgentMemory.content.contains("too pricey"))
+    )
+    assert memories.count() == 0
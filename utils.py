@@ -10,8 +10,39 @@ class InvalidJsonException(Exception):
 class FailedAdditionalCheckException(Exception):
     pass
 
+# raised when max_retries is given and the chain still cannot give a valid response, so caller can fallback (eg. to a larger model)
+class RetryLimitExceededException(Exception):
+    pass
+
+# raised from within an LLM call when the simulation it belongs to is paused or no one is streaming it anymore, so the work stops instead of running to completion
+class CancelledException(Exception):
+    pass
+
+# raised from within an LLM call that runs past its timeout (LLM_TIMEOUT) or the deadline of the work it belongs to (eg. cycle deadline, grpc deadline)
+class LLMTimeoutException(Exception):
+    pass
+
+# the deadline of the work passed (as opposed to the single call taking too long), no point falling back to another model
+class DeadlinePassedException(LLMTimeoutException):
+    pass
+
+# raised when replaying a cassette and the run makes a call the recording does not have at that point
+class CassetteDivergenceException(Exception):
+    pass
+
+# raised when the shard file of a simulation in the catalog is gone without the simulation being dropped (eg. deleted by hand), so the simulation
+# is not quietly started over in an empty shard
+class MissingShardException(Exception):
+    pass
+
+# raised when the worker process running a simulation died (or could not be reached) before it sent the simulation's next update
+class WorkerDiedException(Exception):
+    pass
+
 # expects chains ending with json parser, invokes the chain until returned response is json and has the expected fields
-def get_chain_response_json(chain: any, invoker: dict[str, str], expected_fields: list[str], additional_check: Callable[[dict[str, str]], bool] = None):
+# max_retries None means retry forever (the original behaviour), on_retry is called everytime a response is rejected (for stats)
+def get_chain_response_json(chain: any, invoker: dict[str, str], expected_fields: list[str], additional_check: Callable[[dict[str, str]], bool] = None, max_retries: int = None, on_retry: Callable[[], None] = None):
+    retries = 0
     while True:
         try:
             res = chain.invoke(invoker)
@@ -30,6 +61,11 @@ def get_chain_response_json(chain: any, invoker: dict[str, str], expected_fields
             print("Respond does not have field wanted, retrying", res)
         except FailedAdditionalCheckException:
             print("Respond failed additional check, retrying", res)
+        retries += 1
+        if on_retry is not None:
+            on_retry()
+        if max_retries is not None and retries >= max_retries:
+            raise RetryLimitExceededException
 
 def get_format_instruction_of_pydantic_object(o: Type[BaseModel]):
     schema = o.model_json_schema()
@@ -38,4 +74,4 @@ def get_format_instruction_of_pydantic_object(o: Type[BaseModel]):
         final_str += f"field with key \"{k}\" where it's value is described as \"{v['description']}\", "
     final_str = final_str.strip(", ") # remove final comma cuz they are not needed
     final_str += ". Only respond the JSON object with the specified keys, do not include keys that are not mentioned."
-    return final_str
\ No newline at end of file
+    return final_str
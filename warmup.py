@@ -0,0 +1,207 @@
+# keeps the models the core routes to loaded on the model servers, so the first call after a restart (or after a server unloaded an idle model)
+# does not stall on the model load time (eg. the first cycle of a simulation, the first research request)
+# every model is loaded on every server when the core starts, pinged with keep alive while simulations are running so idle tiers stay loaded,
+# and before a simulation starts the start of the agent prompt (the same for every agent) is sent once in the background so the servers have it cached
+# the core only reports ready (GetReadiness) once the warm up is done and every model is loaded on at least one server
+import os
+import queue
+import threading
+import time
+from typing import Callable
+
+import requests
+
+from backend_pool import Backend, get_backend_pool
+from cassette import get_cassette_mode
+from llm import current_cancel_event, current_deadline, get_keep_alive, get_route, get_tier_model, get_used_tiers
+
+DEFAULT_KEEP_ALIVE_INTERVAL = 60  # seconds between keep alive pings, well under the keep alive so a model never gets to expire
+DEFAULT_WARM_UP_TIMEOUT = 300  # loading a large model from disk can take minutes
+
+
+# replays get everything from the cassette, no model server to warm up
+def is_warm_up_enabled() -> bool:
+    return os.getenv("LLM_WARM_UP") != "false" and get_cassette_mode() != "replay"
+
+
+# models of the used tiers, several tiers can be the same model
+def get_warm_up_models() -> list[str]:
+    models = []
+    for tier in get_used_tiers():
+        if get_tier_model(tier) not in models:
+            models.append(get_tier_model(tier))
+    return models
+
+
+class ModelStatus:
+    def __init__(self, backend: Backend, model: str) -> None:
+        self.backend = backend
+        self.model = model
+        self.loaded = False
+        self.load_time: float = None  # seconds the first load took
+        self.error = ""  # why the last load failed
+
+    def string(self) -> str:
+        if self.loaded:
+            return f"{self.model}@{self.backend.url}: loaded in {self.load_time:.1f}s"
+        return f"{self.model}@{self.backend.url}: {self.error or 'not loaded'}"
+
+
+class ModelResidency:
+    def __init__(
+        self,
+        models: list[str],
+        backends: list[Backend],
+        keep_alive_interval: float = DEFAULT_KEEP_ALIVE_INTERVAL,
+        timeout: float = DEFAULT_WARM_UP_TIMEOUT,
+    ) -> None:
+        self.statuses = [ModelStatus(backend, model) for backend in backends for model in models]
+        self.keep_alive_interval = keep_alive_interval
+        self.timeout = timeout
+        self.warmed_up = threading.Event()  # set once every model got its first load attempt
+        self.is_active: Callable[[], bool] = lambda: False  # whether any simulation is running, set by the servicer
+        self.lock = threading.Lock()
+        self.thread: threading.Thread = None
+        # (model, prefix, deadline, cancel event) of the prefills waiting for the prefill thread, and the (model, prefix) pairs among them
+        self.prefills: queue.Queue = queue.Queue()
+        self.pending_prefills: set[tuple[str, str]] = set()
+        self.prefill_thread: threading.Thread = None
+
+    # asks the server to load the model (an empty prompt only loads it), a prompt is also evaluated so the server has it cached
+    # timeout None waits as long as a model load can take
+    def load(self, status: ModelStatus, prompt: str = "", timeout: float = None) -> bool:
+        start = time.perf_counter()
+        try:
+            res = requests.post(
+                f"{status.backend.url}/api/generate",
+                json={
+                    "model": status.model,
+                    "prompt": prompt,
+                    "stream": False,
+                    "keep_alive": get_keep_alive(),
+                    "options": {"num_predict": 1},
+                },
+                timeout=timeout or self.timeout,
+            )
+            res.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            if prompt != "":
+                # a prefill cut short by its simulation's deadline says nothing about the model, keep_resident finds unloaded ones
+                print(f"Prompt prefix not prefilled for {status.model} on {status.backend.url}: {e}")
+                return False
+            with self.lock:
+                if status.loaded:
+                    print(f"Model {status.model} on {status.backend.url} could not be kept loaded: {e}")
+                status.loaded = False
+                status.error = str(e)
+            return False
+        with self.lock:
+            if not status.loaded:
+                status.load_time = time.perf_counter() - start
+                status.loaded = True
+                status.error = ""
+                print(f"Model {status.string()}")
+        return True
+
+    # servers load one model at a time anyways, so each server's models are loaded one after another but the servers in parallel
+    def warm_up(self):
+        start = time.perf_counter()
+        threads = []
+        for backend in {status.backend.url: status.backend for status in self.statuses}.values():
+            statuses = [status for status in self.statuses if status.backend is backend]
+            thread = threading.Thread(
+                target=lambda statuses=statuses: [self.load(status) for status in statuses],
+                name="llm-warm-up",
+                daemon=True,
+            )
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        self.warmed_up.set()
+        print(f"Model warm up done in {time.perf_counter() - start:.1f}s, {'ready' if self.is_ready() else 'not ready'}: {self.string()}")
+
+    # while simulations run every model is pinged so the ones rarely called (eg. fallback tiers) are not unloaded between calls
+    # models that failed to load are retried even with nothing running, the core is not ready until they are loaded
+    def keep_resident(self):
+        while True:
+            time.sleep(self.keep_alive_interval)
+            if not self.is_active() and self.is_ready():
+                continue
+            for status in self.statuses:
+                if status.backend.healthy or not status.loaded:
+                    self.load(status)
+
+    def start(self, is_active: Callable[[], bool]):
+        self.is_active = is_active
+        if self.thread is not None:
+            return
+
+        def run():
+            self.warm_up()
+            if self.keep_alive_interval > 0:
+                self.keep_resident()
+
+        self.thread = threading.Thread(target=run, name="llm-residency", daemon=True)
+        self.thread.start()
+
+    # the agent prompts of a simulation all start with the same prefix, it is evaluated once on every server before the first turns
+    # so the first agents on each server do not all pay for it (also loads the model if it got unloaded)
+    # queued for the prefill thread so the simulation's step never waits on it, dropped once the simulation is cancelled (eg. paused)
+    # and cut short by the deadline of the work that queued it
+    def prefill(self, call_site: str, prefix: str):
+        model = get_tier_model(get_route(call_site))
+        with self.lock:
+            if (model, prefix) in self.pending_prefills:
+                return  # eg. the variants of a sweep starting together
+            self.pending_prefills.add((model, prefix))
+            if self.prefill_thread is None:
+                self.prefill_thread = threading.Thread(target=self.run_prefills, name="llm-prefill", daemon=True)
+                self.prefill_thread.start()
+        self.prefills.put((model, prefix, current_deadline.get(), current_cancel_event.get()))
+
+    def run_prefills(self):
+        while True:
+            model, prefix, deadline, cancel_event = self.prefills.get()
+            for status in self.statuses:
+                timeout = self.timeout if deadline is None else min(self.timeout, deadline - time.monotonic())
+                if (cancel_event is not None and cancel_event.is_set()) or timeout <= 0:
+                    break
+                if status.model == model and status.backend.healthy:
+                    self.load(status, prompt=prefix, timeout=timeout)
+            with self.lock:
+                self.pending_prefills.discard((model, prefix))
+
+    def is_ready(self) -> bool:
+        with self.lock:
+            models = {status.model for status in self.statuses}
+            loaded = {status.model for status in self.statuses if status.loaded}
+        return self.warmed_up.is_set() and models == loaded
+
+    def string(self) -> str:
+        with self.lock:
+            return "; ".join([status.string() for status in self.statuses])
+
+
+model_residency: ModelResidency = None
+model_residency_lock = threading.Lock()
+
+
+# built on first use since dotenv is only loaded in main after the modules are imported
+def get_model_residency() -> ModelResidency:
+    global model_residency
+    with model_residency_lock:
+        if model_residency is None:
+            model_residency = ModelResidency(
+                get_warm_up_models() if is_warm_up_enabled() else [],
+                get_backend_pool().backends,
+                keep_alive_interval=float(os.getenv("LLM_KEEP_ALIVE_INTERVAL") or DEFAULT_KEEP_ALIVE_INTERVAL),
+                timeout=float(os.getenv("LLM_WARM_UP_TIMEOUT") or DEFAULT_WARM_UP_TIMEOUT),
+            )
+        return model_residency
+
+
+# prefills the shared prompt prefix of a simulation's agents, nothing to do when the warm up is off
+def prefill_prompt_prefix(call_site: str, prefix: str):
+    if is_warm_up_enabled():
+        get_model_residency().prefill(call_site, prefix)
@@ -0,0 +1,299 @@
+# worker pool mode (SIMULATION_WORKERS > 0), every simulation runs in one of a pool of worker processes instead of in the servicer's process
+# so the json parsing, prompt rendering, orm and protobuf work of different simulations are not all under one GIL, and a crash or leak only takes down its worker
+# the servicer supervises the workers: a simulation is assigned to the worker running the fewest simulations, a stream pulling an update asks the worker for it,
+# and a worker that died is restarted with its simulations continuing from the last cycle they completed (see Simulation.rollback_unfinished_cycle)
+# commands and updates go over a pipe per worker, updates as serialized protobuf
+import multiprocessing
+import os
+import threading
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing.connection import Connection
+from typing import Any
+
+from analytics import SimulationAnalytics, register_simulation_analytics
+from db import EventRecord, db, use_simulation_db
+from live_update import LiveUpdate, load_live_update
+from product import Product
+from proto import marcom_core_pb2
+from utils import WorkerDiedException
+
+DEFAULT_MAX_RESTARTS = 3  # times in a row a simulation's worker can die on it before the simulation is given up on
+
+
+# runs in the worker process, executes the commands of the supervisor until the pipe closes
+def run_worker(conn: Connection, index: int):
+    # imported here since the servicer imports this module
+    from MarcomCoreServicer import build_simulation, step_local_simulation
+
+    db.connect(reuse_if_open=True)
+    simulations = {}  # sim id -> simulation
+    generators = {}  # sim id -> generator of the simulation
+    executor = ThreadPoolExecutor(max_workers=int(os.getenv("LLM_WORKERS") or 16), thread_name_prefix="llm")
+    send_lock = threading.Lock()  # steps of different simulations reply from their own threads
+
+    def reply(sim_id: int, payload: dict[str, Any]):
+        with send_lock:
+            conn.send((sim_id, payload))
+
+    def step(sim):
+        try:
+            update = step_local_simulation(sim, generators)
+        except Exception:
+            reply(int(sim.id), {"error": traceback.format_exc()})
+            return
+        if update is not None and update.action == "COMPLETE":
+            simulations.pop(int(sim.id), None)
+        reply(
+            int(sim.id),
+            {
+                "update": update.SerializeToString() if update is not None else None,
+                "cycle": sim.cycle,
+                "total_cycle": sim.total_cycle,  # lowered when the token budget runs out
+                "updates_applied": len(sim.applied_updates),
+            },
+        )
+
+    print(f"Simulation worker {index} started (pid {os.getpid()})")
+    while True:
+        try:
+            command, sim_id, *args = conn.recv()
+        except EOFError:
+            break  # supervisor is gone
+        sim = simulations.get(sim_id)
+        match command:
+            case "create":
+                request = marcom_core_pb2.SimulationRequest.FromString(args[0])
+                sim = build_simulation(request)
+                sim.resume = args[1]
+                simulations[sim_id] = sim
+                generators[sim_id] = sim.run_simulation()
+            case "step":
+                executor.submit(step, sim)
+            case "pause":
+                sim.pause_simulation()
+            case "resume":
+                sim.resume_simulation()
+            case "cancel":
+                sim.cancel()
+            case "clear":
+                sim.cancel_event.clear()
+            case "update":
+                sim.queue_update(load_live_update(args[0], args[1], sim_id))
+
+
+class WorkerProcess:
+    def __init__(self, index: int) -> None:
+        self.index = index
+        self.process: multiprocessing.Process = None
+        self.conn: Connection = None
+        self.pending: dict[int, Future] = {}  # sim id -> step waiting for its update, a new dict for every process
+        self.simulations: set[int] = set()  # simulations created on the current process
+        self.assigned = 0  # simulations assigned to this worker that did not complete yet
+        self.restarts = 0
+        self.broken = False  # the pipe to the current process closed
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.start()
+
+    def start(self):
+        ctx = multiprocessing.get_context("spawn")  # forking a process with grpc threads running is not safe
+        conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=run_worker, args=(child_conn, self.index), name=f"simulation-worker-{self.index}", daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.conn = conn
+        self.pending = {}
+        self.simulations = set()
+        self.broken = False
+        threading.Thread(
+            target=self.read, args=(conn, self.pending), name=f"simulation-worker-{self.index}-reader", daemon=True
+        ).start()
+
+    # hands the updates to the steps waiting for them, fails the waiting steps once the process is gone
+    def read(self, conn: Connection, pending: dict[int, Future]):
+        while True:
+            try:
+                sim_id, payload = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                future = pending.pop(sim_id, None)
+            if future is not None:
+                future.set_result(payload)
+        with self.lock:
+            if conn is self.conn:
+                self.broken = True
+            waiting = list(pending.values())
+            pending.clear()
+        for future in waiting:
+            future.set_exception(WorkerDiedException(f"Simulation worker {self.index} died"))
+
+    def restart_if_dead(self):
+        with self.lock:
+            if self.process.is_alive() and not self.broken:
+                return
+            if self.process.is_alive():
+                self.process.terminate()  # cannot be talked to anymore
+            self.process.join(5)
+            self.restarts += 1
+            print(f"Simulation worker {self.index} died (exit code {self.process.exitcode}), restarting it")
+            self.conn.close()
+            self.start()
+
+    def send(self, *command):
+        with self.send_lock:
+            try:
+                self.conn.send(command)
+            except (BrokenPipeError, OSError) as e:
+                raise WorkerDiedException(f"Simulation worker {self.index} could not be reached: {e}") from e
+
+    # sends the step and waits for the update it replies with
+    def call_step(self, sim_id: int) -> dict[str, Any]:
+        future = Future()
+        with self.lock:
+            if self.broken:
+                raise WorkerDiedException(f"Simulation worker {self.index} died")
+            self.pending[sim_id] = future
+        self.send("step", sim_id)
+        return future.result()
+
+
+# stands in for the Simulation in the servicer, the simulation itself runs in its worker
+class RemoteSimulation:
+    def __init__(self, pool: "WorkerPool", request) -> None:
+        self.pool = pool
+        self.id = int(request.id)
+        self.request = request.SerializeToString()  # to create the simulation again if its worker dies
+        self.total_cycle = int(request.total_cycles)
+        self.cycle = 0
+        self.paused = False
+        self.cancel_event = RemoteCancelEvent(self)
+        self.step_lock = threading.Lock()
+        # analytics are recorded here from the updates, the worker's are in another process
+        self.analytics = SimulationAnalytics(
+            self.id,
+            [
+                Product(id=p.id, name=p.name, desc=p.desc, price=p.price, cost=p.cost, simulation_id=self.id)
+                for p in request.products
+            ],
+        )
+        register_simulation_analytics(self.analytics)
+        self.rebuild_analytics = True  # after the simulation is (re)created, once its initialisation dropped any unfinished cycle
+        self.crashes = 0  # times in a row its worker died on it
+        self.created = False  # created on a worker before, so a new one continues it instead of starting it over
+        self.product_ids = set([int(p.id) for p in request.products])  # catalog after the updates queued so far, to check the next one
+        # every live update queued, sent again when the simulation is created on a worker (the ones it alrd applied are skipped)
+        self.updates: list[tuple[str, str]] = []
+        self.updates_applied = 0
+        self.worker = pool.assign()
+
+    # commands about the simulation are dropped if its worker is gone, a new worker gets the simulation in its current state anyways
+    def send(self, command: str, *args):
+        if self.id not in self.worker.simulations:
+            return
+        try:
+            self.worker.send(command, self.id, *args)
+        except WorkerDiedException:
+            pass
+
+    def pause_simulation(self):
+        self.paused = True
+        self.send("pause")
+
+    def resume_simulation(self):
+        self.paused = False
+        self.send("resume")
+
+    def cancel(self):
+        self.send("cancel")
+
+    def check_update(self, update: LiveUpdate) -> str:
+        return update.check(self.product_ids)
+
+    def queue_update(self, update: LiveUpdate):
+        self.product_ids = update.product_ids(self.product_ids)
+        self.updates.append((update.id, update.to_json()))
+        self.send("update", update.id, update.to_json())
+
+    # same as step_local_simulation, but in the worker
+    def step(self) -> marcom_core_pb2.SimulationUpdate:
+        while True:
+            self.worker.restart_if_dead()
+            try:
+                if self.id not in self.worker.simulations:
+                    # a simulation created again continues from the last cycle it completed
+                    self.worker.send("create", self.id, self.request, self.created)
+                    for update in self.updates:
+                        self.worker.send("update", self.id, *update)
+                    self.worker.simulations.add(self.id)
+                    self.created = True
+                    self.rebuild_analytics = True
+                payload = self.worker.call_step(self.id)
+                break
+            except WorkerDiedException as e:
+                self.crashes += 1
+                if self.crashes > self.pool.max_restarts:
+                    raise
+                print(f"Simulation {self.id}: {e}, continuing on a new worker")
+        if "error" in payload:
+            raise RuntimeError(f"Simulation {self.id} failed in worker {self.worker.index}:\n{payload['error']}")
+        self.crashes = 0
+        self.cycle = payload["cycle"]
+        self.total_cycle = payload["total_cycle"]
+        if payload["updates_applied"] != self.updates_applied:
+            self.updates_applied = payload["updates_applied"]
+            self.rebuild_analytics = True  # the prices changed, the analytics replay the updates from the db
+        if payload["update"] is None:
+            return None
+        update = marcom_core_pb2.SimulationUpdate.FromString(payload["update"])
+        if self.rebuild_analytics:
+            # the events so far are in the db (this one included), counted from there like a simulation does when it initialises
+            with use_simulation_db(self.id, create=False):
+                self.analytics.rebuild()
+            self.rebuild_analytics = False
+        else:
+            self.analytics.record(
+                EventRecord(0, update.simulation_id, update.agent_id, update.action, update.content, update.cycle)
+            )
+        if update.action == "COMPLETE":
+            self.pool.release(self)
+        return update
+
+
+# the cancel event of a RemoteSimulation, setting or clearing it is sent to the simulation in its worker
+class RemoteCancelEvent:
+    def __init__(self, sim: RemoteSimulation) -> None:
+        self.sim = sim
+
+    def set(self):
+        self.sim.send("cancel")
+
+    def clear(self):
+        self.sim.send("clear")
+
+
+class WorkerPool:
+    def __init__(self, size: int, max_restarts: int = None) -> None:
+        self.workers = [WorkerProcess(i) for i in range(size)]
+        self.max_restarts = (
+            max_restarts if max_restarts is not None else int(os.getenv("WORKER_MAX_RESTARTS") or DEFAULT_MAX_RESTARTS)
+        )
+        self.lock = threading.Lock()
+        print(f"Started {size} simulation workers")
+
+    def assign(self) -> WorkerProcess:
+        with self.lock:
+            worker = min(self.workers, key=lambda w: w.assigned)
+            worker.assigned += 1
+            return worker
+
+    def release(self, sim: RemoteSimulation):
+        with self.lock:
+            sim.worker.assigned -= 1
+        sim.worker.simulations.discard(sim.id)
+
+    def create_simulation(self, request) -> RemoteSimulation:
+        return RemoteSimulation(self, request)